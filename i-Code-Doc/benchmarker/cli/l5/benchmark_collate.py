@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import logging
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import fire
+import numpy as np
+import torch
+
+from benchmarker.cli.l5.common.data.datamodule import L5DataModule
+from benchmarker.utils.pregenerated import PregeneratedCustomDataset
+from benchmarker.utils.training import BufferedDictCollate, dict_collate, dict_collate_trim_l5
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _max_abs_diff(a: Any, b: Any) -> float:
+    if isinstance(a, dict):
+        return max([_max_abs_diff(a[k], b[k]) for k in a] + [0.0])
+    if isinstance(a, torch.Tensor):
+        assert a.shape == b.shape and a.dtype == b.dtype, (a.shape, b.shape, a.dtype, b.dtype)
+        return (a.double() - b.double()).abs().max().item() if a.numel() else 0.0
+    return 0.0 if a == b else float('inf')
+
+
+def _time_collate(collate: Callable, batches: Sequence[List[Dict[str, Any]]], repeats: int) -> float:
+    collate(batches[0])
+    tic = time.perf_counter()
+    for _ in range(repeats):
+        for batch in batches:
+            collate(batch)
+    return (time.perf_counter() - tic) / (repeats * len(batches))
+
+
+def benchmark_collate(
+    memmap_path: str,
+    batch_sizes: Tuple[int, ...] = (8, 16, 32, 64),
+    num_batches: int = 20,
+    repeats: int = 3,
+    trim: bool = True,
+    segment_levels: Tuple[str, ...] = ('tokens', 'pages'),
+    seed: int = 0,
+):
+    """
+    Collate time per batch of the default collate functions against `BufferedDictCollate`, on batches of
+    a pregenerated memmap directory with page images. Sample fetching is excluded from the timing; the
+    buffered collate gets memmap row views as the datamodule passes them with `--batch_buffer_slots`.
+
+    Args:
+        memmap_path: directory written by create_memmaps (a split directory)
+        batch_sizes: batch sizes to measure
+        num_batches: random batches per batch size
+        repeats: passes over the batches
+        trim: compare against `dict_collate_trim_l5` instead of `dict_collate`
+        segment_levels: segment levels to load
+        seed: seed of the batch sampling
+    """
+    dataset = PregeneratedCustomDataset.load_from_memmap(
+        path=Path(memmap_path),
+        im_dir=None,
+        segment_levels=tuple(segment_levels),
+        additional_memmap_files=('lm_label_ids', 'doc_id'),
+    )
+    assert dataset.page_images is not None, 'rasterize page images first (create_memmaps --im_dir)'
+    L5DataModule.rename_keys(dataset.data)
+    reference = dict_collate_trim_l5 if trim else dict_collate
+    rng = np.random.RandomState(seed)
+
+    print('{:>6} {:>14} {:>14} {:>9} {:>10}'.format('batch', 'default (ms)', 'buffered (ms)', 'speedup', 'max diff'))
+    for batch_size in batch_sizes:
+        indices = [rng.choice(len(dataset), batch_size, replace=False) for _ in range(num_batches)]
+        dataset.copy_rows = True
+        copied = [[dataset[int(i)] for i in idx] for idx in indices]
+        dataset.copy_rows = False
+        views = [[dataset[int(i)] for i in idx] for idx in indices]
+
+        buffered = BufferedDictCollate(trim=trim, num_slots=2)
+        diff = _max_abs_diff(reference(copied[0]), buffered(views[0]))
+        reference_time = _time_collate(reference, copied, repeats)
+        buffered_time = _time_collate(buffered, views, repeats)
+        print('{:>6} {:>14.3f} {:>14.3f} {:>8.2f}x {:>10.2e}'.format(
+            batch_size, reference_time * 1e3, buffered_time * 1e3, reference_time / buffered_time, diff))
+
+
+if __name__ == '__main__':
+    fire.Fire(benchmark_collate)
@@ -0,0 +1,231 @@
+import logging
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+from torch.utils.data.dataset import ConcatDataset, Dataset
+
+from benchmarker.utils.memmap_writer import ShardedColumn
+
+logger = logging.getLogger(__name__)
+
+
+def _column_parts(column) -> List[np.ndarray]:
+    return column.parts if isinstance(column, ShardedColumn) else [column]
+
+
+def row_lengths(column, chunk_size: int = 8192) -> np.ndarray:
+    """
+    Number of non-zero entries of every row of a [num_samples x seq_len] memmap, read in chunks.
+    """
+    lengths = []
+    for part in _column_parts(column):
+        for start in range(0, len(part), chunk_size):
+            lengths.append(np.count_nonzero(np.asarray(part[start:start + chunk_size]), axis=1))
+    return np.concatenate(lengths).astype(np.int64)
+
+
+def dataset_lengths(dataset: Dataset, key: str = 'attention_mask') -> np.ndarray:
+    """
+    Per-sample lengths of a pregenerated dataset (or ConcatDataset of them) from its stored masks.
+    """
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([dataset_lengths(d, key) for d in dataset.datasets])
+    return row_lengths(dataset.data[key])
+
+
+def padded_size(lengths: np.ndarray, batches: Sequence[Sequence[int]], divisibility: int = 32) -> int:
+    """
+    Number of token slots the batches occupy when trimmed to the longest element as `dict_collate_trim_l5` does.
+    """
+    total = 0
+    for batch in batches:
+        longest = lengths[batch].max()
+        total += len(batch) * int(-(-longest // divisibility) * divisibility)
+    return total
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping samples of similar length.
+
+    Samples are assigned to buckets by `bucket_boundaries` (upper bounds of lengths, longer samples go to
+    an extra last bucket), shuffled within buckets and cut into batches; the batches are then shuffled
+    across buckets. Each iteration uses a new permutation derived from `seed` and the epoch, which is
+    advanced after every iteration unless set explicitly with `set_epoch`, so all ranks produce the
+    same batches.
+
+    In distributed runs the batches are sharded here, rank `rank` taking every `num_replicas`-th batch
+    (defaults come from the initialized process group), so the sampler must not be wrapped nor replaced
+    by Lightning (`replace_sampler_ddp=False`). Every rank gets `num_batches_per_replica` batches, the
+    last ones are repeated from the start as `DistributedSampler` pads.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, bucket_boundaries: Sequence[int],
+                 shuffle: bool = True, drop_last: bool = False, seed: int = 0, divisibility: int = 32,
+                 num_replicas: Optional[int] = None, rank: Optional[int] = None):
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        assert 0 <= rank < num_replicas, f"Invalid rank {rank} for {num_replicas} replicas"
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_boundaries = sorted(bucket_boundaries)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.divisibility = divisibility
+        self.epoch = 0
+        self.buckets = np.searchsorted(self.bucket_boundaries, self.lengths, side='left')
+        self.padding_ratio: Optional[float] = None
+        self._num_batches_per_replica: Optional[int] = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def batches(self, epoch: int) -> List[List[int]]:
+        rng = np.random.RandomState(self.seed + epoch)
+        batches = []
+        for bucket in np.unique(self.buckets):
+            indices = np.flatnonzero(self.buckets == bucket)
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            else:
+                # length order inside bucket minimizes padding for evaluation
+                indices = indices[np.argsort(self.lengths[indices], kind='stable')]
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def report_padding(self, batches: List[List[int]], epoch: int) -> float:
+        real = int(sum(self.lengths[b].sum() for b in batches))
+        padded = padded_size(self.lengths, batches, self.divisibility)
+        self.padding_ratio = 1 - real / max(padded, 1)
+        rng = np.random.RandomState(self.seed + epoch)
+        order = rng.permutation(len(self.lengths))
+        random_batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        random_ratio = 1 - self.lengths.sum() / max(padded_size(self.lengths, random_batches, self.divisibility), 1)
+        logger.info(f'Length bucketing: padding ratio {self.padding_ratio:.3f} '
+                    f'(random batching {random_ratio:.3f}) over {len(batches)} batches')
+        return self.padding_ratio
+
+    def num_batches(self) -> int:
+        """
+        Number of batches of an epoch over all ranks.
+        """
+        counts = np.bincount(self.buckets)
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int((-(-counts // self.batch_size)).sum())
+
+    @property
+    def num_batches_per_replica(self) -> int:
+        if self._num_batches_per_replica is None:
+            self._num_batches_per_replica = -(-self.num_batches() // self.num_replicas)
+        return self._num_batches_per_replica
+
+    def shard(self, batches: List[List[int]]) -> List[List[int]]:
+        """
+        Batches of this rank, `num_batches_per_replica` of them whatever the number of batches.
+        """
+        total = self.num_batches_per_replica * self.num_replicas
+        if batches and len(batches) < total:
+            batches = batches + (batches * (-(-total // len(batches))))[:total - len(batches)]
+        return batches[:total][self.rank::self.num_replicas]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        epoch = self.epoch
+        batches = self.batches(epoch)
+        self.report_padding(batches, epoch)
+        self.epoch += 1
+        return iter(self.shard(batches))
+
+    def __len__(self) -> int:
+        return self.num_batches_per_replica
+
+
+class TokenBudgetBatchSampler(LengthBucketBatchSampler):
+    """
+    Batch sampler forming variable-size batches under a token budget.
+
+    A batch is grown while `batch_size * (padded longest input + padded longest target + extra_tokens)`
+    stays within `max_tokens`, padding is counted the way `dict_collate_trim_l5` trims. Samples are
+    bucketed and shuffled as in `LengthBucketBatchSampler`; without shuffling they are taken in length
+    order, and `order` keeps the sample order of the last iteration to restore the input order of
+    predictions.
+
+    Batches are sharded across ranks as in `LengthBucketBatchSampler`. The number of batches changes
+    between epochs with the shuffling, so every rank gets the number of batches of the first epoch:
+    later epochs drop their surplus batches or repeat their first ones. `__len__` is thus the same on
+    all ranks and in all epochs.
+    """
+
+    def __init__(self, lengths: np.ndarray, target_lengths: np.ndarray, max_tokens: int,
+                 bucket_boundaries: Sequence[int], shuffle: bool = True, seed: int = 0, divisibility: int = 32,
+                 extra_tokens: int = 0, max_batch_size: Optional[int] = None, num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None):
+        super().__init__(lengths, batch_size=1, bucket_boundaries=bucket_boundaries, shuffle=shuffle,
+                         drop_last=False, seed=seed, divisibility=divisibility, num_replicas=num_replicas,
+                         rank=rank)
+        self.target_lengths = np.asarray(target_lengths)
+        self.max_tokens = max_tokens
+        self.extra_tokens = extra_tokens
+        self.max_batch_size = max_batch_size
+        self.order: Optional[np.ndarray] = None
+
+    def _pad(self, length: int) -> int:
+        return int(-(-length // self.divisibility) * self.divisibility)
+
+    def batches(self, epoch: int) -> List[List[int]]:
+        rng = np.random.RandomState(self.seed + epoch)
+        batches = []
+        for bucket in np.unique(self.buckets):
+            indices = np.flatnonzero(self.buckets == bucket)
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            else:
+                indices = indices[np.argsort(self.lengths[indices], kind='stable')]
+            batch, longest_input, longest_target = [], 0, 0
+            for idx in indices:
+                new_input = max(longest_input, self._pad(self.lengths[idx]))
+                new_target = max(longest_target, self._pad(self.target_lengths[idx]))
+                cost = (len(batch) + 1) * (new_input + new_target + self.extra_tokens)
+                full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+                if batch and (cost > self.max_tokens or full):
+                    batches.append(batch)
+                    batch, new_input, new_target = [], self._pad(self.lengths[idx]), self._pad(self.target_lengths[idx])
+                batch.append(int(idx))
+                longest_input, longest_target = new_input, new_target
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def num_batches(self) -> int:
+        return len(self.batches(0))
+
+    def target_tokens_per_batch(self) -> float:
+        """
+        Average number of target tokens per batch, used to normalize summed losses of varying batches.
+        """
+        return float(self.target_lengths.sum()) / max(self.num_batches_per_replica * self.num_replicas, 1)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        epoch = self.epoch
+        batches = self.batches(epoch)
+        self.report_padding(batches, epoch)
+        batches = self.shard(batches)
+        self.order = np.array([idx for batch in batches for idx in batch], dtype=np.int64)
+        self.epoch += 1
+        return iter(batches)
@@ -3,15 +3,20 @@ import logging
 import os
 import re
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional
 
 import pytorch_lightning as pl
 from catalyst.data import DistributedSamplerWrapper
 from torch.utils.data import DataLoader, RandomSampler, Sampler, SequentialSampler
 from torch.utils.data.dataset import ConcatDataset, Dataset
 
+from benchmarker.cli.l5.common.data.bucket_sampler import (
+    LengthBucketBatchSampler,
+    TokenBudgetBatchSampler,
+    dataset_lengths,
+)
 from benchmarker.utils.pregenerated import PregeneratedCustomDataset
-from benchmarker.utils.training import dict_collate, dict_collate_trim_l5
+from benchmarker.utils.training import BufferedDictCollate, dict_collate, dict_collate_trim_l5
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +30,11 @@ class L5DataModule(pl.LightningDataModule):
         self.additional_data_fields = tuple(self.hparams.additional_data_fields)
         self.input_len = self.hparams.max_source_length
         self.trim_batches = self.hparams.trim_batches
-        self.collate = dict_collate_trim_l5 if self.trim_batches else dict_collate
+        self.batch_buffer_slots = getattr(self.hparams, "batch_buffer_slots", 0)
+        if self.batch_buffer_slots:
+            self.collate = BufferedDictCollate(trim=self.trim_batches, num_slots=self.batch_buffer_slots)
+        else:
+            self.collate = dict_collate_trim_l5 if self.trim_batches else dict_collate
         self.target_lens = {
             "train": self.hparams.max_target_length,
             "val": self.hparams.val_max_target_length,
@@ -42,7 +51,10 @@ class L5DataModule(pl.LightningDataModule):
         self.eval_batch_size = self.hparams.eval_batch_size
         self.num_workers = self.hparams.num_workers
         self.img_conf = self.hparams.img_conf
-        
+        self.bucket_boundaries = getattr(self.hparams, "bucket_boundaries", None)
+        self.max_tokens_per_batch = getattr(self.hparams, "max_tokens_per_batch", None)
+        self.batch_samplers = {}
+
         self.im_dir = os.path.join(self.hparams.data_dir[0], self.hparams.im_dir[0])
 
     def setup(self, stage):
@@ -64,6 +76,7 @@ class L5DataModule(pl.LightningDataModule):
             additional_memmap_files=("lm_label_ids",) + additional_data_fields,
             img_conf=self.img_conf,
         )
+        dataset.copy_rows = not self.batch_buffer_slots
         self.rename_keys(dataset.data)
         self.resize_data(dataset.data, split)
         return dataset
@@ -92,6 +105,16 @@ class L5DataModule(pl.LightningDataModule):
         return mmap[:, :new_size]
 
     def train_dataloader(self):
+        if "train" in self.datasets and self.max_tokens_per_batch:
+            return self._get_token_budget_dataloader("train")
+        if "train" in self.datasets and self.bucket_boundaries:
+            return DataLoader(
+                self.datasets["train"],
+                batch_sampler=self._get_batch_sampler("train", self.train_batch_size),
+                collate_fn=self.collate,
+                num_workers=self.num_workers,
+                pin_memory=True,
+            )
         if "train" in self.datasets:
             sampler = self._get_sampler("train")
             shuffle = sampler is None
@@ -109,7 +132,7 @@ class L5DataModule(pl.LightningDataModule):
     def _get_sampler(self, split) -> Optional[Sampler]:
         # for some resaon PL is not replacing dataloader's samplers if train_dataloader
         # have custom sampler, for such cases each dataloader should be converted manually do ddp
-        if isinstance(self.datasets["train"], ConcatDataset):
+        if isinstance(self.datasets["train"], ConcatDataset) or self.uses_batch_samplers(self.hparams):
             dataset = self.datasets[split]
             if split == "train":
                 sampler = RandomSampler(dataset)
@@ -120,6 +143,79 @@ class L5DataModule(pl.LightningDataModule):
             return sampler
         return None
 
+    @staticmethod
+    def uses_batch_samplers(hparams) -> bool:
+        """Whether the dataloaders use length-bucketing batch samplers, which shard batches across ranks
+        themselves and must not be replaced by Lightning (`replace_sampler_ddp=False`)."""
+        return bool(getattr(hparams, "max_tokens_per_batch", None) or getattr(hparams, "bucket_boundaries", None))
+
+    def _replica_kwargs(self) -> Dict[str, Optional[int]]:
+        if self.trainer is None:
+            return {"num_replicas": None, "rank": None}
+        connector = getattr(self.trainer, "_accelerator_connector", None)
+        if self.trainer.world_size > 1 and getattr(connector, "replace_sampler_ddp", False):
+            raise ValueError(
+                "Bucketing batch samplers shard batches themselves, "
+                "run the Trainer with replace_sampler_ddp=False"
+            )
+        return {"num_replicas": self.trainer.world_size, "rank": self.trainer.global_rank}
+
+    def _get_batch_sampler(self, split, batch_size) -> Sampler:
+        # sharded by the sampler itself, a DistributedSamplerWrapper cannot be rebuilt by Lightning
+        return LengthBucketBatchSampler(
+            dataset_lengths(self.datasets[split]),
+            batch_size=batch_size,
+            bucket_boundaries=self.bucket_boundaries,
+            shuffle=split == "train",
+            seed=getattr(self.hparams, "seed", 0) or 0,
+            **self._replica_kwargs(),
+        )
+
+    def _get_token_budget_dataloader(self, split) -> DataLoader:
+        return DataLoader(
+            self.datasets[split],
+            batch_sampler=self._get_token_budget_sampler(split),
+            collate_fn=self.collate,
+            num_workers=self.num_workers,
+            pin_memory=True,
+        )
+
+    def _get_token_budget_sampler(self, split) -> Sampler:
+        if split not in self.batch_samplers:
+            dataset = self.datasets[split]
+            lengths = dataset_lengths(dataset)
+            # image patches are prepended to the encoder input
+            image_size = (self.img_conf or {}).get("size")
+            extra_tokens = (image_size // 16) ** 2 if image_size else 0
+            boundaries = self.bucket_boundaries or [2 ** i for i in range(5, int(lengths.max()).bit_length())]
+            self.batch_samplers[split] = TokenBudgetBatchSampler(
+                lengths,
+                # decoder inputs are trimmed to the labels length plus one, as in dict_collate_trim_l5
+                target_lengths=dataset_lengths(dataset, key="labels") + 1,
+                max_tokens=self.max_tokens_per_batch,
+                bucket_boundaries=boundaries,
+                shuffle=split == "train",
+                seed=getattr(self.hparams, "seed", 0) or 0,
+                extra_tokens=extra_tokens,
+                **self._replica_kwargs(),
+            )
+        # sharded by the sampler itself, its number of batches would not match a DistributedSamplerWrapper's
+        return self.batch_samplers[split]
+
+    def target_tokens_per_batch(self, split="train") -> Optional[float]:
+        """Average number of target tokens in a token-budget batch, None for fixed-size batches."""
+        if split not in self.batch_samplers:
+            return None
+        return self.batch_samplers[split].target_tokens_per_batch()
+
+    def sample_order(self, split) -> Optional[List[int]]:
+        """Dataset indices in the order the last token-budget iteration over the split returned them."""
+        batch_sampler = self.batch_samplers.get(split)
+        if batch_sampler is None or batch_sampler.order is None or batch_sampler.num_replicas > 1:
+            # every rank sees only its own shard of the split
+            return None
+        return batch_sampler.order.tolist()
+
     def _gpu_count(self):
         if isinstance(self.hparams.gpus, int):
             return self.hparams.gpus
@@ -131,6 +227,8 @@ class L5DataModule(pl.LightningDataModule):
 
     def val_dataloader(self):
         if "val" in self.datasets:
+            if self.max_tokens_per_batch:
+                return self._get_token_budget_dataloader("val")
             sampler = self._get_sampler("val")
             return DataLoader(
                 self.datasets["val"],
@@ -145,6 +243,8 @@ class L5DataModule(pl.LightningDataModule):
 
     def test_dataloader(self):
         if "test" in self.datasets:
+            if self.max_tokens_per_batch:
+                return self._get_token_budget_dataloader("test")
             sampler = self._get_sampler("test")
             return DataLoader(
                 self.datasets["test"],
@@ -228,6 +328,21 @@ class L5DataModule(pl.LightningDataModule):
             default=False,
             help="whether to trim batches to longest element in batch to save computing time",
         )
+        parser.add_argument(
+            "--bucket_boundaries",
+            nargs='+',
+            type=int,
+            default=None,
+            help="upper bounds of input length buckets, if set train batches are formed from samples of similar "
+            "length (use with --trim_batches)",
+        )
+        parser.add_argument(
+            "--batch_buffer_slots",
+            default=0,
+            type=int,
+            help="if set, batches are collated into that many reusable (pinned or shared memory) buffers per "
+            "shape bucket, directly from memmap rows; has to exceed the DataLoader prefetch factor plus one",
+        )
         parser.add_argument(
             "--img_conf",
             type=json.loads,
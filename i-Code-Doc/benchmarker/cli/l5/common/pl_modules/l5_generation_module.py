@@ -33,6 +33,8 @@ class L5GenerationModule(BaseLightningModule):
         self.config = load_config(
             model_path=Path(model_name_or_path), **vars(hparams)
         )
+        self.config.attention_implementation = getattr(hparams, "attention_implementation", "eager")
+        self.config.attention_chunk_size = getattr(hparams, "attention_chunk_size", None)
 
         if hparams.load_ckpt_weight is not None:
             ckpt = torch.load(hparams.load_ckpt_weight, map_location="cpu")
@@ -82,7 +84,7 @@ class L5GenerationModule(BaseLightningModule):
     def forward(self, input_ids, **kwargs):
         return self.model(input_ids, **kwargs)
 
-    def _step(self, batch: dict) -> Tuple:
+    def _step(self, batch: dict, reduction: str = "mean") -> Tuple:
         pad_token_id = self.tokenizer.pad_token_id
         src_ids, src_mask = batch["input_ids"], batch["attention_mask"]
         seg_data = batch["seg_data"]['tokens']['bboxes']
@@ -107,7 +109,7 @@ class L5GenerationModule(BaseLightningModule):
         lm_logits = outputs[0]
         if self.hparams.label_smoothing == 0:
             # Same behavior as modeling_bart.py, besides ignoring pad_token_id
-            ce_loss_fct = torch.nn.CrossEntropyLoss(ignore_index=pad_token_id)
+            ce_loss_fct = torch.nn.CrossEntropyLoss(ignore_index=pad_token_id, reduction=reduction)
 
             assert lm_logits.shape[-1] == self.vocab_size
             loss = ce_loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), tgt_ids.view(-1))
@@ -123,7 +125,12 @@ class L5GenerationModule(BaseLightningModule):
         return self.tokenizer.pad_token_id
 
     def training_step(self, batch, batch_idx) -> Dict:
-        loss_tensors = self._step(batch)
+        if self.hparams.max_tokens_per_batch:
+            # batches of varying size: sum the token losses and divide by a constant, so that every target
+            # token has the same weight whatever batch, and accumulation step, it lands in
+            loss_tensors = self._step(batch, reduction="sum") / self.target_tokens_per_batch
+        else:
+            loss_tensors = self._step(batch)
         logs = {'loss': loss_tensors.mean()}
         lrs = {f"lr_group_{i}": param["lr"] for i, param in enumerate(self.trainer.optimizers[0].param_groups)}
         logs.update(lrs)
@@ -158,6 +165,7 @@ class L5GenerationModule(BaseLightningModule):
             for out in outputs
             for v in zip(*out["generation_results"].values())
         ]
+        flat_generations = self.restore_sample_order(flat_generations, prefix)
         self.val_outs = {
             "generation_results": flat_generations,
         }
@@ -165,6 +173,20 @@ class L5GenerationModule(BaseLightningModule):
             "generation_results": flat_generations,
         }
 
+    def restore_sample_order(self, generations: List[Dict], prefix: str) -> List[Dict]:
+        """Put generations of length-sorted token-budget batches back into the dataset order."""
+        datamodule = getattr(self.trainer, "datamodule", None)
+        if not self.hparams.max_tokens_per_batch or datamodule is None:
+            return generations
+        order = datamodule.sample_order(prefix)
+        if order is None or len(order) != len(generations):
+            # sanity check runs and distributed evaluation see only a part of the split
+            return generations
+        restored = [None] * len(generations)
+        for generation, idx in zip(generations, order):
+            restored[idx] = generation
+        return restored
+
     def collect_predictions(self, data):
         predictions = []
         references = []
@@ -279,6 +301,18 @@ class L5GenerationModule(BaseLightningModule):
     def dataset_size(self):
         return len(self.train_dataloader().dataset)
 
+    @property
+    def target_tokens_per_batch(self) -> float:
+        return self.trainer.datamodule.target_tokens_per_batch("train")
+
+    def total_steps(self) -> int:
+        if self.hparams.max_steps or not self.hparams.max_tokens_per_batch:
+            return super().total_steps()
+        # the number of token-budget batches is known only from the sampler, it is already per device
+        # when the sampler is distributed
+        num_batches = len(self.train_dataloader())
+        return (num_batches / self.hparams.accumulate_grad_batches) * self.hparams.max_epochs
+
     @staticmethod
     def add_model_specific_args(parser, root_dir):
         BaseLightningModule.add_model_specific_args(parser, root_dir)
@@ -288,7 +322,13 @@ class L5GenerationModule(BaseLightningModule):
         parser.add_argument("--overwrite_output_dir", action="store_true", default=False)
         parser.add_argument("--load_ckpt_weight", type=str, default=None)
         parser.add_argument("--restore_training", action="store_true", default=False)
-        parser.add_argument("--max_tokens_per_batch", type=int, default=None)
+        parser.add_argument(
+            "--max_tokens_per_batch",
+            type=int,
+            default=None,
+            help="form batches of varying size holding at most this many padded input, target and image tokens "
+            "instead of using --train_batch_size/--eval_batch_size (use with --trim_batches)",
+        )
         parser.add_argument(
             "--logger_name", type=str, choices=["default", "wandb", "wandb_shared", "mlflow"], default="default"
         )
@@ -346,6 +386,17 @@ class L5GenerationModule(BaseLightningModule):
             default=None,
             help="Overwrite number of encoder layers in pretrained model",
         )
+        parser.add_argument(
+            "--attention_implementation",
+            type=str,
+            choices=["eager", "sdpa", "chunked"],
+            default="eager",
+            help="eager materializes attention probabilities, sdpa (scaled_dot_product_attention with the 2D "
+            "relative bias as attention mask) and chunked (queries in chunks, recomputed in backward) do not",
+        )
+        parser.add_argument(
+            "--attention_chunk_size", type=int, default=None, help="queries per chunk of chunked attention"
+        )
         parser.add_argument(
             "--gradient_checkpointing",
             action="store_true",
@@ -11,14 +11,29 @@ from typing import Callable, Dict, Iterable, List, Tuple, Union
 import pandas as pd
 from torch import nn
 
+from benchmarker.utils.memmap_writer import ShardedMemmapWriter
 from benchmarker.utils.pregenerated import PregeneratedCustomDataset
 
 csv.field_size_limit(sys.maxsize)
 logger = logging.getLogger(__name__)
 
 
-def save_t5_kleister_cache(path, tokenizer, features, max_seq_length, segment_levels=("tokens",)):
+def save_t5_kleister_cache(path, tokenizer, features, max_seq_length, segment_levels=("tokens",),
+                           rows_per_shard=0, processes=1):
+    if rows_per_shard > 0:
+        writer = ShardedMemmapWriter(
+            path,
+            rows_per_shard=rows_per_shard,
+            processes=processes,
+            tokenizer=tokenizer,
+            max_seq_length=max_seq_length,
+            additional_memmap_files=("lm_label_ids", "doc_id", "label_name"),
+            segment_levels=segment_levels,
+        )
+        writer.write(features)
+        return
     _ = PregeneratedCustomDataset(
+        im_dir=None,
         path=path,
         tokenizer=tokenizer,
         input_data=features,  # type: ignore
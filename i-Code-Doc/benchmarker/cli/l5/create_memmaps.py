@@ -1,15 +1,22 @@
 #!/usr/bin/env python
+import json
 import logging
+import shutil
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Iterator
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import fire
 
 from benchmarker.cli.l5.common.utils import save_t5_kleister_cache
 from benchmarker.data.model.feature import Feature
 from benchmarker.data.reader import Corpus, qa_strategies
+from benchmarker.data.reader.benchmark_dataset import BenchmarkDataset
 from benchmarker.data.slicer import LongPageStrategy
 from benchmarker.data.t5 import T5DownstreamDataConverter
+from benchmarker.utils.memmap_writer import ShardedMemmapWriter, shard_name
+from benchmarker.utils.page_images import create_page_image_memmap
+from benchmarker.utils.pregenerated import PregeneratedCustomDataset
 from benchmarker.utils.training import load_tokenizer
 
 logger = logging.getLogger(__name__)
@@ -25,6 +32,125 @@ def list_wrapper(features_iterator: Iterator[Feature], limit: int = -1):
         yield [feature]
 
 
+SHARD_DONE_MARKER = '.done'
+SPLIT_INPUT_FILES = ('document.jsonl', 'documents_content.jsonl')
+
+
+def build_pipeline(dataset_path_or_name: str, corpus_kwargs: Dict[str, Any], read_kwargs: Dict[str, Any],
+                   tokenizer_kwargs: Dict[str, Any], converter_kwargs: Dict[str, Any]):
+    corpus = Corpus(**corpus_kwargs)
+    corpus.read_benchmark_challenge(directory=Path(dataset_path_or_name), **read_kwargs)
+    tokenizer = load_tokenizer(**tokenizer_kwargs)
+    data_converter = T5DownstreamDataConverter(tokenizer, **converter_kwargs)
+    return corpus, tokenizer, data_converter
+
+
+def shard_ranges(num_documents: int, num_shards: int) -> List[Tuple[int, int]]:
+    """Contiguous [start, end) document ranges, shards follow the input order."""
+    per_shard = -(-num_documents // num_shards)
+    return [(start, min(start + per_shard, num_documents)) for start in range(0, num_documents, per_shard)]
+
+
+def input_signature(dataset_path_or_name: str, set_name: str) -> Dict[str, List[float]]:
+    """Size and modification time of the input files of a split, a change invalidates written shards."""
+    split_dir = Path(dataset_path_or_name) / set_name
+    signature = {}
+    for name in SPLIT_INPUT_FILES:
+        if (split_dir / name).is_file():
+            stat = (split_dir / name).stat()
+            signature[name] = [stat.st_size, stat.st_mtime]
+    return signature
+
+
+def read_shard_marker(marker: Path) -> Optional[Dict[str, Any]]:
+    """Content of a shard marker, None if missing or written by an older version (a bare row count)."""
+    if not marker.is_file():
+        return None
+    try:
+        content = json.loads(marker.read_text())
+    except ValueError:
+        return None
+    return content if isinstance(content, dict) else None
+
+
+def shard_is_done(marker: Path, expected: Dict[str, Any]) -> bool:
+    """Whether the marker records a shard written from the same document range, shard count and inputs."""
+    content = read_shard_marker(marker)
+    return content is not None and all(content.get(key) == value for key, value in expected.items())
+
+
+def generate_memmap_shard(
+        job: Tuple[str, int, Tuple[int, int], Path, Dict[str, Any], Dict[str, Any]]) -> Tuple[int, int]:
+    """
+    Read, convert and write the documents of one range end-to-end in the calling process.
+    A shard is complete once its marker file records the same document range, number of shards and input
+    files, so an interrupted run can be resumed; shards written for other ranges or inputs are rebuilt.
+    """
+    set_name, idx, doc_range, set_path, pipeline_kwargs, expected = job
+    shard_path = set_path / shard_name(idx)
+    marker = shard_path / SHARD_DONE_MARKER
+    if shard_is_done(marker, expected):
+        return idx, read_shard_marker(marker)['num_rows']
+    if shard_path.exists():
+        logger.info(f'{set_name}: rebuilding {shard_path.name}, it was written for other documents or inputs')
+        shutil.rmtree(shard_path)
+
+    read_kwargs = dict(pipeline_kwargs['read_kwargs'], doc_range=doc_range)
+    corpus, tokenizer, data_converter = build_pipeline(
+        pipeline_kwargs['dataset_path_or_name'], pipeline_kwargs['corpus_kwargs'], read_kwargs,
+        pipeline_kwargs['tokenizer_kwargs'], pipeline_kwargs['converter_kwargs'])
+    features = list(list_wrapper(data_converter.generate_features(getattr(corpus, set_name))))
+    if features:
+        _ = PregeneratedCustomDataset(
+            im_dir=None,
+            path=shard_path,
+            tokenizer=tokenizer,
+            input_data=features,
+            mode='w+',
+            max_seq_length=pipeline_kwargs['max_seq_length'],
+            additional_memmap_files=("lm_label_ids", "doc_id", "label_name"),
+            segment_levels=read_kwargs['segment_levels'],
+            verbose=False,
+            columnar=True,
+        )
+    shard_path.mkdir(exist_ok=True, parents=True)
+    marker.write_text(json.dumps(dict(expected, num_rows=len(features))))
+    return idx, len(features)
+
+
+def generate_sharded_memmaps(set_name: str, set_path: Path, num_shards: int, processes: int,
+                             pipeline_kwargs: Dict[str, Any], tokenizer) -> Dict[str, Any]:
+    """
+    Shard-parallel version of the serial pipeline for one split. Documents are split by index range,
+    every worker converts and writes its own shards and the manifest lists them in range order, so
+    rows come in the same order as in the serial run.
+    """
+    read_kwargs = pipeline_kwargs['read_kwargs']
+    num_documents = BenchmarkDataset(
+        Path(pipeline_kwargs['dataset_path_or_name']), set_name, read_kwargs['ocr']).num_documents()
+    ranges = shard_ranges(num_documents, num_shards)
+    signature = input_signature(pipeline_kwargs['dataset_path_or_name'], set_name)
+    jobs = [
+        (set_name, idx, doc_range, set_path, pipeline_kwargs,
+         {'doc_range': list(doc_range), 'num_shards': len(ranges), 'inputs': signature})
+        for idx, doc_range in enumerate(ranges)
+    ]
+    done = sum(shard_is_done(set_path / shard_name(idx) / SHARD_DONE_MARKER, job[-1]) for idx, job in enumerate(jobs))
+    if done:
+        logger.info(f'{set_name}: resuming, {done} of {len(jobs)} shards are already written')
+    # shards beyond the current count are left over from a run with more document shards
+    for stale in sorted(set_path.glob('shard_*')):
+        if stale.is_dir() and stale.name not in {shard_name(idx) for idx in range(len(jobs))}:
+            logger.info(f'{set_name}: removing {stale.name}, left over from a run with other --doc_shards')
+            shutil.rmtree(stale)
+
+    with Pool(processes) as pool:
+        sizes = dict(pool.imap_unordered(generate_memmap_shard, jobs))
+
+    writer = ShardedMemmapWriter(set_path, tokenizer=tokenizer, max_seq_length=pipeline_kwargs['max_seq_length'])
+    return writer.write_manifest([sizes[idx] for idx in range(len(jobs))])
+
+
 def generate_memmaps(
     dataset_path_or_name: str,
     model_path: str,
@@ -54,6 +180,10 @@ def generate_memmaps(
     processes=1,
     imap_chunksize=100,
     skip_text_tokens=False,
+    im_dir: str = '',
+    image_size: int = 224,
+    rows_per_shard: int = 0,
+    doc_shards: int = 0,
 ):
     r"""
     Generate memmaps for given dataset.
@@ -95,11 +225,17 @@ def generate_memmaps(
         processes: number of threads to use for preparing data
         imap_chunksize: chop the docs iterable into a number of chunks which will be submited to the process pool as separate tasks
         skip_text_tokens: whether to not use text tokens as an input. Useful for latter use of image tokens
+        im_dir: directory with `<doc_id>.pdf` files, if set first pages are rasterized once into page images memmap
+        image_size: side of the rasterized page images, should match `img_conf['size']` used in training
+        rows_per_shard: if positive, memmaps are written column-wise as shards of that many rows by `processes` writers
+        doc_shards: if positive, each split is cut into that many document ranges which are read, converted and written
+            end-to-end by `processes` workers; rerunning with the same arguments resumes from the finished shards.
+            Row order matches the serial run (except for random token augmentation), `limit` is not supported
 
     """
     model_path, memmap_path = Path(model_path), Path(memmap_path)
 
-    corpus = Corpus(
+    corpus_kwargs = dict(
         unescape_prefix=unescape_prefix,
         unescape_values=unescape_values,
         use_prefix=use_prefix,
@@ -115,31 +251,46 @@ def generate_memmaps(
         test_strategy=getattr(qa_strategies, test_strategy),
         augment_tokens_from_file=augment_tokens_from_file,
     )
-
-    corpus.read_benchmark_challenge(
-        directory=Path(dataset_path_or_name),
-        ocr=ocr_engine,
-        segment_levels=segment_levels,
-    )
-
-    tokenizer = load_tokenizer(model_path, model_type=model_type, convert_to_fast_tokenizer=use_fast_tokenizer)
-    data_converter = T5DownstreamDataConverter(
-        tokenizer,
+    read_kwargs = dict(ocr=ocr_engine, segment_levels=segment_levels)
+    tokenizer_kwargs = dict(model_path=model_path, model_type=model_type, convert_to_fast_tokenizer=use_fast_tokenizer)
+    converter_kwargs = dict(
         segment_levels=segment_levels,
         max_seq_length=max_encoder_length,
         long_page_strategy=LongPageStrategy(long_page_strategy),
         img_matrix_order=img_matrix_order,
-        processes=processes,
+        processes=processes if doc_shards <= 0 else 1,
         imap_chunksize=imap_chunksize,
         skip_text_tokens=skip_text_tokens,
     )
+    corpus, tokenizer, data_converter = build_pipeline(
+        dataset_path_or_name, corpus_kwargs, read_kwargs, tokenizer_kwargs, converter_kwargs)
+
+    if doc_shards > 0:
+        assert limit == -1, 'limit is not supported with doc_shards'
+        pipeline_kwargs = dict(
+            dataset_path_or_name=dataset_path_or_name,
+            corpus_kwargs=corpus_kwargs,
+            read_kwargs=read_kwargs,
+            tokenizer_kwargs=tokenizer_kwargs,
+            converter_kwargs=converter_kwargs,
+            max_seq_length=max_encoder_length,
+        )
+
     for set_name in ('train', 'dev', 'test'):
         subset = getattr(corpus, set_name)
         if not subset:
             continue
+        if doc_shards > 0:
+            generate_sharded_memmaps(set_name, memmap_path / set_name, doc_shards, processes, pipeline_kwargs, tokenizer)
+            if im_dir:
+                create_page_image_memmap(memmap_path / set_name, Path(im_dir), size=image_size, processes=processes)
+            continue
         train_features = data_converter.generate_features(subset)
         train_features = list_wrapper(train_features, limit)
-        save_t5_kleister_cache(memmap_path / set_name, tokenizer, train_features, max_encoder_length, segment_levels)
+        save_t5_kleister_cache(memmap_path / set_name, tokenizer, train_features, max_encoder_length, segment_levels,
+                               rows_per_shard=rows_per_shard, processes=processes)
+        if im_dir:
+            create_page_image_memmap(memmap_path / set_name, Path(im_dir), size=image_size, processes=processes)
 
 
 if __name__ == '__main__':
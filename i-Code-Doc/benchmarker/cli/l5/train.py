@@ -109,8 +109,10 @@ def get_generic_trainer(model: L5GenerationModule, datamodule: L5DataModule, arg
     else:
         resume_from_checkpoint = None
 
+    # bucketing batch samplers shard across ranks themselves and cannot be rebuilt by Lightning
+    replace_sampler_ddp = len(args.data_dir) == 1 and not L5DataModule.uses_batch_samplers(args)
     train_params = {'accumulate_grad_batches': args.accumulate_grad_batches,
-        'replace_sampler_ddp': len(args.data_dir) == 1, 'plugins': None}
+        'replace_sampler_ddp': replace_sampler_ddp, 'plugins': None}
 
     if args.num_nodes > 1:
         # See https://applica.atlassian.net/browse/AA-751
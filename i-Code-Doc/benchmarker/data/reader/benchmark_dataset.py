@@ -2,8 +2,9 @@ import json
 import logging
 import os
 from collections import defaultdict
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Iterator, List, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from benchmarker.data.reader.common import Dataset, Document
 from benchmarker.input_loader.common_format import CommonFormatLoader
@@ -29,18 +30,32 @@ def get_child_values(annotation_values: List[Dict]) -> List:
 class BenchmarkDataset(Dataset):
     """docstring for BenchmarkDataset"""
 
-    def __init__(self, directory: Path, split, ocr: str, segment_levels: tuple = ("tokens", "pages")):
+    def __init__(self, directory: Path, split, ocr: str, segment_levels: tuple = ("tokens", "pages"),
+                 doc_range: Optional[Tuple[int, int]] = None):
+        """
+        :param doc_range: optional [start, end) range of line indices of document.jsonl to read,
+            lines outside of it are skipped without being parsed
+        """
         super(BenchmarkDataset, self).__init__()
         self.directory = directory
         self.split = split
         self.ocr = ocr
         self.segment_levels = segment_levels
+        self.doc_range = doc_range
+
+    def num_documents(self) -> int:
+        """Number of lines of document.jsonl, regardless of doc_range."""
+        with open(self.directory / self.split / 'document.jsonl') as docs_file:
+            return sum(1 for _ in docs_file)
 
     def __iter__(self) -> Iterator[Document]:
         docs_jsonl_path = self.directory / self.split / 'document.jsonl'
         docs_content_jsonl_path = self.directory / self.split / 'documents_content.jsonl'
         with open(docs_jsonl_path) as docs_file, open(docs_content_jsonl_path) as docs_content_file:
-            for doc_line, doc_content in zip(docs_file, docs_content_file):
+            lines = zip(docs_file, docs_content_file)
+            if self.doc_range is not None:
+                lines = islice(lines, *self.doc_range)
+            for doc_line, doc_content in lines:
                 doc_dict = json.loads(doc_line)
                 identifier = f'{doc_dict["name"]}'
                 doc_content_dict = json.loads(doc_content)
@@ -0,0 +1,162 @@
+import json
+import logging
+from itertools import count, islice
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from benchmarker.data.model.feature import Feature
+
+logger = logging.getLogger(__name__)
+
+SHARDS_MANIFEST = 'shards.json'
+
+
+def shard_name(idx: int) -> str:
+    return f'shard_{idx:05d}'
+
+
+def iter_blocks(data: Iterable[List[Feature]], rows_per_shard: int) -> Iterator[Tuple[int, List[Feature]]]:
+    """
+    Flatten lists of features and group them into numbered blocks of at most rows_per_shard rows.
+    """
+    rows = (feature for features_list in data for feature in features_list)
+    for idx in count():
+        block = list(islice(rows, rows_per_shard))
+        if not block:
+            return
+        yield idx, block
+
+
+class ShardedColumn:
+    """
+    Read-only concatenation of per-shard arrays along the first axis.
+
+    Supports what datasets and datamodules do with memmaps: row indexing, slicing of the
+    trailing axes (`x[:, :n]`), `shape`, `dtype` and `flush`.
+    """
+
+    def __init__(self, parts: Sequence[np.ndarray]):
+        self.parts = list(parts)
+        self.offsets = np.cumsum([0] + [len(p) for p in self.parts])
+        self.shape = (int(self.offsets[-1]),) + tuple(self.parts[0].shape[1:])
+        self.dtype = self.parts[0].dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple) and item[0] == slice(None):
+            return ShardedColumn([p[item] for p in self.parts])
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError(f'index {item} is out of bounds for size {len(self)}')
+            shard = int(np.searchsorted(self.offsets, item, side='right')) - 1
+            return self.parts[shard][item - self.offsets[shard]]
+        raise TypeError(f'Unsupported index for sharded column: {item}')
+
+    def flush(self) -> None:
+        for p in self.parts:
+            if isinstance(p, np.memmap):
+                p.flush()
+
+
+def merge_shard_data(shard_data: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge nested dicts of per-shard memmaps into one nested dict of `ShardedColumn`.
+    """
+    merged: Dict[str, Any] = {}
+    for k, v in shard_data[0].items():
+        if isinstance(v, dict):
+            merged[k] = merge_shard_data([d[k] for d in shard_data])
+        elif v is None:
+            merged[k] = None
+        else:
+            merged[k] = ShardedColumn([d[k] for d in shard_data])
+    return merged
+
+
+_writer_args: Dict[str, Any] = {}
+
+
+def _init_writer(kwargs: Dict[str, Any]) -> None:
+    _writer_args.update(kwargs)
+
+
+def _write_shard_job(args: Tuple[int, List[Feature]]) -> Tuple[int, int]:
+    from benchmarker.utils.pregenerated import PregeneratedCustomDataset
+
+    idx, rows = args
+    _ = PregeneratedCustomDataset(
+        im_dir=None,
+        path=_writer_args['path'] / shard_name(idx),
+        input_data=[rows],
+        mode='w+',
+        columnar=True,
+        verbose=False,
+        **_writer_args['dataset_kwargs'],
+    )
+    return idx, len(rows)
+
+
+class ShardedMemmapWriter:
+    """
+    Writes features into fixed-size memmap shards, each shard is a complete memmap directory.
+
+    Rows are buffered into blocks of `rows_per_shard`, so the size of every shard is known before its
+    files are allocated and each feature is written column-wise for the whole block at once; files
+    are never resized nor cropped. Blocks are written by `processes` parallel writers and a
+    `shards.json` manifest lists the shards in input order.
+
+    The number of rows is not known in advance (every input item is a list of features, and the input
+    may be a generator), shard sizes are the exact block sizes and are reported once written.
+    """
+
+    def __init__(self, path: Path, rows_per_shard: int = 4096, processes: int = 1, verbose: bool = True,
+                 **dataset_kwargs: Any):
+        self.path = Path(path)
+        self.rows_per_shard = rows_per_shard
+        self.processes = processes
+        self.verbose = verbose
+        self.dataset_kwargs = dataset_kwargs
+
+    def write(self, data: Iterable[List[Feature]]) -> Dict[str, Any]:
+        self.path.mkdir(exist_ok=True, parents=True)
+        writer_args = {'path': self.path, 'dataset_kwargs': self.dataset_kwargs}
+        blocks = iter_blocks(data, self.rows_per_shard)
+        if self.processes > 1:
+            pool = Pool(self.processes, initializer=_init_writer, initargs=(writer_args,))
+            results = pool.imap_unordered(_write_shard_job, blocks)
+        else:
+            pool = None
+            _init_writer(writer_args)
+            results = map(_write_shard_job, blocks)
+        shard_sizes = {}
+        for idx, num_rows in tqdm(results, desc='Writing shards ', disable=not self.verbose):
+            shard_sizes[idx] = num_rows
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if self.verbose:
+            logging.info(f'Wrote {sum(shard_sizes.values())} rows into {len(shard_sizes)} shards')
+
+        return self.write_manifest([shard_sizes[i] for i in range(len(shard_sizes))])
+
+    def write_manifest(self, shard_sizes: List[int]) -> Dict[str, Any]:
+        tokenizer = self.dataset_kwargs.get('tokenizer')
+        manifest = {
+            'shards': [{'name': shard_name(i), 'num_samples': n} for i, n in enumerate(shard_sizes)],
+            'num_training_examples': int(sum(shard_sizes)),
+            'max_seq_len': self.dataset_kwargs.get('max_seq_length'),
+            'vocab_len': len(tokenizer) if tokenizer is not None else None,
+        }
+        (self.path / SHARDS_MANIFEST).write_text(json.dumps(manifest, indent=2))
+        # keeps the directory readable by tools which only look at metrics.json
+        metrics = {k: manifest[k] for k in ('num_training_examples', 'max_seq_len', 'vocab_len')}
+        (self.path / 'metrics.json').write_text(json.dumps(metrics))
+        return manifest
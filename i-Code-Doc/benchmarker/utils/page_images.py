@@ -0,0 +1,153 @@
+import json
+import logging
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+PAGE_IMAGES_MANIFEST = 'page_images.json'
+PAGE_IMAGES_FILE = 'page_images.memmap'
+PAGE_IMAGE_INDEX_FILE = 'page_image_index.memmap'
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def rasterize_page(pdf_path: Path, size: int) -> np.ndarray:
+    """
+    Rasterize the first page of a PDF and resize it the same way `img_trans_torchvision` does.
+    Returns (size, size, 3) uint8 array.
+    """
+    from pdf2image import convert_from_path
+
+    im = convert_from_path(str(pdf_path), first_page=1, last_page=1)[0]
+    im = im.convert('RGB').resize((size, size), Image.BILINEAR)
+    return np.asarray(im, dtype=np.uint8)
+
+
+def _rasterize_job(args: Tuple[int, str, int]) -> Tuple[int, Optional[np.ndarray], Optional[str]]:
+    idx, pdf_path, size = args
+    try:
+        return idx, rasterize_page(Path(pdf_path), size), None
+    except Exception as e:
+        return idx, None, f'{type(e).__name__}: {e}'
+
+
+def create_page_image_memmap(
+    memmap_path: Path,
+    im_dir: Path,
+    size: int = 224,
+    processes: int = 1,
+    chunksize: int = 16,
+    verbose: bool = True,
+) -> Dict[str, Any]:
+    """
+    Rasterize the page image of every document of a memmap directory once.
+
+    Images are stored per distinct doc_id in a fixed-shape uint8 memmap, and an index memmap aligned
+    with the token memmaps maps each row to its image. Documents which could not be rasterized get a
+    white page and are listed in the manifest together with the error.
+
+    Args:
+        memmap_path: directory written by `PregeneratedCustomDataset` (must contain doc_id memmap)
+        im_dir: directory with `<doc_id>.pdf` files
+        size: side of the square image, same as `img_conf['size']`
+        processes: number of rasterizing processes
+        chunksize: documents submitted to a process at once
+        verbose: whether to show progress bar
+
+    Returns:
+        manifest dictionary, also saved to `page_images.json`
+    """
+    from benchmarker.utils.pregenerated import PregeneratedCustomDataset
+
+    memmap_path, im_dir = Path(memmap_path), Path(im_dir)
+    dataset = PregeneratedCustomDataset.load_from_memmap(
+        memmap_path, im_dir=im_dir, segment_levels=('tokens',), additional_memmap_files=('doc_id',), verbose=False)
+    num_samples = len(dataset)
+    doc_ids = np.array([dataset.data['doc_id'][i] for i in range(num_samples)])
+
+    # distinct documents in order of first appearance
+    unique_docs, first_idx, row_to_image = np.unique(doc_ids, return_index=True, return_inverse=True)
+    order = np.argsort(first_idx)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    unique_docs = unique_docs[order]
+    row_to_image = rank[row_to_image]
+
+    images = np.memmap(memmap_path / PAGE_IMAGES_FILE, dtype=np.uint8, mode='w+',
+                       shape=(len(unique_docs), size, size, 3))
+    index = np.memmap(memmap_path / PAGE_IMAGE_INDEX_FILE, dtype=np.int32, mode='w+', shape=(num_samples,))
+    index[:] = row_to_image
+
+    jobs = [(i, str(im_dir / f'{doc_id}.pdf'), size) for i, doc_id in enumerate(unique_docs)]
+    failures = {}
+    if processes > 1:
+        pool = Pool(processes)
+        results = pool.imap_unordered(_rasterize_job, jobs, chunksize=chunksize)
+    else:
+        pool = None
+        results = map(_rasterize_job, jobs)
+    for idx, img, error in tqdm(results, total=len(jobs), desc='Rasterizing ', disable=not verbose):
+        if error is not None:
+            images[idx] = 255
+            failures[str(unique_docs[idx])] = error
+        else:
+            images[idx] = img
+    if pool is not None:
+        pool.close()
+        pool.join()
+    images.flush()
+    index.flush()
+
+    manifest = {
+        'size': size,
+        'channels': 3,
+        'num_images': len(unique_docs),
+        'num_samples': num_samples,
+        'failures': failures,
+    }
+    (memmap_path / PAGE_IMAGES_MANIFEST).write_text(json.dumps(manifest, indent=2))
+    if failures:
+        logger.warning(f'{len(failures)} of {len(unique_docs)} documents could not be rasterized, '
+                       f'see {memmap_path / PAGE_IMAGES_MANIFEST}')
+    return manifest
+
+
+def load_page_image_memmap(memmap_path: Path) -> Optional[Dict[str, Any]]:
+    """
+    Open page images written by `create_page_image_memmap`, returns None if there are none.
+    Memmaps are opened copy-on-write so that slices can be wrapped by torch without copying.
+    """
+    manifest_file = Path(memmap_path) / PAGE_IMAGES_MANIFEST
+    if not manifest_file.is_file():
+        return None
+    manifest = json.loads(manifest_file.read_text())
+    size, channels = manifest['size'], manifest['channels']
+    return {
+        'manifest': manifest,
+        'images': np.memmap(Path(memmap_path) / PAGE_IMAGES_FILE, dtype=np.uint8, mode='c',
+                            shape=(manifest['num_images'], size, size, channels)),
+        'index': np.memmap(Path(memmap_path) / PAGE_IMAGE_INDEX_FILE, dtype=np.int32, mode='c',
+                           shape=(manifest['num_samples'],)),
+    }
+
+
+def normalize_page_images(images: torch.Tensor, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Batched equivalent of `img_trans_torchvision` normalization for uint8 (..., H, W, C) images.
+    Returns float (..., C, H, W) tensor, written into `out` if given.
+    """
+    mean = images.new_tensor(IMAGENET_MEAN, dtype=torch.float).view(-1, 1, 1)
+    std = images.new_tensor(IMAGENET_STD, dtype=torch.float).view(-1, 1, 1)
+    if out is None:
+        images = images.movedim(-1, -3).float().div_(255.)
+    else:
+        images = out.copy_(images.movedim(-1, -3)).div_(255.)
+    return images.sub_(mean).div_(std)
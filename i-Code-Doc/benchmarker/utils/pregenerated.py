@@ -14,6 +14,8 @@ from pdf2image import convert_from_path
 from benchmarker.data.data_converter import FEAT_META
 from benchmarker.data.model.feature import Feature
 from benchmarker.data.utils import IMG_SIZE_DIVISIBILITY, apply_on_nested_dict
+from benchmarker.utils.memmap_writer import SHARDS_MANIFEST, merge_shard_data
+from benchmarker.utils.page_images import load_page_image_memmap
 
 from core.common.utils import img_trans_torchvision
 # noinspection PyArgumentList
@@ -38,6 +40,9 @@ class PregeneratedDatasetBase(Dataset):
         self.num_samples: int = 0
         self.seq_len = None
         self.vocab_size = None
+        self.page_images: Optional[Dict[str, Any]] = None
+        # rows are returned as memmap views when disabled, for collate functions copying them into batch buffers
+        self.copy_rows = True
 
     @staticmethod
     def validate_img_conf(img_conf):
@@ -73,6 +78,20 @@ class PregeneratedDatasetBase(Dataset):
             raise e
         return mmap
 
+    def _load_page_images(self) -> None:
+        """
+        Use page images pre-rasterized by `create_page_image_memmap` if they are present.
+        """
+        self.page_images = load_page_image_memmap(self.memfile_path)
+        if self.page_images is None:
+            return
+        manifest = self.page_images['manifest']
+        assert manifest['num_samples'] == self.num_samples, \
+            f'Page images were created for {manifest["num_samples"]} samples, memmaps have {self.num_samples}'
+        if self.img_conf is not None and self.img_conf.get('size', manifest['size']) != manifest['size']:
+            logging.warning(f'Page images were rasterized at {manifest["size"]}px, '
+                            f'img_conf requires {self.img_conf["size"]}px')
+
     def _create_segments(self, lvl: str):
         if lvl == 'tokens':
             return
@@ -136,6 +155,16 @@ class PregeneratedDatasetBase(Dataset):
             else:
                 v[i] = features[k]
 
+    def fill_columns(self, rows: Sequence[Feature], data: Dict[str, Any]) -> None:
+        """
+        Write every feature for all rows at once, rows have to fit into preallocated memmaps
+        """
+        for k, v in data.items():
+            if isinstance(v, dict):
+                self.fill_columns([row[k] for row in rows], v)
+            else:
+                v[:len(rows)] = np.stack([np.asarray(row[k]) for row in rows])
+
     def check_for_resize(self, i: int) -> None:
         if i + 1 > self.num_samples:
             self.resize_memmaps(self.num_samples + max(self.num_samples // 5, 1000))
@@ -204,12 +233,15 @@ class PregeneratedDatasetBase(Dataset):
         return self.num_samples
 
     def __getitem__(self, item: int) -> Dict[str, Any]:
-        try:
-            # noinspection PyUnusedLocal
-            def convert(x, unused):
-                y = x[item]
-                return np.array(y) if isinstance(y, np.memmap) else y
+        # noinspection PyUnusedLocal
+        def convert(x, unused):
+            y = x[item]
+            return np.array(y) if self.copy_rows and isinstance(y, np.memmap) else y
 
+        if self.page_images is not None:
+            item_dict = apply_on_nested_dict(convert, self.data)
+            return self.add_page_image(item_dict, item)
+        try:
             item_dict = apply_on_nested_dict(convert, self.data)
             item_dict = self.add_images(item_dict, os.path.join(self.im_dir, item_dict['doc_id']+'.pdf'))
             return item_dict
@@ -227,6 +259,16 @@ class PregeneratedDatasetBase(Dataset):
         item_dict['seg_data']['lazyimages']['img_lst'] = img_lst
         return item_dict
 
+    def add_page_image(self, item_dict, item):
+        """
+        Add pre-rasterized uint8 (H, W, C) page image to sample, a view of the page images memmap.
+        It is normalized batch-wise by the collate function.
+        """
+        img = self.page_images['images'][self.page_images['index'][item]]
+        item_dict['seg_data']['lazyimages'] = {}
+        item_dict['seg_data']['lazyimages']['img_lst'] = np.asarray(img)
+        return item_dict
+
     def _get_images(self, impath: Optional[Path], item_dict: Dict[str, Any]) -> List[np.ndarray]:
         imgs = []
         width, height, channels = self.img_conf['width'], self.img_conf['max_height'], self.img_conf['channels']
@@ -350,6 +392,7 @@ class PregeneratedCustomDataset(PregeneratedDatasetBase):
         additional_memmap_files = ('token_label_ids',),
         verbose = True,
         img_conf = None,
+        columnar = False,
     ):
         super().__init__(im_dir, path, data_epoch, mode, segment_levels, verbose, img_conf)
         self.tokenizer = tokenizer
@@ -359,7 +402,11 @@ class PregeneratedCustomDataset(PregeneratedDatasetBase):
             assert self.tokenizer is not None
             self.vocab_size = len(tokenizer)
             self.seq_len = max_seq_length
-            if hasattr(input_data, '__len__'):
+            if columnar:
+                # all rows are known up front, memmaps are allocated with the exact size
+                input_data = [features for features_list in input_data for features in features_list]
+                self.num_samples = len(input_data)
+            elif hasattr(input_data, '__len__'):
                 self.num_samples = len(input_data)
             else:
                 # if input_data is generator and it is not known what will be size of it
@@ -370,17 +417,47 @@ class PregeneratedCustomDataset(PregeneratedDatasetBase):
             self.num_samples = metrics['num_training_examples']
             self.seq_len = metrics['max_seq_len']
 
-        self._create_memmap()
-        for keymap in additional_memmap_files:
-            self.data[keymap] = self.get_memmap(keymap, keymap)
+        if self.mode == 'r' and (self.memfile_path / SHARDS_MANIFEST).is_file():
+            self._load_shards(additional_memmap_files)
+        else:
+            self._create_memmap()
+            for keymap in additional_memmap_files:
+                self.data[keymap] = self.get_memmap(keymap, keymap)
+        if self.mode == 'r':
+            self._load_page_images()
 
         if self.mode == 'w+':
-            self.fill_memmap(input_data)
+            if columnar:
+                self.fill_columns(input_data, self.data)
+                self.flush_memmaps()
+            else:
+                self.fill_memmap(input_data)
             self.save_metrics()
 
         if self.verbose:
             logging.info('Loading complete!')
 
+    def _load_shards(self, additional_memmap_files) -> None:
+        """
+        Present shards written by `ShardedMemmapWriter` as a single dataset
+        """
+        manifest = json.loads((self.memfile_path / SHARDS_MANIFEST).read_text())
+        shards = [
+            PregeneratedCustomDataset(
+                self.im_dir,
+                self.memfile_path / shard['name'],
+                mode='r',
+                segment_levels=self.segment_levels,
+                additional_memmap_files=additional_memmap_files,
+                verbose=False,
+                img_conf=self.img_conf,
+            )
+            for shard in manifest['shards'] if shard['num_samples'] > 0
+        ]
+        assert shards, f'All shards of {self.memfile_path} are empty'
+        self.data = merge_shard_data([shard.data for shard in shards])
+        assert sum(len(shard) for shard in shards) == self.num_samples
+
     def fill_memmap(self, data: Sequence[Dict[str, Any]]) -> None:
         span_count = 0
         for features_list in tqdm(data, desc='Pregenerating ', disable=not self.verbose):
@@ -6,7 +6,7 @@ from argparse import Namespace
 from datetime import date
 from math import ceil
 from pathlib import Path
-from typing import Any, Dict, Optional, Sequence, Tuple, Union, cast
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple, Union, cast
 
 import numpy as np
 import torch
@@ -17,7 +17,9 @@ from transformers.tokenization_utils_fast import PreTrainedTokenizerFast
 from benchmarker.config.benchmarker_config import BaseBenchmarkerConfig
 from benchmarker.data.model.feature import Feature
 from benchmarker.data.utils import FEAT_META, IMG_SIZE_DIVISIBILITY
+from benchmarker.utils.page_images import normalize_page_images
 from benchmarker import MODEL_CLASSES
+from core.common.batch_buffers import BatchBufferPool
 
 
 def calculate_dataset_size(pregenerated_data_path: Path) -> list:
@@ -252,7 +254,10 @@ def dict_collate(batch: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
     if isinstance(batch[0], dict):
         dict_batch = {}
         for k in batch[0].keys():
-            if k == "img_lst":
+            if k == "img_lst" and isinstance(batch[0][k], np.ndarray):
+                # pre-rasterized uint8 pages, normalized in prepare_batch_dict
+                dict_batch[k] = default_collate([el[k] for el in batch])
+            elif k == "img_lst":
                 # assuming 3 channels, temporary and only for DALLE
                 dict_batch[k] = merge_images_into_tensor([el[k].permute(2,0,1) for el in batch], 
                                                          IMG_SIZE_DIVISIBILITY)
@@ -266,7 +271,8 @@ def dict_collate(batch: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
 
 
 def merge_images_into_tensor(
-        tensors: list, size_divisibility: int = 64, pad_value: float = 255.
+        tensors: list, size_divisibility: int = 64, pad_value: float = 255.,
+        allocate: Optional[Callable[[Sequence[int], torch.dtype], torch.Tensor]] = None,
     ) -> "torch.Tensor":
     """
     Copied from detectron2
@@ -278,6 +284,7 @@ def merge_images_into_tensor(
             the common height and width is divisible by `size_divisibility`.
             This depends on the model and many models need a divisibility of 32.
         pad_value (float): value to pad
+        allocate: optional `(shape, dtype) -> tensor` returning the (possibly reused) output buffer
 
     Returns:
         an `ImageList`.
@@ -299,7 +306,10 @@ def merge_images_into_tensor(
 
     # max_size can be a tensor in tracing mode, therefore convert to list
     batch_shape = [len(tensors)] + list(tensors[0].shape[:-2]) + list(max_size)
-    batched_imgs = tensors[0].new_full(batch_shape, pad_value)
+    if allocate is not None:
+        batched_imgs = allocate(batch_shape, tensors[0].dtype).fill_(pad_value)
+    else:
+        batched_imgs = tensors[0].new_full(batch_shape, pad_value)
     for img, pad_img in zip(tensors, batched_imgs):
         pad_img[..., : img.shape[-2], : img.shape[-1]].copy_(img)
 
@@ -310,6 +320,8 @@ def prepare_batch_dict(batch: Dict[str, Any], device: Union[str, torch.device, N
     for skey, seg in batch.items():
         if isinstance(seg, dict):
             batch[skey] = prepare_batch_dict(seg, device)
+        elif skey == "img_lst" and isinstance(seg, torch.Tensor) and seg.dtype == torch.uint8:
+            batch[skey] = normalize_page_images(seg.to(device=device))
         elif isinstance(seg, torch.Tensor):
             batch[skey] = seg.to(dtype=FEAT_META[skey]['train_dtype'], device=device)
     return batch
@@ -347,15 +359,92 @@ def dict_collate_trim_l5(batch: Sequence[Dict[str, Any]],
         return cast(Dict[str, Any], default_collate(batch))
 
 
+TRIMMED_TO_INPUT = ("attention_mask", "bboxes", "input_ids", "ranges", "masks", "token_map")
+
+
+class BufferedDictCollate:
+    """
+    Drop-in replacement for `dict_collate` (trim=False) and `dict_collate_trim_l5` (trim=True) which
+    writes batches into reusable buffers of a `BatchBufferPool`.
+
+    Every field is copied once, directly from the per-sample rows (memmap views when the dataset has
+    `copy_rows` disabled) into a buffer of its training dtype, trimmed rows are cut before the copy.
+    Returned tensors are reused after `num_slots` batches, so batches must not be kept longer than that.
+    """
+
+    def __init__(self, trim: bool = True, divisibility: int = 32, num_slots: int = 4,
+                 pin_memory: Optional[bool] = None):
+        self.trim = trim
+        self.divisibility = divisibility
+        self.buffers = BatchBufferPool(num_slots=num_slots, pin_memory=pin_memory)
+
+    def __call__(self, batch: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+        input_len = target_len = None
+        if self.trim:
+            input_len = self._round(max([np.count_nonzero(s["attention_mask"]) for s in batch]))
+            target_len = self._round(max([np.count_nonzero(s["labels"]) for s in batch]) + 1)
+        return self._collate(batch, (), input_len, target_len)
+
+    def _round(self, length: int) -> int:
+        return int((length + (self.divisibility - 1)) // self.divisibility * self.divisibility)
+
+    def _collate(self, batch: Sequence[Any], path: Tuple[str, ...], input_len: Optional[int],
+                 target_len: Optional[int]) -> Any:
+        elem = batch[0]
+        if isinstance(elem, dict):
+            return {k: self._collate([el[k] for el in batch], path + (k,), input_len, target_len) for k in elem}
+        if elem is None:
+            return None
+        key = path[-1]
+        if key == "img_lst":
+            return self._collate_images(batch, path)
+        if not isinstance(elem, np.ndarray) or "train_dtype" not in FEAT_META.get(key, {}):
+            collated = default_collate(batch)
+            if isinstance(collated, torch.Tensor) and "train_dtype" in FEAT_META.get(key, {}):
+                collated = collated.to(dtype=FEAT_META[key]["train_dtype"])
+            return collated
+
+        length = None
+        if key in TRIMMED_TO_INPUT:
+            length = input_len
+        elif key == "labels":
+            length = target_len
+        shape = elem.shape
+        if length is not None and elem.ndim:
+            shape = (min(shape[0], length),) + shape[1:]
+        out = self.buffers.get(path, (len(batch),) + shape, FEAT_META[key]["train_dtype"])
+        out_np = out.numpy()
+        for i, row in enumerate(batch):
+            out_np[i] = row[:shape[0]] if elem.ndim else row
+        return out
+
+    def _collate_images(self, batch: Sequence[Any], path: Tuple[str, ...]) -> torch.Tensor:
+        if isinstance(batch[0], np.ndarray):
+            # pre-rasterized uint8 pages
+            images = self.buffers.get(path, (len(batch),) + batch[0].shape, torch.uint8)
+            images_np = images.numpy()
+            for i, img in enumerate(batch):
+                images_np[i] = img
+            out_shape = images.shape[:-3] + (images.shape[-1],) + images.shape[-3:-1]
+            return normalize_page_images(images, out=self.buffers.get(path + ("normalized",), out_shape, torch.float))
+        return merge_images_into_tensor(
+            [el.permute(2, 0, 1) for el in batch],
+            IMG_SIZE_DIVISIBILITY,
+            allocate=lambda shape, dtype: self.buffers.get(path, shape, FEAT_META["img_lst"]["train_dtype"]),
+        )
+
+
 def prepare_batch_dict_trim_l5(batch: Dict[str, Any], device: Union[str, torch.device, None] = None,
                                input_len=None, target_len=None) -> Dict[str, Any]:
     assert input_len is not None and target_len is not None
     for skey, seg in batch.items():
         if isinstance(seg, dict):
             batch[skey] = prepare_batch_dict_trim_l5(seg, device, input_len, target_len)
+        elif skey == "img_lst" and isinstance(seg, torch.Tensor) and seg.dtype == torch.uint8:
+            batch[skey] = normalize_page_images(seg.to(device=device))
         elif isinstance(seg, torch.Tensor):
             batch[skey] = seg.to(dtype=FEAT_META[skey]['train_dtype'], device=device)
-            if skey in ("attention_mask", "bboxes", "input_ids", "ranges", "masks", "token_map"):
+            if skey in TRIMMED_TO_INPUT:
                 batch[skey] = batch[skey][:, :input_len].contiguous()
             elif skey == "labels":
                 batch[skey] = batch[skey][:, :target_len].contiguous()
@@ -0,0 +1,61 @@
+import math
+from collections import OrderedDict
+from typing import Hashable, Optional, Sequence
+
+import torch
+from torch.utils.data import get_worker_info
+
+
+class BatchBufferPool:
+    """
+    Reusable host buffers collate functions write batches into.
+
+    Buffers are kept per (name, dtype, bucket), where the bucket is the element count rounded up to a
+    power of two, and a request returns a contiguous view of the requested shape at the start of a
+    bucket buffer. Each bucket holds a ring of `num_slots` buffers handed out in turn, so a batch stays
+    valid until `num_slots` further batches of the same bucket were collated; it has to be larger than
+    the number of batches in flight (DataLoader `prefetch_factor` plus the one being consumed).
+
+    In DataLoader workers buffers live in shared memory, so returning a batch to the main process does
+    not copy it. In the main process they are pinned, so the host to device copy can be asynchronous.
+    """
+
+    def __init__(self, num_slots: int = 4, pin_memory: Optional[bool] = None, max_buckets: int = 32):
+        self.num_slots = num_slots
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.max_buckets = max_buckets
+        self._rings: "OrderedDict[Hashable, list]" = OrderedDict()
+
+    def __getstate__(self):
+        # a pool copied into a worker process starts empty
+        state = self.__dict__.copy()
+        state['_rings'] = OrderedDict()
+        return state
+
+    def _allocate(self, numel: int, dtype: torch.dtype) -> torch.Tensor:
+        buffer = torch.empty(numel, dtype=dtype)
+        if get_worker_info() is not None:
+            buffer.share_memory_()
+        elif self.pin_memory:
+            buffer = buffer.pin_memory()
+        return buffer
+
+    def get(self, name: Hashable, shape: Sequence[int], dtype: torch.dtype) -> torch.Tensor:
+        """
+        Uninitialized contiguous tensor of the given shape backed by a reusable buffer.
+        """
+        numel = math.prod(shape)
+        capacity = 1 << max(numel - 1, 0).bit_length()
+        key = (name, dtype, capacity)
+        ring = self._rings.get(key)
+        if ring is None:
+            ring = self._rings[key] = [[], 0]
+            if len(self._rings) > self.max_buckets:
+                self._rings.popitem(last=False)
+        else:
+            self._rings.move_to_end(key)
+        buffers, slot = ring
+        if slot == len(buffers):
+            buffers.append(self._allocate(capacity, dtype))
+        ring[1] = (slot + 1) % self.num_slots
+        return buffers[slot][:numel].view(tuple(shape))
@@ -0,0 +1,169 @@
+import math
+from typing import Optional
+
+import torch
+from torch import Tensor
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+from transformers.models.t5.modeling_t5 import T5Attention
+
+ATTENTION_IMPLEMENTATIONS = ("eager", "sdpa", "chunked")
+
+
+def _attend(query: Tensor, key: Tensor, value: Tensor, bias: Tensor, dropout_p: float) -> Tensor:
+    scores = torch.matmul(query, key.transpose(3, 2)) + bias
+    attn_weights = F.softmax(scores.float(), dim=-1).type_as(scores)
+    attn_weights = F.dropout(attn_weights, p=dropout_p, training=dropout_p > 0)
+    return torch.matmul(attn_weights, value)
+
+
+def biased_attention(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    bias: Tensor,
+    dropout_p: float = 0.0,
+    implementation: str = "sdpa",
+    chunk_size: int = 256,
+) -> Tensor:
+    """
+    softmax(query key^T + bias) value without materializing the attention probabilities of the whole
+    sequence. As in T5, scores are not scaled by 1/sqrt(head_dim).
+
+    :param query: [batch_size x num_heads x query_len x head_dim]
+    :param key: [batch_size x num_heads x key_len x head_dim]
+    :param value: [batch_size x num_heads x key_len x head_dim]
+    :param bias: additive bias broadcastable to [batch_size x num_heads x query_len x key_len], holding
+        relative position bias and attention mask
+    :param implementation: "sdpa" uses `scaled_dot_product_attention` where available (falls back to
+        "chunked"), "chunked" computes `chunk_size` queries at a time, recomputing them in backward
+    """
+    if implementation == "sdpa" and hasattr(F, "scaled_dot_product_attention"):
+        # undo the 1/sqrt(head_dim) scaling applied by sdpa
+        query = query * math.sqrt(query.size(-1))
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=bias.to(query.dtype), dropout_p=dropout_p)
+
+    outputs = []
+    for start in range(0, query.size(2), chunk_size):
+        query_chunk = query[:, :, start:start + chunk_size]
+        bias_chunk = bias[:, :, start:start + chunk_size] if bias.size(2) > 1 else bias
+        if torch.is_grad_enabled() and (query.requires_grad or key.requires_grad or bias.requires_grad):
+            outputs.append(checkpoint(_attend, query_chunk, key, value, bias_chunk, dropout_p))
+        else:
+            outputs.append(_attend(query_chunk, key, value, bias_chunk, dropout_p))
+    return torch.cat(outputs, dim=2)
+
+
+class T5BiasedAttention(T5Attention):
+    """
+    T5Attention computing attention with `biased_attention`. Falls back to the original implementation
+    when attention probabilities are requested, or with head masks and pruned heads.
+    """
+
+    attention_implementation = "sdpa"
+    attention_chunk_size = 256
+
+    def forward(
+        self,
+        hidden_states,
+        mask=None,
+        key_value_states=None,
+        position_bias=None,
+        past_key_value=None,
+        layer_head_mask=None,
+        query_length=None,
+        use_cache=False,
+        output_attentions=False,
+    ):
+        if output_attentions or layer_head_mask is not None or self.pruned_heads:
+            return super().forward(
+                hidden_states,
+                mask=mask,
+                key_value_states=key_value_states,
+                position_bias=position_bias,
+                past_key_value=past_key_value,
+                layer_head_mask=layer_head_mask,
+                query_length=query_length,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+            )
+
+        # projections and position bias as in T5Attention.forward
+        batch_size, seq_length = hidden_states.shape[:2]
+        real_seq_length = seq_length
+        if past_key_value is not None:
+            real_seq_length += past_key_value[0].shape[2] if query_length is None else query_length
+        key_length = real_seq_length if key_value_states is None else key_value_states.shape[1]
+
+        def shape(states):
+            return states.view(batch_size, -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
+
+        def project(hidden_states, proj_layer, key_value_states, past_key_value):
+            if key_value_states is None:
+                hidden_states = shape(proj_layer(hidden_states))
+            elif past_key_value is None:
+                hidden_states = shape(proj_layer(key_value_states))
+            if past_key_value is not None:
+                if key_value_states is None:
+                    hidden_states = torch.cat([past_key_value, hidden_states], dim=2)
+                elif past_key_value.shape[2] != key_value_states.shape[1]:
+                    hidden_states = shape(proj_layer(key_value_states))
+                else:
+                    hidden_states = past_key_value
+            return hidden_states
+
+        query_states = shape(self.q(hidden_states))
+        key_states = project(
+            hidden_states, self.k, key_value_states, past_key_value[0] if past_key_value is not None else None
+        )
+        value_states = project(
+            hidden_states, self.v, key_value_states, past_key_value[1] if past_key_value is not None else None
+        )
+
+        if position_bias is None:
+            if not self.has_relative_attention_bias:
+                position_bias = torch.zeros(
+                    (1, self.n_heads, real_seq_length, key_length), device=query_states.device, dtype=query_states.dtype
+                )
+                if self.gradient_checkpointing and self.training:
+                    position_bias.requires_grad = True
+            else:
+                position_bias = self.compute_bias(real_seq_length, key_length, device=query_states.device)
+            if past_key_value is not None:
+                position_bias = position_bias[:, :, -hidden_states.size(1):, :]
+            if mask is not None:
+                position_bias = position_bias + mask
+
+        attn_output = biased_attention(
+            query_states,
+            key_states,
+            value_states,
+            position_bias,
+            dropout_p=self.dropout if self.training else 0.0,
+            implementation=self.attention_implementation,
+            chunk_size=self.attention_chunk_size,
+        )
+        attn_output = attn_output.transpose(1, 2).contiguous().view(batch_size, -1, self.inner_dim)
+        attn_output = self.o(attn_output)
+
+        present_key_value_state = (key_states, value_states) if (self.is_decoder and use_cache) else None
+        return (attn_output,) + (present_key_value_state,) + (position_bias,)
+
+
+def set_attention_implementation(module: nn.Module, implementation: str = "eager",
+                                 chunk_size: Optional[int] = None) -> None:
+    """
+    Switch all T5 attention layers of the module to the given implementation, weights are kept.
+    """
+    assert implementation in ATTENTION_IMPLEMENTATIONS, f"Unknown attention implementation {implementation}"
+    for layer in module.modules():
+        if not isinstance(layer, T5Attention):
+            continue
+        if implementation == "eager":
+            layer.__class__ = T5Attention
+            continue
+        layer.__class__ = T5BiasedAttention
+        layer.attention_implementation = implementation
+        if chunk_size is not None:
+            layer.attention_chunk_size = chunk_size
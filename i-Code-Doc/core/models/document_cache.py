@@ -0,0 +1,49 @@
+import hashlib
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import torch
+from torch import Tensor
+
+
+def document_hash(*tensors: Tensor) -> str:
+    """
+    Content hash of the given tensors, used as a document key when the caller does not provide one.
+    """
+    digest = hashlib.sha1()
+    for t in tensors:
+        t = t.detach().cpu().contiguous()
+        if t.dtype == torch.bfloat16:
+            t = t.float()
+        digest.update(str((tuple(t.shape), t.dtype)).encode())
+        digest.update(t.numpy().tobytes())
+    return digest.hexdigest()
+
+
+class DocumentCache:
+    """
+    Least recently used cache of per-document tensors, keeps at most `max_size` documents.
+    Cached values depend on model weights, so the cache has to be cleared when they change.
+    """
+
+    def __init__(self, max_size: int = 16):
+        self.max_size = max_size
+        self._items: "OrderedDict[Hashable, Tensor]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Tensor]:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Tensor) -> None:
+        self._items[key] = value.detach()
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
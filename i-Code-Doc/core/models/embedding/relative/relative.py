@@ -84,9 +84,7 @@ class RelativePositionBiasBase(nn.Module, ABC):
 
         return relative_position.to(torch.long)
 
-    def forward(self, attention_mask: Optional[Tensor] = None,
-                seg_data: Optional[Dict[str, Any]] = None) -> Tensor:
-
+    def expand_prefix_bias(self) -> None:
         # re-using pretrained model with subsequent addition of prefix_bucket
         if self.expand and self.prefix_bucket:
             new_bias = nn.Embedding(self.relative_attention_num_buckets + 2, self.num_heads)
@@ -94,25 +92,42 @@ class RelativePositionBiasBase(nn.Module, ABC):
             new_bias.weight.data[self.relative_attention_num_buckets:] = 0.1
             self.relative_attention_bias = new_bias
             self.expand = False
- 
-        rp_bucket = self.get_bucket(attention_mask, seg_data)
 
+    def add_prefix_bucket(self, rp_bucket: Tensor, seg_data: Tensor) -> Tensor:
+        """
+        Put pairs of prefix and non-prefix tokens into the two extra buckets, for all rows at once.
+        Prefix tokens are the leading ones, based on assumption that prefix bboxes are negative.
+        :return: [batch_size x seq_len x seq_len] buckets, `rp_bucket` is broadcast over the batch
+        """
+        num_prefix = (seg_data[:, :, 1] < 0).sum(-1)[:, None, None]
+        positions = torch.arange(rp_bucket.size(-1), device=rp_bucket.device)
+        query_in_prefix = positions[None, :, None] < num_prefix
+        key_in_prefix = positions[None, None, :] < num_prefix
+        rp_bucket = torch.where(query_in_prefix & ~key_in_prefix,
+                                rp_bucket.new_tensor(self.relative_attention_num_buckets), rp_bucket)
+        rp_bucket = torch.where(~query_in_prefix & key_in_prefix,
+                                rp_bucket.new_tensor(self.relative_attention_num_buckets + 1), rp_bucket)
+        return rp_bucket
+
+    def get_values(self, attention_mask: Optional[Tensor] = None,
+                   seg_data: Optional[Dict[str, Any]] = None) -> Tensor:
+        """
+        Bias values in [batch_size x seq_len x seq_len x num_heads] layout, batch_size may be 1
+        when the bias does not depend on the batch.
+        """
+        self.expand_prefix_bias()
+        rp_bucket = self.get_bucket(attention_mask, seg_data)
         if self.prefix_bucket:
-            if rp_bucket.size(0) == 1 and attention_mask.size(0) > 1:
-                rp_bucket = rp_bucket.repeat(attention_mask.size(0), 1, 1)
-            # based on assumption that prefix bboxes are negative
-            is_prefix = seg_data[:, :, 1] < 0
-            num_prefix = is_prefix.sum(-1)
-            for idx, num_prefix_row in enumerate(num_prefix.cpu().numpy()):
-                rp_bucket[idx, :num_prefix_row, num_prefix_row:] = self.relative_attention_num_buckets
-                rp_bucket[idx, num_prefix_row:, :num_prefix_row] = self.relative_attention_num_buckets + 1
+            rp_bucket = self.add_prefix_bucket(rp_bucket, seg_data)
 
         values: Tensor = self.relative_attention_bias(rp_bucket)
         assert values.dim() == 4, "Wrong dimension of values tensor"
-        values = values.permute([0, 3, 1, 2])
-
         return values
 
+    def forward(self, attention_mask: Optional[Tensor] = None,
+                seg_data: Optional[Dict[str, Any]] = None) -> Tensor:
+        return self.get_values(attention_mask, seg_data).permute([0, 3, 1, 2])
+
 
 class RelativePositionBias1D(RelativePositionBiasBase):
     def __init__(self, scaling_factor=1, max_distance=128, **kwargs):
@@ -121,6 +136,17 @@ class RelativePositionBias1D(RelativePositionBiasBase):
         their distance in the sequence. Parameters are the same as in base class
         """
         super().__init__(scaling_factor=scaling_factor, max_distance=max_distance, **kwargs)
+        self._bucket_cache = None
+
+    def get_bucket(self, attention_mask: Optional[Tensor] = None,
+                   seg_data: Optional[Dict[str, Any]] = None) -> Tensor:
+        # distances in the sequence depend only on its length, unless randomly augmented
+        if self.augmentation and self.training:
+            return super().get_bucket(attention_mask, seg_data)
+        key = (attention_mask.size(1), attention_mask.device)
+        if self._bucket_cache is None or self._bucket_cache[0] != key:
+            self._bucket_cache = (key, super().get_bucket(attention_mask, seg_data))
+        return self._bucket_cache[1]
 
     def prepare_input(self, attention_mask: Optional[Tensor] = None,
                       seg_data: Optional[Dict[str, Any]] = None) -> Tensor:
@@ -207,8 +233,15 @@ class RelativePositionBiasAggregated(nn.Module):
     ) -> Union[float, Tensor]:
         x = 0.0
         for bias in self.biases:  # type: ignore
-            x = bias(attention_mask, seg_data) + x
+            values = bias.get_values(attention_mask, seg_data)
+            # accumulate in place once the sum has the full shape, 1d bias is not batched
+            if isinstance(x, Tensor) and x.shape == torch.broadcast_shapes(x.shape, values.shape):
+                x += values
+            else:
+                x = values + x
 
+        if isinstance(x, Tensor):
+            x = x.permute([0, 3, 1, 2])
         return x
 
 
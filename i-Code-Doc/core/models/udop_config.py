@@ -17,6 +17,8 @@ class UdopConfig(T5Config):
                  relative_bias_args: Optional[Sequence[Dict[str, Any]]] = [{"type":"1d"},{"type":"horizontal"},{"type":"vertical"}],
                  truncate_decoder_after_layer: Optional[int] = None,
                  truncate_encoder_after_layer: Optional[int] = None,
+                 attention_implementation: str = "eager",
+                 attention_chunk_size: Optional[int] = None,
                  **kwargs):
         super().__init__(**kwargs)
         
@@ -30,3 +32,6 @@ class UdopConfig(T5Config):
         
         self.truncate_decoder_after_layer = truncate_decoder_after_layer
         self.truncate_encoder_after_layer = truncate_encoder_after_layer
+        # "eager", "sdpa" or "chunked", see core.models.biased_attention
+        self.attention_implementation = attention_implementation
+        self.attention_chunk_size = attention_chunk_size
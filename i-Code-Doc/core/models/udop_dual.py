@@ -11,6 +11,7 @@ from transformers import T5Config, T5PreTrainedModel
 from transformers.modeling_outputs import BaseModelOutput
 from transformers.models.t5.modeling_t5 import T5Block, T5ForConditionalGeneration, T5LayerNorm
 
+from core.models.biased_attention import set_attention_implementation
 from core.models.embedding.cell_embed import CellEmbeddings
 from core.models.embedding.relative.relative import (
     RelativePositionBias1D,
@@ -89,7 +90,6 @@ class T52dStack(T5PreTrainedModel):
 
         self.embed_tokens = embed_tokens
         self.is_decoder = config.is_decoder
-        setattr(config, 'output_attentions', True)
         if self.is_decoder:
             self.num_layers = (
                 config.truncate_decoder_after_layer if config.truncate_decoder_after_layer else config.num_layers
@@ -111,6 +111,11 @@ class T52dStack(T5PreTrainedModel):
             self.cell2dembedding = CellEmbeddings(config.max_2d_position_embeddings, config.hidden_size)
 
         self.init_weights()
+        set_attention_implementation(
+            self,
+            getattr(config, "attention_implementation", "eager"),
+            getattr(config, "attention_chunk_size", None),
+        )
 
         if not self.is_decoder:
             self.vision_encoder = mae_model(config.mae_version, config.mae_checkpoint, config.image_size, config.vocab_size, config.max_2d_position_embeddings)
@@ -150,7 +155,8 @@ class T52dStack(T5PreTrainedModel):
         token_type_ids = None,
     ):
         use_cache = use_cache if use_cache is not None else self.config.use_cache
-        output_attentions = True #False #True #output_attentions if output_attentions is not None else self.config.output_attentions
+        # attention probabilities are materialized only on request, see config.attention_implementation
+        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
@@ -268,7 +274,7 @@ class T52dStack(T5PreTrainedModel):
             #import pdb; pdb.set_trace()
 
             if output_attentions:
-                all_attentions = all_attentions + (layer_outputs[2],)  # We keep only self-attention weights for now
+                all_attentions = all_attentions + (layer_outputs[3],)  # We keep only self-attention weights for now
                 if self.is_decoder:
                     all_cross_attentions = all_cross_attentions + (layer_outputs[5],)
 
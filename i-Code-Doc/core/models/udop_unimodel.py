@@ -1,6 +1,7 @@
 import logging
+import math
 import os
-from typing import Any, Dict, Optional, Sequence, Tuple
+from typing import Any, Dict, Hashable, Optional, Sequence, Tuple
 from dataclasses import dataclass
 
 import torch
@@ -11,6 +12,9 @@ from transformers import T5Config, T5PreTrainedModel
 from transformers.modeling_outputs import BaseModelOutput
 from transformers.models.t5.modeling_t5 import T5Block, T5ForConditionalGeneration, T5LayerNorm
 
+from core.common.utils import get_visual_bbox
+from core.models.biased_attention import set_attention_implementation
+from core.models.document_cache import DocumentCache, document_hash
 from core.models.embedding.cell_embed import CellEmbeddings
 from core.models.embedding.relative.relative import (
     RelativePositionBias1D,
@@ -22,59 +26,57 @@ from core.models.mae.build import mae_model
 
 logger = logging.getLogger(__name__)
 
-def pad_sequence(seq, target_len, pad_value=0):
-    if isinstance(seq, torch.Tensor):
-        n = seq.shape[0]
-    else:
-        n = len(seq)
-        seq = torch.tensor(seq)
-    m = target_len - n
-    if m > 0:
-        ret = torch.stack([pad_value] * m).to(seq)
-        seq = torch.cat([seq, ret], dim=0)
-    return seq[:target_len]
-
+# bbox value of prompt tokens, as written by the data converter (`prefix_bbox_fill_value`)
+PREFIX_BBOX_FILL_VALUE = -0.01
 
 def collate_vlembed(inputs_patches, inputs_embeds, seg_data, visual_segdata, vis_special_token=None, attention_mask=None, num_patches=14, max_len=0):
-    
+    """
+    Fuse image patches with the text sequence, for the whole batch at once.
+
+    Every text token gets the embedding of the patch under its bbox center added (except special and
+    padding tokens, with bbox of all 0 or all 1). Patches not covered by any token are appended after
+    the text in their original order, padded with zeros to `max_len` patches in total
+    (number of patches when 0), together with their bboxes and attention mask.
+    """
     L = num_patches
+    batch_size, total_patches, dim = inputs_patches.shape
     ocr_points_x = torch.clip(torch.floor((seg_data[:, :, 0]+seg_data[:, :, 2])/2.0 * L).long(), 0, L-1)
     ocr_points_y = torch.clip(torch.floor((seg_data[:, :, 1]+seg_data[:, :, 3])/2.0 * L).long(), 0, L-1) * L
     ocr_points = ocr_points_x + ocr_points_y
     target_seg = (seg_data.mean(-1) == 0.0) | (seg_data.mean(-1) == 1.0)
-    repeated_vision_embeds = torch.gather(inputs_patches, 1, ocr_points.unsqueeze(-1).repeat(1, 1, inputs_patches.size(-1)))
-    repeated_vision_embeds[target_seg] = 0.0
+    repeated_vision_embeds = torch.gather(inputs_patches, 1, ocr_points.unsqueeze(-1).expand(-1, -1, dim))
+    repeated_vision_embeds = repeated_vision_embeds.masked_fill(target_seg.unsqueeze(-1), 0.0)
     inputs_embeds += repeated_vision_embeds
-    
-    
-    patch_inds = torch.full_like(inputs_patches[:, :, 0], True).bool()
-    ind = torch.cat([torch.arange(len(ocr_points))[:, None].repeat(1, ocr_points.size(-1))[:, :, None].to(ocr_points), ocr_points[:, :, None]], -1).flatten(0,1)
-    rows, cols = zip(*ind)
-    patch_inds[rows, cols] = False
-    
-    
-    input_vision_patches = [inputs_patches[i][patch_inds[i]] for i in range(len(patch_inds))]
-    visual_segdata = [visual_segdata[i][patch_inds[i]] for i in range(len(patch_inds))]
-    if attention_mask is not None:
-        visual_attention_mask = [torch.tensor([1] * len(item)).to(attention_mask) for item in visual_segdata]
-        
+
+    # patches under no token (padding tokens included) are kept
+    patch_inds = torch.ones(batch_size, total_patches, dtype=torch.bool, device=inputs_patches.device)
+    patch_inds.scatter_(1, ocr_points, False)
+
+    # move kept patches to the front preserving their order, keys are unique so the sort is stable
+    positions = torch.arange(total_patches, device=inputs_patches.device)
+    order = torch.argsort((~patch_inds).long() * total_patches + positions, dim=1)
     if max_len == 0:
-        max_len = inputs_patches.size(1)
+        max_len = total_patches
     else:
-        max_len = max_len - inputs_embeds.size(1)    
-    inputs_vision_patches = torch.stack([pad_sequence(item, max_len, torch.zeros_like(inputs_patches[0, 0])) for item in input_vision_patches])
-    visual_segdata = torch.stack([pad_sequence(item, max_len, torch.zeros_like(seg_data[0, 0])) for item in visual_segdata])
-    if attention_mask is not None:
-        visual_attention_mask = torch.stack([pad_sequence(item, max_len, torch.zeros_like(attention_mask[0, 0])) for item in visual_attention_mask])
-        
+        max_len = max_len - inputs_embeds.size(1)
+    if max_len <= total_patches:
+        order = order[:, :max_len]
+    else:
+        order = torch.cat([order, order.new_zeros(batch_size, max_len - total_patches)], 1)
+    valid = torch.arange(max_len, device=inputs_patches.device)[None, :] < patch_inds.sum(1, keepdim=True)
+
+    inputs_vision_patches = torch.gather(inputs_patches, 1, order.unsqueeze(-1).expand(-1, -1, dim))
+    inputs_vision_patches = inputs_vision_patches.masked_fill(~valid.unsqueeze(-1), 0.0)
+    visual_segdata = torch.gather(visual_segdata, 1, order.unsqueeze(-1).expand(-1, -1, visual_segdata.size(-1)))
+    visual_segdata = visual_segdata.masked_fill(~valid.unsqueeze(-1), 0)
+
     if vis_special_token is not None:
         inputs_vision_patches += vis_special_token
-    
-    
+
     inputs_embeds = torch.cat([inputs_embeds, inputs_vision_patches], 1)
     seg_data = torch.cat([seg_data, visual_segdata], 1)
     if attention_mask is not None:
-        attention_mask = torch.cat([attention_mask, visual_attention_mask], 1)
+        attention_mask = torch.cat([attention_mask, valid.to(attention_mask)], 1)
     return inputs_embeds, seg_data, attention_mask
 
 
@@ -187,8 +189,7 @@ class T52dStack(T5PreTrainedModel):
         self.embed_tokens = embed_tokens
         self.is_decoder = config.is_decoder
         self._max_length = config.max_length
-        
-        setattr(config, 'output_attentions', True)
+
         if self.is_decoder:
             self.num_layers = (
                 config.truncate_decoder_after_layer if config.truncate_decoder_after_layer else config.num_layers
@@ -221,6 +222,11 @@ class T52dStack(T5PreTrainedModel):
                 )
                 
         self.init_weights()
+        set_attention_implementation(
+            self,
+            getattr(config, "attention_implementation", "eager"),
+            getattr(config, "attention_chunk_size", None),
+        )
         
 
     @staticmethod
@@ -261,11 +267,14 @@ class T52dStack(T5PreTrainedModel):
     ):
         
         use_cache = use_cache if use_cache is not None else self.config.use_cache
-        output_attentions = True #False #True #output_attentions if output_attentions is not None else self.config.output_attentions
+        # attention probabilities are materialized only on request, see config.attention_implementation
+        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        # as in UdopDualForConditionalGeneration the relative bias can be computed by the caller
+        position_bias_given = position_bias is not None
                       
             
             
@@ -351,9 +360,11 @@ class T52dStack(T5PreTrainedModel):
         if self.is_decoder:  # modified lines
             position_bias = None
         else:
-            position_bias = self.relative_bias(
-                    attention_mask=attention_mask, seg_data=seg_data
-                )
+            # computed once per forward, the first layer passes it on to all others
+            if not position_bias_given:
+                position_bias = self.relative_bias(
+                        attention_mask=attention_mask, seg_data=seg_data
+                    )
             position_bias = position_bias + extended_attention_mask
         encoder_decoder_position_bias = None
 
@@ -400,7 +411,7 @@ class T52dStack(T5PreTrainedModel):
                 present_key_value_states = present_key_value_states + (present_key_value_state,)
 
             if output_attentions:
-                all_attentions = all_attentions + (layer_outputs[2],)  # We keep only self-attention weights for now
+                all_attentions = all_attentions + (layer_outputs[3],)  # We keep only self-attention weights for now
                 if self.is_decoder:
                     all_cross_attentions = all_cross_attentions + (layer_outputs[5],)
 
@@ -464,6 +475,9 @@ class UdopUnimodelForConditionalGeneration(T5ForConditionalGeneration):
         self.embed_dim = mae_model_tmp.embed_dim
         self.pos_embed = mae_model_tmp.pos_embed
         self.special_vis_token = mae_model_tmp.special_vis_token
+
+        # patch embeddings of recently seen document images, see answer_questions
+        self.document_cache = DocumentCache(getattr(config, "document_cache_size", 16))
         
 
     @staticmethod
@@ -523,6 +537,7 @@ class UdopUnimodelForConditionalGeneration(T5ForConditionalGeneration):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         input_dict: Dict[str, Any] = None,
+        inputs_patches: Optional[Tensor] = None,
         **kwargs,
     ) -> Tuple[Tensor, ...]:
         
@@ -533,8 +548,10 @@ class UdopUnimodelForConditionalGeneration(T5ForConditionalGeneration):
             return return_task_outputs
 
         if encoder_outputs is None:
-            inputs_patches=None
-            if image is not None:
+            if inputs_patches is not None:
+                # precomputed patch embeddings of a cached document
+                num_patches = int(round(math.sqrt(inputs_patches.size(1))))
+            elif image is not None:
                 assert visual_seg_data is not None
                 x = self.patch_embed(image)
                 num_patches = image.size(2) // 16
@@ -598,6 +615,97 @@ class UdopUnimodelForConditionalGeneration(T5ForConditionalGeneration):
     
     def get_encoder(self):
         return self
+
+    def train(self, mode: bool = True):
+        # cached patch embeddings are stale once weights are updated
+        if getattr(self, "document_cache", None) is not None:
+            self.document_cache.clear()
+        return super().train(mode)
+
+    def embed_document_image(self, image: Tensor, doc_key: Optional[Hashable] = None) -> Tensor:
+        """
+        Patch embeddings of a single page image, cached per document.
+        :param image: [1 x C x H x W] page image
+        :param doc_key: document key, content hash of the image by default
+        :return: [1 x num_patches x d_model] patch embeddings
+        """
+        if doc_key is None:
+            doc_key = document_hash(image)
+        patches = self.document_cache.get(doc_key)
+        if patches is None:
+            patches = self.patch_embed(image)
+            self.document_cache.put(doc_key, patches)
+        return patches
+
+    @torch.no_grad()
+    def answer_questions(
+        self,
+        input_ids: Tensor,
+        seg_data: Tensor,
+        image: Tensor,
+        questions: Sequence[Tensor],
+        question_seg_data: Optional[Sequence[Tensor]] = None,
+        visual_seg_data: Optional[Tensor] = None,
+        doc_key: Optional[Hashable] = None,
+        max_input_length: Optional[int] = None,
+        **generate_kwargs,
+    ) -> Tensor:
+        """
+        Generate answers to many questions about one document, as a single batch.
+
+        The image patch embeddings are computed once per document and kept in `document_cache`, and all
+        questions share one encoder and one generation pass. Encoder states of the document tokens are
+        not reused between questions: the encoder is bidirectional, so they depend on the prompt.
+
+        :param input_ids: [doc_len] token ids of the document, without the prompt
+        :param seg_data: [doc_len x 4] bboxes of the document tokens
+        :param image: [C x H x W] or [1 x C x H x W] page image
+        :param questions: token ids of every prompt, put in front of the document tokens
+        :param question_seg_data: [prompt_len x 4] bboxes of every prompt, filled with
+            PREFIX_BBOX_FILL_VALUE by default
+        :param visual_seg_data: [num_patches x 4] bboxes of the patches, image grid by default
+        :param doc_key: document key of the cache, content hash of the image by default
+        :param max_input_length: truncate prompt and document to that many tokens
+        :param generate_kwargs: passed to `generate`
+        :return: generated ids, one row per question
+        """
+        device = self.device
+        if image.dim() == 3:
+            image = image[None]
+        image = image.to(device)
+        num_questions = len(questions)
+        questions = [torch.as_tensor(q, dtype=torch.long) for q in questions]
+        if question_seg_data is None:
+            question_seg_data = [torch.full((len(q), 4), PREFIX_BBOX_FILL_VALUE) for q in questions]
+        input_ids = torch.as_tensor(input_ids, dtype=torch.long).cpu()
+        seg_data = torch.as_tensor(seg_data).cpu()
+
+        rows = [torch.cat([q, input_ids])[:max_input_length] for q in questions]
+        row_bboxes = [torch.cat([torch.as_tensor(b).to(seg_data), seg_data])[:max_input_length]
+                      for b in question_seg_data]
+        seq_len = max(len(r) for r in rows)
+        batch_ids = torch.full((num_questions, seq_len), self.config.pad_token_id, dtype=torch.long)
+        batch_bboxes = torch.zeros((num_questions, seq_len, 4), dtype=torch.float)
+        attention_mask = torch.zeros((num_questions, seq_len), dtype=torch.long)
+        for i, (ids, bboxes) in enumerate(zip(rows, row_bboxes)):
+            batch_ids[i, :len(ids)] = ids
+            batch_bboxes[i, :len(ids)] = bboxes
+            attention_mask[i, :len(ids)] = 1
+
+        patches = self.embed_document_image(image, doc_key)
+        if visual_seg_data is None:
+            visual_seg_data = get_visual_bbox(image.size(-1))
+        visual_seg_data = torch.as_tensor(visual_seg_data).to(device=device, dtype=patches.dtype)
+
+        return self.generate(
+            input_ids=batch_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            seg_data=batch_bboxes.to(device=device, dtype=patches.dtype),
+            visual_seg_data=visual_seg_data[None].expand(num_questions, -1, -1),
+            inputs_patches=patches.expand(num_questions, -1, -1),
+            use_cache=True,
+            **generate_kwargs,
+        )
     
     
  
@@ -1,5 +1,5 @@
 import random
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Union
 
 import torch
@@ -7,6 +7,8 @@ from transformers.tokenization_utils import PreTrainedTokenizer
 from transformers.tokenization_utils_base import PaddingStrategy
 from transformers.tokenization_utils_fast import PreTrainedTokenizerFast
 
+from core.common.batch_buffers import BatchBufferPool
+
 
 def pad_sequence_native(seq, target_len, pad_value=0, dtype=torch.int):
     if isinstance(seq, torch.Tensor):
@@ -20,6 +22,26 @@ def pad_sequence_native(seq, target_len, pad_value=0, dtype=torch.int):
     return ret
 
 
+def pad_stack(seqs, target_len, pad_value=0, dtype=torch.int, allocate=None):
+    """
+    Batched pad_sequence_native: pads or cuts every sequence to target_len and
+    stacks them, writing straight into allocate(shape, dtype) when given.
+    """
+    seqs = [s if isinstance(s, torch.Tensor) else torch.tensor(s, dtype=dtype) for s in seqs]
+    trailing = next((s.shape[1:] for s in seqs if s.shape[0] > 0), seqs[0].shape[1:])
+    shape = (len(seqs), target_len) + tuple(trailing)
+    if allocate is not None:
+        out = allocate(shape, seqs[0].dtype)
+    else:
+        out = torch.empty(shape, dtype=seqs[0].dtype)
+    pad = torch.as_tensor(pad_value, dtype=out.dtype)
+    for i, s in enumerate(seqs):
+        n = min(s.shape[0], target_len)
+        out[i, :n] = s[:n]
+        out[i, n:] = pad
+    return out
+
+
 def random_masking(L=4096, mask_ratio=0.75):
     """
     Perform per-sample random masking by per-sample shuffling.
@@ -55,6 +77,18 @@ class DataCollator:
     max_length_decoder: Optional[int] = 512    
     max_length_char: Optional[int] = 1024+512   
     pad_to_multiple_of: Optional[int] = None
+    # reuse batch buffers, a batch is overwritten after that many batches (0 disables)
+    buffer_slots: int = 0
+    buffers: Optional[BatchBufferPool] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.buffer_slots:
+            self.buffers = BatchBufferPool(num_slots=self.buffer_slots)
+
+    def _allocator(self, key):
+        if self.buffers is None:
+            return None
+        return lambda shape, dtype: self.buffers.get(key, shape, dtype)
 
     def __call__(self, features: List[Dict[str, Union[List[int], torch.Tensor]]]):# -> Dict[str, torch.Tensor]:
         if features[0] is None:
@@ -84,22 +118,29 @@ class DataCollator:
             elif key in special_labels:
                 continue
 
-            if key in ['decoder_input_ids', 'labels', 'decoder_attention_mask', 'decoder_seg_data']:
-                batched_feature = torch.stack([pad_sequence_native(f[key], target_len_decoder, pad_value) for f in features], dim=0)
-            elif key == "visual_seg_data":
-                batched_feature = torch.stack([f[key] for f in features], dim=0)    
-            elif key in ['char_ids', 'char_seg_data']:
-                batched_feature = torch.stack([pad_sequence_native(f[key], target_len_char, pad_value) for f in features], dim=0)
+            if key == "visual_seg_data":
+                batched_feature = torch.stack([f[key] for f in features], dim=0)
             else:
-                batched_feature = torch.stack([pad_sequence_native(f[key], target_len, pad_value) for f in features], dim=0)
+                if key in ['decoder_input_ids', 'labels', 'decoder_attention_mask', 'decoder_seg_data']:
+                    key_len = target_len_decoder
+                elif key in ['char_ids', 'char_seg_data']:
+                    key_len = target_len_char
+                else:
+                    key_len = target_len
+                batched_feature = pad_stack(
+                    [f[key] for f in features], key_len, pad_value, allocate=self._allocator(key))
             batch[key] = batched_feature
 
         if "position_ids" not in batch:
-            position_ids = torch.stack([torch.arange(target_len, dtype=torch.long) for _ in range(batch_size)])
+            position_ids = torch.arange(target_len, dtype=torch.long).repeat(batch_size, 1)
             batch["position_ids"] = position_ids
         
         if 'image' in features[0]:
-            image_list = torch.stack([d['image'] for d in features])
+            images = [d['image'] for d in features]
+            out = None
+            if self.buffers is not None:
+                out = self.buffers.get('image', (batch_size,) + tuple(images[0].shape), images[0].dtype)
+            image_list = torch.stack(images, out=out)
             batch.update({'image': image_list})
             
             for k in ['image_mask_label']:
@@ -125,6 +125,14 @@ class DataTrainingArguments:
             'than this will be truncated, sequences shorter will be padded.'
         },
     )    
+    collate_buffer_slots: int = field(
+        default=0,
+        metadata={
+            'help':
+            'If set, batches are collated into that many reusable shared or pinned memory buffers per shape. '
+            'Has to exceed the dataloader prefetch factor plus one.'
+        },
+    )
 
 
 @dataclass
@@ -276,6 +284,7 @@ def main():
         padding=padding,
         max_length=data_args.max_seq_length,
         max_length_decoder=data_args.max_seq_length_decoder,
+        buffer_slots=data_args.collate_buffer_slots,
     )
     metric = load_metric("accuracy")
 
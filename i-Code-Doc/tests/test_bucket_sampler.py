@@ -0,0 +1,97 @@
+from argparse import Namespace
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from torch.utils.data import Dataset
+
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("catalyst")
+
+from benchmarker.cli.l5.common.data.datamodule import L5DataModule  # noqa: E402
+
+WORLD_SIZE = 2
+
+
+class LengthsDataset(Dataset):
+    """Stands in for a pregenerated dataset, items are their own indices."""
+
+    def __init__(self, num_samples, seed=0, seq_len=256, target_len=32):
+        rng = np.random.RandomState(seed)
+        lengths = rng.randint(1, seq_len + 1, num_samples)
+        target_lengths = rng.randint(1, target_len + 1, num_samples)
+        self.data = {
+            "attention_mask": (np.arange(seq_len)[None] < lengths[:, None]).astype(np.int8),
+            "labels": (np.arange(target_len)[None] < target_lengths[:, None]).astype(np.int64),
+        }
+
+    def __len__(self):
+        return len(self.data["attention_mask"])
+
+    def __getitem__(self, idx):
+        return idx
+
+
+def make_hparams(**kwargs):
+    hparams = dict(
+        segment_levels=["tokens"], additional_data_fields=[], max_source_length=256, trim_batches=True,
+        max_target_length=32, val_max_target_length=32, test_max_target_length=32, data_dir=["data"],
+        train_data_dir=["train"], val_data_dir=["val"], test_data_dir=["test"], datasets_weights=None,
+        train_batch_size=8, eval_batch_size=8, num_workers=0, img_conf=None, im_dir=["images"],
+        gpus=WORLD_SIZE, seed=0, bucket_boundaries=None, max_tokens_per_batch=None,
+    )
+    hparams.update(kwargs)
+    return Namespace(**hparams)
+
+
+def make_datamodule(rank, replace_sampler_ddp=False, **kwargs):
+    datamodule = L5DataModule(make_hparams(**kwargs))
+    datamodule.datasets = {"train": LengthsDataset(203), "val": LengthsDataset(57, seed=1)}
+    datamodule.collate = list
+    datamodule.trainer = SimpleNamespace(
+        world_size=WORLD_SIZE,
+        global_rank=rank,
+        _accelerator_connector=SimpleNamespace(replace_sampler_ddp=replace_sampler_ddp),
+    )
+    return datamodule
+
+
+def check_sharded(loaders, num_samples):
+    lengths = {len(loader) for loader in loaders}
+    assert len(lengths) == 1
+    per_rank = [[batch for batch in loader] for loader in loaders]
+    assert all(len(batches) == len(loader) for batches, loader in zip(per_rank, loaders))
+    seen = [idx for batches in per_rank for batch in batches for idx in batch]
+    # every sample once, a few repeated to pad the ranks to the same number of batches
+    assert set(seen) == set(range(num_samples))
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"bucket_boundaries": [32, 64, 128]},
+    {"max_tokens_per_batch": 2048},
+])
+def test_train_loader_is_sharded_by_the_sampler(kwargs):
+    loaders = [make_datamodule(rank, **kwargs).train_dataloader() for rank in range(WORLD_SIZE)]
+    check_sharded(loaders, 203)
+    # a second epoch keeps the number of batches, which Lightning and the lr scheduler rely on
+    for loader in loaders:
+        assert len(list(loader)) == len(loader)
+
+
+def test_token_budget_eval_loader_is_sharded_by_the_sampler():
+    loaders = [make_datamodule(rank, max_tokens_per_batch=2048).val_dataloader() for rank in range(WORLD_SIZE)]
+    check_sharded(loaders, 57)
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"bucket_boundaries": [32, 64, 128]},
+    {"max_tokens_per_batch": 2048},
+])
+def test_sampler_replacement_is_refused(kwargs):
+    assert L5DataModule.uses_batch_samplers(make_hparams(**kwargs))
+    with pytest.raises(ValueError, match="replace_sampler_ddp"):
+        make_datamodule(0, replace_sampler_ddp=True, **kwargs).train_dataloader()
+
+
+def test_default_loaders_keep_sampler_replacement():
+    assert not L5DataModule.uses_batch_samplers(make_hparams())
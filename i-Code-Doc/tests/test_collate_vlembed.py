@@ -0,0 +1,115 @@
+import itertools
+
+import pytest
+import torch
+
+from core.models.udop_unimodel import collate_vlembed
+
+
+def legacy_pad_sequence(seq, target_len, pad_value=0):
+    if isinstance(seq, torch.Tensor):
+        n = seq.shape[0]
+    else:
+        n = len(seq)
+        seq = torch.tensor(seq)
+    m = target_len - n
+    if m > 0:
+        ret = torch.stack([pad_value] * m).to(seq)
+        seq = torch.cat([seq, ret], dim=0)
+    return seq[:target_len]
+
+
+def legacy_collate_vlembed(inputs_patches, inputs_embeds, seg_data, visual_segdata, vis_special_token=None,
+                           attention_mask=None, num_patches=14, max_len=0):
+    """Per-row implementation replaced by the batched one, kept as the reference."""
+    L = num_patches
+    ocr_points_x = torch.clip(torch.floor((seg_data[:, :, 0]+seg_data[:, :, 2])/2.0 * L).long(), 0, L-1)
+    ocr_points_y = torch.clip(torch.floor((seg_data[:, :, 1]+seg_data[:, :, 3])/2.0 * L).long(), 0, L-1) * L
+    ocr_points = ocr_points_x + ocr_points_y
+    target_seg = (seg_data.mean(-1) == 0.0) | (seg_data.mean(-1) == 1.0)
+    repeated_vision_embeds = torch.gather(inputs_patches, 1, ocr_points.unsqueeze(-1).repeat(1, 1, inputs_patches.size(-1)))
+    repeated_vision_embeds[target_seg] = 0.0
+    inputs_embeds += repeated_vision_embeds
+
+    patch_inds = torch.full_like(inputs_patches[:, :, 0], True).bool()
+    ind = torch.cat([torch.arange(len(ocr_points))[:, None].repeat(1, ocr_points.size(-1))[:, :, None].to(ocr_points), ocr_points[:, :, None]], -1).flatten(0,1)
+    rows, cols = zip(*ind)
+    patch_inds[rows, cols] = False
+
+    input_vision_patches = [inputs_patches[i][patch_inds[i]] for i in range(len(patch_inds))]
+    visual_segdata = [visual_segdata[i][patch_inds[i]] for i in range(len(patch_inds))]
+    if attention_mask is not None:
+        visual_attention_mask = [torch.tensor([1] * len(item)).to(attention_mask) for item in visual_segdata]
+
+    if max_len == 0:
+        max_len = inputs_patches.size(1)
+    else:
+        max_len = max_len - inputs_embeds.size(1)
+    inputs_vision_patches = torch.stack([legacy_pad_sequence(item, max_len, torch.zeros_like(inputs_patches[0, 0])) for item in input_vision_patches])
+    visual_segdata = torch.stack([legacy_pad_sequence(item, max_len, torch.zeros_like(seg_data[0, 0])) for item in visual_segdata])
+    if attention_mask is not None:
+        visual_attention_mask = torch.stack([legacy_pad_sequence(item, max_len, torch.zeros_like(attention_mask[0, 0])) for item in visual_attention_mask])
+
+    if vis_special_token is not None:
+        inputs_vision_patches += vis_special_token
+
+    inputs_embeds = torch.cat([inputs_embeds, inputs_vision_patches], 1)
+    seg_data = torch.cat([seg_data, visual_segdata], 1)
+    if attention_mask is not None:
+        attention_mask = torch.cat([attention_mask, visual_attention_mask], 1)
+    return inputs_embeds, seg_data, attention_mask
+
+
+NUM_PATCHES = 4
+SEQ_LEN = 12
+DIM = 8
+
+
+def make_inputs(batch_size, image_mask_ratio, seed):
+    gen = torch.Generator().manual_seed(seed)
+    total = NUM_PATCHES ** 2
+    inputs_patches = torch.randn(batch_size, total, DIM, generator=gen)
+    if image_mask_ratio > 0:
+        # masked patches are replaced by the (shared) mask token, as forward does with ids_keep/ids_restore
+        masked = torch.rand(batch_size, total, generator=gen) < image_mask_ratio
+        inputs_patches[masked] = torch.randn(DIM, generator=gen)
+    inputs_embeds = torch.randn(batch_size, SEQ_LEN, DIM, generator=gen)
+
+    corner = torch.rand(batch_size, SEQ_LEN, 2, generator=gen) * 0.8
+    seg_data = torch.cat([corner, corner + torch.rand(batch_size, SEQ_LEN, 2, generator=gen) * 0.2], -1)
+    # prompt tokens with negative bboxes, a special token (all ones) and padding (all zeros)
+    seg_data[:, :2] = -0.01
+    seg_data[:, 2] = 1.0
+    lengths = torch.randint(3, SEQ_LEN + 1, (batch_size,), generator=gen)
+    attention_mask = (torch.arange(SEQ_LEN)[None] < lengths[:, None]).long()
+    seg_data[attention_mask == 0] = 0.0
+
+    step = torch.arange(NUM_PATCHES, dtype=torch.float) / NUM_PATCHES
+    x, y = step.repeat(NUM_PATCHES), step.repeat_interleave(NUM_PATCHES)
+    visual_segdata = torch.stack([x, y, x + 1 / NUM_PATCHES, y + 1 / NUM_PATCHES], -1)
+    visual_segdata = visual_segdata[None].repeat(batch_size, 1, 1)
+    return inputs_patches, inputs_embeds, seg_data, visual_segdata, attention_mask
+
+
+@pytest.mark.parametrize(
+    "batch_size,image_mask_ratio,special_token,with_mask,max_len",
+    list(itertools.product([1, 3], [0.0, 0.75], [False, True], [False, True], [0, SEQ_LEN + 5, SEQ_LEN + 30])),
+)
+def test_collate_vlembed_matches_legacy(batch_size, image_mask_ratio, special_token, with_mask, max_len):
+    for seed in range(3):
+        inputs_patches, inputs_embeds, seg_data, visual_segdata, attention_mask = make_inputs(
+            batch_size, image_mask_ratio, seed)
+        vis_special_token = torch.randn(DIM) if special_token else None
+        mask = attention_mask if with_mask else None
+
+        expected = legacy_collate_vlembed(inputs_patches, inputs_embeds.clone(), seg_data, visual_segdata,
+                                          vis_special_token, mask, NUM_PATCHES, max_len)
+        result = collate_vlembed(inputs_patches, inputs_embeds.clone(), seg_data, visual_segdata,
+                                 vis_special_token, mask, NUM_PATCHES, max_len)
+
+        for got, ref in zip(result, expected):
+            if ref is None:
+                assert got is None
+                continue
+            assert got.shape == ref.shape and got.dtype == ref.dtype
+            assert torch.equal(got, ref)
@@ -0,0 +1,240 @@
+"""
+Encoders from decoded tensors to media bytes.
+
+Images and videos are converted to uint8 channels-last in one batched op on
+    the decoding device and copied to host once, every sample is then encoded
+    from that buffer in a thread pool (cv2 and PyAV release the GIL while
+    encoding). Videos are written frame by frame into an in-memory container,
+    and an audio track can be muxed into the same container.
+
+Encoders are looked up by (xtype, format) and new ones can be added with
+    register_encoder.
+"""
+
+import io
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+
+_encoders = {}
+
+def register_encoder(xtype, fmt):
+    """
+    Register fn(sample, **kwargs) -> bytes as the encoder of fmt for xtype.
+        sample is one item of the host batch made by prepare_batch.
+    """
+    def wrapper(fn):
+        _encoders[(xtype, fmt)] = fn
+        return fn
+    return wrapper
+
+def get_encoder(xtype, fmt):
+    try:
+        return _encoders[(xtype, fmt)]
+    except KeyError:
+        formats = sorted([f for x, f in _encoders if x == xtype])
+        raise ValueError('No {} encoder for format {}, available: {}'.format(xtype, fmt, formats))
+
+def to_uint8(x, value_range=(0, 1), channels_last=True, bgr=False):
+    """
+    Batched float image tensor to uint8 on its own device.
+    :param x: [... x C x H x W] tensor in value_range.
+    :return: [... x H x W x C] uint8 tensor when channels_last.
+    """
+    if x.dtype != torch.uint8:
+        low, high = value_range
+        x = ((x.float() - low) * (255.0 / (high - low))).clamp_(0, 255).round_().to(torch.uint8)
+    if bgr:
+        x = x.flip(-3)
+    if channels_last:
+        x = x.movedim(-3, -1)
+    return x
+
+def to_int16(x):
+    """
+    Float waveform tensor in [-1, 1] to int16 on its own device.
+    """
+    if x.dtype == torch.int16:
+        return x
+    return (x.float() * 32767.0).clamp_(-32768, 32767).round_().to(torch.int16)
+
+def prepare_batch(x, xtype, fmt):
+    """
+    Convert a decoded batch to the host layout the encoders of xtype read,
+        with a single device to host copy.
+    :param x: image [B x C x H x W] or video [B x F x C x H x W] in [0, 1] or
+        uint8, audio [B x N] or [B x 1 x N] in [-1, 1], text a list of str.
+    """
+    if xtype == 'text':
+        return list(x)
+    if xtype in ['image', 'video']:
+        # cv2 reads BGR, PyAV is handed rgb24 frames
+        bgr = xtype == 'image'
+        x = to_uint8(x, bgr=bgr)
+    elif xtype == 'audio':
+        if x.dim() == 3:
+            x = x[:, 0]
+        x = to_int16(x) if fmt in ['wav', 'flac'] else x.float()
+    return x.contiguous().cpu().numpy()
+
+#############
+# encoders  #
+#############
+
+def _require(module, name):
+    if module is None:
+        raise ImportError('{} is required for this output format'.format(name))
+
+@register_encoder('image', 'png')
+def encode_png(image, compression=3):
+    _require(cv2, 'opencv-python')
+    ok, buf = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    assert ok
+    return buf.tobytes()
+
+@register_encoder('image', 'webp')
+def encode_webp(image, quality=101):
+    """
+    quality above 100 selects lossless WebP.
+    """
+    _require(cv2, 'opencv-python')
+    ok, buf = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    assert ok
+    return buf.tobytes()
+
+@register_encoder('audio', 'wav')
+def encode_wav(waveform, sample_rate=16000):
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(waveform.tobytes())
+    return buf.getvalue()
+
+@register_encoder('audio', 'flac')
+def encode_flac(waveform, sample_rate=16000):
+    _require(sf, 'soundfile')
+    buf = io.BytesIO()
+    sf.write(buf, waveform, sample_rate, format='FLAC', subtype='PCM_16')
+    return buf.getvalue()
+
+@register_encoder('text', 'txt')
+def encode_txt(text):
+    return text.encode('utf-8')
+
+# container format, video codec, pixel format, audio codec
+VIDEO_CONTAINERS = {
+    'mp4': ('mp4', 'libx264', 'yuv420p', 'aac'),
+    # lossless
+    'mkv': ('matroska', 'ffv1', 'bgr0', 'flac'),
+}
+
+def encode_video(frames, fmt='mp4', fps=8, audio=None, sample_rate=16000, crf=None):
+    """
+    Encode frames into an in-memory container, frame by frame, optionally
+        muxing an audio track.
+    :param frames: [F x H x W x 3] uint8 RGB array.
+    :param audio: optional [N] float waveform in [-1, 1].
+    """
+    _require(av, 'av')
+    container_format, codec, pix_fmt, audio_codec = VIDEO_CONTAINERS[fmt]
+    num_frames, height, width, _ = frames.shape
+
+    buf = io.BytesIO()
+    container = av.open(buf, mode='w', format=container_format)
+    stream = container.add_stream(codec, rate=fps)
+    stream.width, stream.height = width, height
+    stream.pix_fmt = pix_fmt
+    if crf is not None:
+        stream.options = {'crf': str(crf)}
+    if audio is not None:
+        audio_stream = container.add_stream(audio_codec, rate=sample_rate)
+        audio_stream.layout = 'mono'
+
+    for frame in frames:
+        frame = av.VideoFrame.from_ndarray(frame, format='rgb24')
+        for packet in stream.encode(frame):
+            container.mux(packet)
+    for packet in stream.encode():
+        container.mux(packet)
+
+    if audio is not None:
+        # trim the track to the video duration
+        audio = audio[:int(round(num_frames / fps * sample_rate))]
+        frame = av.AudioFrame.from_ndarray(
+            np.ascontiguousarray(audio, dtype=np.float32)[None], format='flt', layout='mono')
+        frame.sample_rate = sample_rate
+        # the codec context re-chunks the track to its own frame size
+        for packet in audio_stream.encode(frame):
+            container.mux(packet)
+        for packet in audio_stream.encode():
+            container.mux(packet)
+
+    container.close()
+    return buf.getvalue()
+
+for _fmt in VIDEO_CONTAINERS:
+    register_encoder('video', _fmt)(
+        lambda frames, _fmt=_fmt, **kwargs: encode_video(frames, fmt=_fmt, **kwargs))
+
+#############
+# pool      #
+#############
+
+class output_encoder(object):
+    """
+    Encodes decoded batches to bytes in a worker thread pool.
+    Format options (compression, quality, fps, sample_rate, crf) are passed
+        through to the encoder.
+    """
+    def __init__(self, num_workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    def submit(self, x, xtype, fmt, **kwargs):
+        """
+        :return: one future per sample of x, each resolving to bytes.
+        """
+        fn = get_encoder(xtype, fmt)
+        batch = prepare_batch(x, xtype, fmt)
+        return [self.pool.submit(fn, sample, **kwargs) for sample in batch]
+
+    def encode(self, x, xtype, fmt, **kwargs):
+        return [f.result() for f in self.submit(x, xtype, fmt, **kwargs)]
+
+    def submit_muxed(self, video, audio, fmt='mp4', fps=8, sample_rate=16000, **kwargs):
+        """
+        Mux sample i of the video batch with sample i of the audio batch.
+        :return: one future per sample, each resolving to bytes.
+        """
+        assert fmt in VIDEO_CONTAINERS, fmt
+        frames = prepare_batch(video, 'video', fmt)
+        audio = prepare_batch(audio, 'audio', fmt)
+        assert len(frames) == len(audio)
+        return [
+            self.pool.submit(
+                encode_video, fi, fmt=fmt, fps=fps, audio=ai, sample_rate=sample_rate, **kwargs)
+            for fi, ai in zip(frames, audio)]
+
+    def encode_muxed(self, video, audio, fmt='mp4', fps=8, sample_rate=16000, **kwargs):
+        return [f.result() for f in self.submit_muxed(video, audio, fmt, fps, sample_rate, **kwargs)]
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -1,4 +1,5 @@
 from inspect import isfunction
+from functools import partial
 import math
 import torch
 import torch.nn.functional as F
@@ -6,6 +7,7 @@ from torch import nn, einsum
 from einops import rearrange, repeat
 
 from .diffusion_utils import checkpoint
+from .token_merging import compute_merge
 
 
 def exists(val):
@@ -204,11 +206,19 @@ class BasicTransformerBlock(nn.Module):
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
         self.checkpoint = checkpoint
-
-    def forward(self, x, context=None):
-        return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
-
-    def _forward(self, x, context=None):
+        # set by core.models.token_merging.apply_token_merging, None is a no-op
+        self.token_merge = None
+
+    def forward(self, x, context=None, hw=None):
+        return checkpoint(partial(self._forward, hw=hw), (x, context), self.parameters(), self.checkpoint)
+
+    def _forward(self, x, context=None, hw=None):
+        if self.token_merge is not None and hw is not None:
+            merge, unmerge = compute_merge(x, hw, self.token_merge)
+            x = unmerge(self.attn1(merge(self.norm1(x)))) + x
+            x = self.attn2(self.norm2(x), context=context) + x
+            x = unmerge(self.ff(merge(self.norm3(x)))) + x
+            return x
         x = self.attn1(self.norm1(x)) + x
         x = self.attn2(self.norm2(x), context=context) + x
         x = self.ff(self.norm3(x)) + x
@@ -255,7 +265,7 @@ class SpatialTransformer(nn.Module):
         x = self.proj_in(x)
         x = rearrange(x, 'b c h w -> b (h w) c')
         for block in self.transformer_blocks:
-            x = block(x, context=context)
+            x = block(x, context=context, hw=(h, w))
         x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
         x = self.proj_out(x)
         return x + x_in
\ No newline at end of file
@@ -1,11 +1,11 @@
 import torch
+import torch.nn.functional as F
 from core.models.audioldm.latent_diffusion.ema import *
 from core.models.audioldm.variational_autoencoder.modules import Encoder, Decoder
 from core.models.audioldm.variational_autoencoder.distributions import DiagonalGaussianDistribution
 
 from core.models.audioldm.hifigan.utilities import get_vocoder, vocoder_infer
         
-from core.models.audioldm.audio.tools import wav_to_fbank
 from core.models.audioldm.audio.stft import TacotronSTFT
 def ddconfig():
     return {
@@ -57,6 +57,7 @@ class AudioAutoencoderKL(nn.Module):
         self.decoder = Decoder(**ddconfig)
 
         self.subband = int(subband)
+        self.image_key = image_key
 
         if self.subband > 1:
             print("Use subband decomposition %s" % self.subband)
@@ -77,26 +78,78 @@ class AudioAutoencoderKL(nn.Module):
     def encode(self, x, time=10.0):
 #         if next(self.parameters()).dtype = torch.float16:
 #             self = self.float()
-        temp_dtype = x.dtype
-        x = wav_to_fbank(
-                x.float(), target_length=int(time * 102.4), fn_STFT=self.fn_STFT.float()
-            ).to(x.device).to(temp_dtype)
-        x = self.freq_split_subband(x)
+        x = self.wav_to_subband_fbank(x, int(time * 102.4)).to(x.dtype)
         h = self.encoder(x)
         moments = self.quant_conv(h)
 #         .to(temp_dtype)
         posterior = DiagonalGaussianDistribution(moments)
         return posterior
 
+    def wav_to_subband_fbank(self, waveform, target_length):
+        """
+        Batched, on-device wav_to_fbank fused with freq_split_subband: the
+            whole batch is normalized, padded and transformed at once, the mel
+            projection is written time major and the subbands are a view of it.
+        :param waveform: [B x samples] waveform.
+        :param target_length: number of mel frames.
+        :return: [B x subband x target_length x fbins/subband] float32 log mel.
+        """
+        stft = self.fn_STFT.float()
+        stft_fn = stft.stft_fn
+        hop, half = stft_fn.hop_length, stft_fn.filter_length // 2
+
+        x = waveform.float()
+        x = x - x.mean(1, keepdim=True)
+        x = x / (x.abs().amax(1, keepdim=True) + 1e-8) * 0.5
+        segment_length = target_length * hop
+        if x.size(1) > segment_length:
+            x = x[:, :segment_length]
+        elif x.size(1) < segment_length:
+            x = F.pad(x, (0, segment_length - x.size(1)))
+        x = F.pad(x.clamp(-1, 1).unsqueeze(1), (half, half), mode="reflect")
+        # only the samples seen by the first target_length frames
+        x = x[:, :, : (target_length - 1) * hop + stft_fn.filter_length]
+
+        spec = F.conv1d(x, stft_fn.forward_basis, stride=hop)
+        magnitude = torch.sqrt(spec[:, : half + 1] ** 2 + spec[:, half + 1 :] ** 2)
+        fbank = torch.matmul(magnitude.transpose(1, 2), stft.mel_basis.t())
+        fbank = stft.spectral_normalize(fbank, torch.log)
+        return self.freq_split_subband(fbank.unsqueeze(1))
+
     def decode(self, z):
         z = self.post_quant_conv(z)
         dec = self.decoder(z)
         dec = self.freq_merge_subband(dec)
         return dec
 
+    def vocoder_input(self, dec):
+        """
+        Decoder output to the [B x fbins x T] layout of the vocoder. Subbands
+            are merged within the single copy the layout change needs anyway.
+        """
+        if dec.size(1) == 1:
+            mel = dec.squeeze(1).transpose(1, 2)
+        else:
+            bs, sub_ch, tstep, fbins = dec.size()
+            mel = dec.permute(0, 1, 3, 2).reshape(bs, sub_ch * fbins, tstep)
+        return mel.to(self.vocoder.conv_pre.weight.dtype)
+
+    def vocode(self, dec):
+        """
+        [B x 1 x samples] waveform of a decoder output, kept on device.
+        """
+        return self.vocoder(self.vocoder_input(dec))
+
+    def decode_waveform(self, z):
+        """
+        Fused decode and vocoder on device, the subbands of the decoder output
+            go to the vocoder without being merged first.
+        """
+        z = self.post_quant_conv(z)
+        return self.vocode(self.decoder(z))
+
     def decode_to_waveform(self, dec):
-        dec = dec.squeeze(1).permute(0, 2, 1)
-        wav_reconstruction = vocoder_infer(dec, self.vocoder)
+        wav_reconstruction = vocoder_infer(self.vocoder_input(dec), self.vocoder)
         return wav_reconstruction
 
     def forward(self, input, sample_posterior=True):
@@ -124,15 +177,12 @@ class AudioAutoencoderKL(nn.Module):
         assert fbank.size(-1) % self.subband == 0
         assert ch == 1
 
-        return (
-            fbank.squeeze(1)
-            .reshape(bs, tstep, self.subband, fbins // self.subband)
-            .permute(0, 2, 1, 3)
-        )
+        # a strided view, the first encoder conv reads it without a copy
+        return fbank.view(bs, tstep, self.subband, fbins // self.subband).transpose(1, 2)
 
     def freq_merge_subband(self, subband_fbank):
         if self.subband == 1 or self.image_key != "stft":
             return subband_fbank
         assert subband_fbank.size(1) == self.subband  # Channel dimension
         bs, sub_ch, tstep, fbins = subband_fbank.size()
-        return subband_fbank.permute(0, 2, 1, 3).reshape(bs, tstep, -1).unsqueeze(1)
\ No newline at end of file
+        return subband_fbank.transpose(1, 2).reshape(bs, 1, tstep, sub_ch * fbins)
@@ -21,5 +21,5 @@ from .pretrained import (
     get_pretrained_url,
     download_pretrained,
 )
-from .tokenizer import SimpleTokenizer, tokenize
+from .tokenizer import SimpleTokenizer, tokenize, tokenize_batch
 from .transform import image_transform
@@ -5,6 +5,7 @@ Copied from https://github.com/openai/CLIP. Originally MIT License, Copyright (c
 import gzip
 import html
 import os
+from collections import OrderedDict
 from functools import lru_cache
 from typing import Union, List
 
@@ -71,8 +72,64 @@ def whitespace_clean(text):
     return text
 
 
+# printable ascii bytes are mapped to themselves by bytes_to_unicode
+_PRINTABLE_ASCII = re.compile(r"[!-~]+")
+
+
+class LRUCache(object):
+    """
+    Bounded least recently used cache with hit / miss counters.
+    maxsize=None never evicts.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if self.maxsize is not None and len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def info(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe(), special_tokens=None):
+    def __init__(
+        self, bpe_path: str = default_bpe(), special_tokens=None, cache_size=65536
+    ):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
         merges = gzip.open(bpe_path).read().decode("utf-8").split("\n")
@@ -90,7 +147,11 @@ class SimpleTokenizer(object):
         self.encoder = dict(zip(vocab, range(len(vocab))))
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {t: t for t in special_tokens}
+        # special tokens are pinned, all other words go through the bounded caches
+        self.special_cache = {t: t for t in special_tokens}
+        self.special_ids = {t: (self.encoder[t],) for t in special_tokens}
+        self.cache = LRUCache(cache_size)
+        self.ids_cache = LRUCache(cache_size)
         special = "|".join(special_tokens)
         self.pat = re.compile(
             special + r"""|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
@@ -101,8 +162,11 @@ class SimpleTokenizer(object):
         self.all_special_ids = [self.encoder[t] for t in special_tokens]
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
+        if token in self.special_cache:
+            return self.special_cache[token]
+        word = self.cache.get(token)
+        if word is not None:
+            return word
         word = tuple(token[:-1]) + (token[-1] + "</w>",)
         pairs = get_pairs(word)
 
@@ -138,19 +202,54 @@ class SimpleTokenizer(object):
             else:
                 pairs = get_pairs(word)
         word = " ".join(word)
-        self.cache[token] = word
+        self.cache.put(token, word)
         return word
 
+    def byte_encode(self, token):
+        if _PRINTABLE_ASCII.fullmatch(token):
+            return token
+        return "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+
+    def bpe_ids(self, token):
+        """
+        Token ids of one pre-tokenized word, cached per word.
+        """
+        if token in self.special_ids:
+            return self.special_ids[token]
+        ids = self.ids_cache.get(token)
+        if ids is None:
+            ids = tuple(
+                self.encoder[bpe_token]
+                for bpe_token in self.bpe(self.byte_encode(token)).split(" ")
+            )
+            self.ids_cache.put(token, ids)
+        return ids
+
     def encode(self, text):
         bpe_tokens = []
         text = whitespace_clean(basic_clean(text)).lower()
         for token in re.findall(self.pat, text):
-            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
-            bpe_tokens.extend(
-                self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
-            )
+            bpe_tokens.extend(self.bpe_ids(token))
         return bpe_tokens
 
+    def encode_batch(self, texts):
+        """
+        Encode a list of texts, every distinct word of the batch goes through
+        bpe at most once.
+        """
+        words = [
+            re.findall(self.pat, whitespace_clean(basic_clean(text)).lower())
+            for text in texts
+        ]
+        ids = {token: self.bpe_ids(token) for token in set().union(*words)}
+        return [[i for token in tokens for i in ids[token]] for tokens in words]
+
+    def cache_info(self):
+        """
+        Hit / miss statistics of the word caches.
+        """
+        return {"bpe": self.cache.info(), "ids": self.ids_cache.info()}
+
     def decode(self, tokens):
         text = "".join([self.decoder[token] for token in tokens])
         text = (
@@ -181,17 +280,45 @@ def tokenize(
     -------
     A two-dimensional tensor containing the resulting tokens, shape = [number of input strings, context_length]
     """
+    return tokenize_batch(texts, context_length)
+
+
+def tokenize_batch(
+    texts: Union[str, List[str]],
+    context_length: int = 77,
+    out: torch.LongTensor = None,
+    tokenizer: SimpleTokenizer = None,
+) -> torch.LongTensor:
+    """
+    Batched tokenize. Texts are encoded with SimpleTokenizer.encode_batch and
+    written into one preallocated tensor, truncated to context_length.
+
+    Parameters
+    ----------
+    out : torch.LongTensor, optional
+        A [number of input strings, context_length] tensor reused as output.
+    tokenizer : SimpleTokenizer, optional
+        Defaults to the module tokenizer.
+    """
     if isinstance(texts, str):
         texts = [texts]
+    if tokenizer is None:
+        tokenizer = _tokenizer
 
-    sot_token = _tokenizer.encoder["<start_of_text>"]
-    eot_token = _tokenizer.encoder["<end_of_text>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
-
-    for i, tokens in enumerate(all_tokens):
-        if len(tokens) > context_length:
-            tokens = tokens[:context_length]  # Truncate
-        result[i, : len(tokens)] = torch.tensor(tokens)
+    sot_token = tokenizer.encoder["<start_of_text>"]
+    eot_token = tokenizer.encoder["<end_of_text>"]
+    if out is None:
+        out = torch.zeros(len(texts), context_length, dtype=torch.long)
+    else:
+        assert out.shape == (len(texts), context_length)
+        out.zero_()
 
-    return result
+    rows, flat = [], []
+    for i, tokens in enumerate(tokenizer.encode_batch(texts)):
+        tokens = ([sot_token] + tokens + [eot_token])[:context_length]  # Truncate
+        rows.append(len(tokens))
+        flat.extend(tokens)
+    lengths = torch.tensor(rows, dtype=torch.long)
+    mask = torch.arange(context_length)[None] < lengths[:, None]
+    out[mask] = torch.tensor(flat, dtype=torch.long)
+    return out
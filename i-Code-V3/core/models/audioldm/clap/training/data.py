@@ -455,6 +455,39 @@ def get_mel(audio_data, audio_cfg):
     return mel.T  # (T, n_mels)
 
 
+def fill_audio(audio_data, max_len, data_filling):
+    """
+    Fill audio_data shorter than max_len up to max_len samples.
+    """
+    if len(audio_data) < max_len:  # do nothing if equal
+        if data_filling == "repeatpad":
+            n_repeat = int(max_len / len(audio_data))
+            audio_data = audio_data.repeat(n_repeat)
+            # audio_data = audio_data.unsqueeze(0).unsqueeze(0).unsqueeze(0)
+            # audio_data = F.interpolate(audio_data,size=max_len,mode="bicubic")[0,0,0]
+            audio_data = F.pad(
+                audio_data,
+                (0, max_len - len(audio_data)),
+                mode="constant",
+                value=0,
+            )
+        elif data_filling == "pad":
+            audio_data = F.pad(
+                audio_data,
+                (0, max_len - len(audio_data)),
+                mode="constant",
+                value=0,
+            )
+        elif data_filling == "repeat":
+            n_repeat = int(max_len / len(audio_data))
+            audio_data = audio_data.repeat(n_repeat + 1)[:max_len]
+        else:
+            raise NotImplementedError(
+                f"data_filling {data_filling} not implemented"
+            )
+    return audio_data
+
+
 def get_audio_features(
     sample, audio_data, max_len, data_truncating, data_filling, audio_cfg
 ):
@@ -532,32 +565,7 @@ def get_audio_features(
             audio_data = audio_data[idx : idx + max_len]
 
         else:  # padding if too short
-            if len(audio_data) < max_len:  # do nothing if equal
-                if data_filling == "repeatpad":
-                    n_repeat = int(max_len / len(audio_data))
-                    audio_data = audio_data.repeat(n_repeat)
-                    # audio_data = audio_data.unsqueeze(0).unsqueeze(0).unsqueeze(0)
-                    # audio_data = F.interpolate(audio_data,size=max_len,mode="bicubic")[0,0,0]
-                    audio_data = F.pad(
-                        audio_data,
-                        (0, max_len - len(audio_data)),
-                        mode="constant",
-                        value=0,
-                    )
-                elif data_filling == "pad":
-                    audio_data = F.pad(
-                        audio_data,
-                        (0, max_len - len(audio_data)),
-                        mode="constant",
-                        value=0,
-                    )
-                elif data_filling == "repeat":
-                    n_repeat = int(max_len / len(audio_data))
-                    audio_data = audio_data.repeat(n_repeat + 1)[:max_len]
-                else:
-                    raise NotImplementedError(
-                        f"data_filling {data_filling} not implemented"
-                    )
+            audio_data = fill_audio(audio_data, max_len, data_filling)
             if data_truncating == "fusion":
                 mel = get_mel(audio_data, audio_cfg)
                 mel_fusion = torch.stack([mel, mel, mel, mel], dim=0)
@@ -570,6 +578,32 @@ def get_audio_features(
     return sample
 
 
+def select_text(json_dict_raw, text_augment_selection=None):
+    """
+    Select the (augmented) captions of a sample from its json dict.
+    """
+    if text_augment_selection is None or text_augment_selection == "none":
+        texts = json_dict_raw["text"]
+    elif text_augment_selection == "all":
+        if "text_augment_all" in json_dict_raw.keys():
+            texts = json_dict_raw["text_augment_all"]
+        else:
+            texts = json_dict_raw["text"]
+    elif text_augment_selection == "augment_only":
+        if "text_augment_all" in json_dict_raw.keys():
+            if json_dict_raw["text_augment_t5"] is None:
+                texts = json_dict_raw["text"]
+            else:
+                texts = json_dict_raw["text_augment_t5"]
+        else:
+            texts = json_dict_raw["text"]
+    else:
+        raise NotImplementedError(
+            f"text_augment_selection {text_augment_selection} not implemented"
+        )
+    return texts
+
+
 def preprocess(
     sample,
     audio_ext,
@@ -613,26 +647,7 @@ def preprocess(
     except:
         print("sample[__url__]:", sample["__url__"])
 
-    # For selecting augmented text from dataset
-    if text_augment_selection is None or text_augment_selection == "none":
-        texts = json_dict_raw["text"]
-    elif text_augment_selection == "all":
-        if "text_augment_all" in json_dict_raw.keys():
-            texts = json_dict_raw["text_augment_all"]
-        else:
-            texts = json_dict_raw["text"]
-    elif text_augment_selection == "augment_only":
-        if "text_augment_all" in json_dict_raw.keys():
-            if json_dict_raw["text_augment_t5"] is None:
-                texts = json_dict_raw["text"]
-            else:
-                texts = json_dict_raw["text_augment_t5"]
-        else:
-            texts = json_dict_raw["text"]
-    else:
-        raise NotImplementedError(
-            f"text_augment_selection {text_augment_selection} not implemented"
-        )
+    texts = select_text(json_dict_raw, text_augment_selection)
     sample["full_text"] = texts
 
     if isinstance(texts, list) and isinstance(texts[0], str) and len(texts) > 1:
@@ -927,6 +942,10 @@ def get_dataset_fn(data_path, dataset_type):
             )
     elif dataset_type == "toy":
         return get_toy_dataset
+    elif dataset_type == "melshard":
+        from .mel_shards import get_mel_shard_dataset
+
+        return get_mel_shard_dataset
     else:
         raise ValueError(f"Unsupported dataset type: {dataset_type}")
 
@@ -0,0 +1,336 @@
+"""
+Persistent embedding index for zero-shot classification and retrieval.
+
+The normalized embeddings of a label set or caption corpus are computed once,
+    written to a memory-mapped .npy file next to the model fingerprint and the
+    keys they were computed from, and reused as long as both match. Queries
+    are answered by batched top-k over the stored embeddings, either exactly
+    (brute force) or over the nprobe closest partitions of an IVF index.
+
+    fingerprint = model_fingerprint(model, TEXT_EMBEDDING_PARAMS)
+    index = EmbeddingIndex.get_or_build(
+        'cache/audioset_labels', labels, text_embed_fn(model, tokenizer), fingerprint)
+    scores, ids = index.search(model.get_audio_embedding(audio_dicts), k=5)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+META_FILE = "meta.json"
+KEYS_FILE = "keys.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+CENTROIDS_FILE = "ivf_centroids.npy"
+ORDER_FILE = "ivf_order.npy"
+OFFSETS_FILE = "ivf_offsets.npy"
+
+# name prefixes of the CLAP parameters producing text / audio embeddings
+TEXT_EMBEDDING_PARAMS = ("text_branch", "text_transform", "text_projection",
+                         "token_embedding", "positional_embedding", "ln_final")
+AUDIO_EMBEDDING_PARAMS = ("audio_branch", "audio_transform", "audio_projection")
+
+
+def model_fingerprint(model, prefixes=None):
+    """
+    Hash of the names, shapes, dtypes and values of the parameters and buffers
+        of model, any change of these weights gives a new fingerprint.
+    :param prefixes: only hash the entries whose name starts with one of
+        them, e.g. TEXT_EMBEDDING_PARAMS for an index of text embeddings, so
+        that training other parts of the model keeps the index valid.
+    """
+    sha = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        if prefixes is not None and not name.startswith(tuple(prefixes)):
+            continue
+        tensor = tensor.detach().cpu().contiguous()
+        sha.update(name.encode())
+        sha.update(str(tuple(tensor.shape)).encode())
+        sha.update(str(tensor.dtype).encode())
+        sha.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+def keys_fingerprint(keys):
+    return hashlib.sha1(json.dumps(list(keys)).encode()).hexdigest()
+
+
+def text_embed_fn(model, tokenizer, templates=None):
+    """
+    Embedding function for text keys. With templates, every key is embedded
+        once per template and the normalized embeddings are averaged, as for
+        zero-shot classifiers.
+    :param tokenizer: maps a list of strings to the token dict of the text
+        branch, e.g. training.data.tokenizer.
+    :param templates: list of callables or format strings with one {}.
+    """
+    def fill(template, key):
+        return template(key) if callable(template) else template.format(key)
+
+    def embed(keys):
+        with torch.no_grad():
+            if templates is None:
+                return model.get_text_embedding(tokenizer(list(keys)))
+            texts = [fill(t, key) for key in keys for t in templates]
+            embeds = model.get_text_embedding(tokenizer(texts))
+            embeds = embeds.view(len(keys), len(templates), -1).mean(1)
+            return F.normalize(embeds, dim=-1)
+    return embed
+
+
+def audio_embed_fn(model, load_fn):
+    """
+    Embedding function for audio keys, e.g. file names.
+    :param load_fn: maps a key to its audio dict from get_audio_features.
+    """
+    def embed(keys):
+        with torch.no_grad():
+            return model.get_audio_embedding([load_fn(key) for key in keys])
+    return embed
+
+
+def _topk_merge(scores, ids, new_scores, new_ids, k):
+    if scores is None:
+        scores, ids = new_scores, new_ids
+    else:
+        scores = torch.cat([scores, new_scores], dim=1)
+        ids = torch.cat([ids, new_ids], dim=1)
+    k = min(k, scores.shape[1])
+    scores, pos = scores.topk(k, dim=1)
+    return scores, ids.gather(1, pos)
+
+
+def spherical_kmeans(x, nlist, niter=20, seed=0):
+    """
+    k-means on the unit sphere (cosine similarity), x is a normalized [N x D]
+        float tensor. Empty clusters are re-seeded from random points.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    perm = torch.randperm(x.shape[0], generator=generator)
+    centroids = x[perm[:nlist]].clone()
+    for _ in range(niter):
+        assign = (x @ centroids.t()).argmax(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            reseed = torch.randint(x.shape[0], (int(empty.sum()),), generator=generator)
+            sums[empty] = x[reseed.to(x.device)]
+        centroids = F.normalize(sums, dim=-1)
+    return centroids
+
+
+class EmbeddingIndex(object):
+    """
+    Normalized embeddings of a fixed set of keys, memory mapped from root.
+    :param root: directory of the index.
+    :param device: device the queries are scored on.
+    :param in_memory: copy the embeddings to device once instead of streaming
+        them from the memory map block by block.
+    """
+    def __init__(self, root, device="cpu", in_memory=False, block_size=65536):
+        self.root = root
+        self.device = torch.device(device)
+        self.block_size = block_size
+        with open(os.path.join(root, META_FILE)) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(root, KEYS_FILE)) as f:
+            self.keys = json.load(f)
+        self.embeddings = np.load(os.path.join(root, EMBEDDINGS_FILE), mmap_mode="r")
+        self.cached = None
+        if in_memory:
+            self.cached = torch.from_numpy(np.ascontiguousarray(self.embeddings)).to(self.device)
+
+        self.backend = self.meta["backend"]
+        if self.backend == "ivf":
+            self.centroids = torch.from_numpy(np.load(os.path.join(root, CENTROIDS_FILE))).to(self.device)
+            self.order = np.load(os.path.join(root, ORDER_FILE))
+            self.offsets = np.load(os.path.join(root, OFFSETS_FILE))
+
+    def __len__(self):
+        return self.meta["num"]
+
+    @property
+    def fingerprint(self):
+        return self.meta["fingerprint"]
+
+    @staticmethod
+    def is_valid(root, keys, fingerprint):
+        """
+        True if root holds a complete index of keys built by the model with
+            this fingerprint.
+        """
+        meta_path = os.path.join(root, META_FILE)
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta.get("fingerprint") == fingerprint \
+            and meta.get("keys") == keys_fingerprint(keys)
+
+    @classmethod
+    def build(cls, root, keys, embed_fn, fingerprint, batch_size=256,
+              backend="brute_force", nlist=None, niter=20, dtype="float32", **kwargs):
+        """
+        Embed keys in batches with embed_fn and persist the index to root.
+        :param keys: the labels / captions / audio ids, json serializable.
+        :param embed_fn: embed_fn(list of keys) -> [B x D] tensor.
+        :param backend: 'brute_force' or 'ivf'.
+        :param nlist: number of IVF partitions, defaults to ~sqrt(len(keys)).
+        """
+        assert backend in ["brute_force", "ivf"], "Unknown index backend {}.".format(backend)
+        keys = list(keys)
+        tmp = root.rstrip("/") + ".tmp"
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        embeddings = None
+        for start in range(0, len(keys), batch_size):
+            batch = embed_fn(keys[start:start + batch_size])
+            batch = F.normalize(batch.float(), dim=-1).cpu().numpy()
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    os.path.join(tmp, EMBEDDINGS_FILE), mode="w+",
+                    dtype=dtype, shape=(len(keys), batch.shape[1]))
+            embeddings[start:start + len(batch)] = batch
+        assert embeddings is not None, "Cannot build an index of no keys."
+        embeddings.flush()
+
+        meta = {
+            "fingerprint": fingerprint,
+            "keys": keys_fingerprint(keys),
+            "num": len(keys),
+            "dim": int(embeddings.shape[1]),
+            "dtype": dtype,
+            "backend": backend, }
+
+        if backend == "ivf":
+            if nlist is None:
+                nlist = max(1, int(np.sqrt(len(keys))))
+            nlist = min(nlist, len(keys))
+            x = torch.from_numpy(np.asarray(embeddings, dtype=np.float32))
+            centroids = spherical_kmeans(x, nlist, niter=niter)
+            assign = (x @ centroids.t()).argmax(1).numpy()
+            order = np.argsort(assign, kind="stable").astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+            np.save(os.path.join(tmp, CENTROIDS_FILE), centroids.numpy())
+            np.save(os.path.join(tmp, ORDER_FILE), order)
+            np.save(os.path.join(tmp, OFFSETS_FILE), offsets)
+            meta["nlist"] = nlist
+        del embeddings
+
+        with open(os.path.join(tmp, KEYS_FILE), "w") as f:
+            json.dump(keys, f)
+        # meta.json is written last, its presence marks a complete index
+        with open(os.path.join(tmp, META_FILE), "w") as f:
+            json.dump(meta, f)
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.replace(tmp, root)
+        return cls(root, **kwargs)
+
+    @classmethod
+    def get_or_build(cls, root, keys, embed_fn, fingerprint, batch_size=256,
+                     backend="brute_force", nlist=None, niter=20, dtype="float32", **kwargs):
+        """
+        Open the index at root if it matches keys and fingerprint, otherwise
+            (re)build it.
+        """
+        keys = list(keys)
+        if cls.is_valid(root, keys, fingerprint):
+            index = cls(root, **kwargs)
+            if index.backend == backend:
+                return index
+        return cls.build(root, keys, embed_fn, fingerprint, batch_size=batch_size,
+                         backend=backend, nlist=nlist, niter=niter, dtype=dtype, **kwargs)
+
+    def _rows(self, ids):
+        if self.cached is not None:
+            return self.cached[torch.as_tensor(ids, device=self.device)].float()
+        # sorted reads are sequential on the memory map
+        ids = np.asarray(ids)
+        order = np.argsort(ids)
+        rows = np.empty((len(ids), self.embeddings.shape[1]), dtype=np.float32)
+        rows[order] = self.embeddings[ids[order]]
+        return torch.from_numpy(rows).to(self.device)
+
+    def _search_brute_force(self, queries, k):
+        if self.cached is not None:
+            scores = queries @ self.cached.float().t()
+            k = min(k, scores.shape[1])
+            scores, ids = scores.topk(k, dim=1)
+            return scores, ids
+        best_scores, best_ids = None, None
+        for start in range(0, len(self), self.block_size):
+            block = np.asarray(self.embeddings[start:start + self.block_size], dtype=np.float32)
+            block = torch.from_numpy(block).to(self.device)
+            scores = queries @ block.t()
+            kb = min(k, scores.shape[1])
+            scores, ids = scores.topk(kb, dim=1)
+            best_scores, best_ids = _topk_merge(best_scores, best_ids, scores, ids + start, k)
+        return best_scores, best_ids
+
+    def _search_ivf(self, queries, k, nprobe):
+        nprobe = min(nprobe, self.centroids.shape[0])
+        probes = (queries @ self.centroids.float().t()).topk(nprobe, dim=1)[1].cpu().numpy()
+        k_out = min(k, len(self))
+        all_scores = torch.full((queries.shape[0], k_out), -float("inf"), device=self.device)
+        all_ids = torch.full((queries.shape[0], k_out), -1, dtype=torch.long, device=self.device)
+        for qi, lists in enumerate(probes):
+            candidates = np.concatenate(
+                [self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+            if len(candidates) == 0:
+                continue
+            scores = self._rows(candidates) @ queries[qi]
+            kq = min(k_out, len(candidates))
+            scores, pos = scores.topk(kq)
+            all_scores[qi, :kq] = scores
+            all_ids[qi, :kq] = torch.as_tensor(candidates, device=self.device)[pos]
+        return all_scores, all_ids
+
+    def search(self, queries, k=10, nprobe=8):
+        """
+        Top-k most similar keys of a batch of query embeddings.
+        :param queries: [Q x D] tensor, normalized here.
+        :param nprobe: number of IVF partitions searched per query, ignored by
+            the brute force backend.
+        :return: [Q x k] cosine similarities and [Q x k] key indices, sorted by
+            similarity. IVF pads missing results with -inf / -1.
+        """
+        with torch.no_grad():
+            queries = F.normalize(queries.float().to(self.device), dim=-1)
+            if self.backend == "ivf":
+                return self._search_ivf(queries, k, nprobe)
+            return self._search_brute_force(queries, k)
+
+    def classify(self, queries, logit_scale=None):
+        """
+        Zero-shot logits of queries against every key, [Q x num_keys].
+        """
+        with torch.no_grad():
+            queries = F.normalize(queries.float().to(self.device), dim=-1)
+            if self.cached is not None:
+                logits = queries @ self.cached.float().t()
+            else:
+                logits = torch.cat([
+                    queries @ torch.from_numpy(np.asarray(
+                        self.embeddings[start:start + self.block_size], dtype=np.float32)).to(self.device).t()
+                    for start in range(0, len(self), self.block_size)], dim=1)
+            if logit_scale is not None:
+                logits = logit_scale * logits
+            return logits
+
+    def lookup(self, ids):
+        """
+        Keys of the (nested list / tensor of) indices returned by search.
+        """
+        if torch.is_tensor(ids):
+            ids = ids.tolist()
+        if isinstance(ids, list):
+            return [self.lookup(i) for i in ids]
+        return self.keys[ids] if ids >= 0 else None
@@ -0,0 +1,391 @@
+"""
+Offline mel / fusion feature shards for CLAP training.
+
+write_mel_shards decodes every sample of a set of webdataset tars once and
+    stores the log mel spectrogram of the (filled) audio, the shrunk global
+    view used by fusion and the captions in local memory-mapped shards.
+    MelShardDataset replays the random front / middle / back crop of
+    get_audio_features from the stored mel, so the dataloader workers only
+    slice arrays instead of decoding, resampling and running STFTs.
+
+Every random draw of a sample is seeded by (seed, epoch, index), together with
+    MelShardSampler this makes an epoch reproducible and resumable from any
+    sample offset.
+
+python -m core.models.audioldm.clap.training.mel_shards \\
+    --input /data/audiocaps/train/*.tar --output /data/audiocaps_mel/train \\
+    --amodel HTSAT-tiny --data-filling repeatpad
+"""
+
+import argparse
+import bisect
+import glob
+import io
+import json
+import logging
+import math
+import os
+
+import numpy as np
+import soundfile as sf
+import torch
+import torchvision.transforms
+from torch.utils.data import Dataset, DataLoader, Sampler
+
+from .data import (
+    DataInfo,
+    collate_fn,
+    fill_audio,
+    float32_to_int16,
+    get_mel,
+    int16_to_float32,
+    select_text,
+    tokenizer,
+)
+
+MANIFEST_FILE = "manifest.json"
+N_MELS = 64
+
+
+def _shard_prefix(out_dir, shard_id):
+    return os.path.join(out_dir, "shard_{:05d}".format(shard_id))
+
+
+def _chunk_frames(max_len, audio_cfg):
+    # the +1 related to how the spectrogram is computed
+    return max_len // audio_cfg["hop_size"] + 1
+
+
+class _ShardWriter(object):
+    def __init__(self, out_dir, shard_id, store_waveform):
+        self.prefix = _shard_prefix(out_dir, shard_id)
+        self.store_waveform = store_waveform
+        self.mels, self.shrinks, self.waves, self.index, self.meta = [], [], [], [], []
+        self.mel_offset = 0
+        self.wav_offset = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, mel, shrink, waveform, meta):
+        self.mels.append(mel.numpy().astype(np.float16))
+        self.shrinks.append(shrink.numpy().astype(np.float16))
+        wav_len = 0
+        if self.store_waveform:
+            self.waves.append(float32_to_int16(waveform.numpy()))
+            wav_len = len(waveform)
+        self.index.append([self.mel_offset, mel.shape[0], self.wav_offset, wav_len])
+        self.mel_offset += mel.shape[0]
+        self.wav_offset += wav_len
+        self.meta.append(meta)
+
+    def close(self):
+        np.save(self.prefix + ".mel.npy", np.concatenate(self.mels, axis=0))
+        np.save(self.prefix + ".shrink.npy", np.stack(self.shrinks, axis=0))
+        np.save(self.prefix + ".index.npy", np.array(self.index, dtype=np.int64))
+        if self.store_waveform:
+            np.save(self.prefix + ".wav.npy", np.concatenate(self.waves, axis=0))
+        with open(self.prefix + ".jsonl", "w") as f:
+            for m in self.meta:
+                f.write(json.dumps(m) + "\n")
+        return os.path.basename(self.prefix), len(self.index)
+
+
+def write_mel_shards(
+    input_shards,
+    out_dir,
+    audio_cfg,
+    max_len=480000,
+    data_filling="repeatpad",
+    audio_ext="flac",
+    text_ext="json",
+    samples_per_shard=2000,
+    store_waveform=False,
+):
+    """
+    Precompute the mel features of every sample of input_shards.
+    :param input_shards: list of webdataset tar files.
+    :param audio_cfg: model_cfg['audio_cfg'] of the model being trained.
+    :param max_len: audio length in samples seen by the model, audio shorter
+        than this is filled with data_filling before the mel is computed.
+    :param store_waveform: also store the int16 waveform, needed for
+        non-fusion models that compute their mel on the fly.
+    """
+    import webdataset as wds
+
+    os.makedirs(out_dir, exist_ok=True)
+    chunk_frames = _chunk_frames(max_len, audio_cfg)
+    resize = torchvision.transforms.Resize(size=[chunk_frames, N_MELS])
+
+    pipeline = wds.DataPipeline(
+        wds.SimpleShardList(input_shards),
+        wds.tarfile_to_samples(),
+    )
+    shards = []
+    writer = _ShardWriter(out_dir, 0, store_waveform)
+    with torch.no_grad():
+        for sample in pipeline:
+            audio_data, orig_sr = sf.read(io.BytesIO(sample[audio_ext]))
+            audio_data = int16_to_float32(float32_to_int16(audio_data))
+            audio_data = torch.tensor(audio_data).float()
+            if len(audio_data) <= max_len:
+                audio_data = fill_audio(audio_data, max_len, data_filling)
+            mel = get_mel(audio_data, audio_cfg)
+            if mel.shape[0] > chunk_frames:
+                shrink = resize(mel[None])[0]
+            else:
+                shrink = mel
+            json_dict_raw = json.loads(sample[text_ext].decode("utf-8"))
+            key = sample["__key__"].split("/")[-1]
+            writer.add(mel, shrink, audio_data, {
+                "__key__": sample["__key__"],
+                "__url__": sample["__url__"],
+                "json": json_dict_raw,
+                "audio_name": key + "." + audio_ext,
+                "text_name": key + "." + text_ext,
+                "audio_orig_sr": orig_sr,
+            })
+            if len(writer) == samples_per_shard:
+                shards.append(writer.close())
+                writer = _ShardWriter(out_dir, len(shards), store_waveform)
+    if len(writer) > 0:
+        shards.append(writer.close())
+
+    manifest = {
+        "audio_cfg": audio_cfg,
+        "max_len": max_len,
+        "chunk_frames": chunk_frames,
+        "data_filling": data_filling,
+        "store_waveform": store_waveform,
+        "shards": [{"name": name, "num_samples": n} for name, n in shards],
+    }
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+    logging.info(
+        f"Wrote {sum([n for _, n in shards])} samples in {len(shards)} mel shards to {out_dir}."
+    )
+    return manifest
+
+
+class MelShardDataset(Dataset):
+    """
+    Samples of the mel shards in out_dir, with the same keys as the webdataset
+        preprocess output (waveform only if the shards store it).
+    """
+    def __init__(
+        self,
+        out_dir,
+        seed=0,
+        class_index_dict=None,
+        text_augment_selection=None,
+    ):
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.out_dir = out_dir
+        self.seed = seed
+        self.epoch = 0
+        self.class_index_dict = class_index_dict
+        self.text_augment_selection = text_augment_selection
+        self.chunk_frames = self.manifest["chunk_frames"]
+        self.max_len = self.manifest["max_len"]
+        self.store_waveform = self.manifest["store_waveform"]
+        self.offsets = [0]
+        for shard in self.manifest["shards"]:
+            self.offsets.append(self.offsets[-1] + shard["num_samples"])
+        # memory maps are opened lazily, once per dataloader worker
+        self.shards = None
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _open(self):
+        self.shards = []
+        for shard in self.manifest["shards"]:
+            prefix = os.path.join(self.out_dir, shard["name"])
+            with open(prefix + ".jsonl") as f:
+                meta = [json.loads(line) for line in f]
+            self.shards.append({
+                "mel": np.load(prefix + ".mel.npy", mmap_mode="r"),
+                "shrink": np.load(prefix + ".shrink.npy", mmap_mode="r"),
+                "index": np.load(prefix + ".index.npy"),
+                "wav": np.load(prefix + ".wav.npy", mmap_mode="r") if self.store_waveform else None,
+                "meta": meta,
+            })
+
+    def _mel_fusion(self, mel, shrink, rng):
+        chunk_frames = self.chunk_frames
+        total_frames = mel.shape[0]
+        if total_frames <= chunk_frames:
+            mel = torch.from_numpy(np.asarray(mel[:chunk_frames], dtype=np.float32))
+            return torch.stack([mel, mel, mel, mel], dim=0), False
+        ranges = np.array_split(list(range(0, total_frames - chunk_frames + 1)), 3)
+        if len(ranges[1]) == 0:
+            ranges[1] = [0]
+        if len(ranges[2]) == 0:
+            ranges[2] = [0]
+        chunks = [
+            np.asarray(mel[i : i + chunk_frames], dtype=np.float32)
+            for i in [rng.choice(r) for r in ranges]
+        ]
+        chunks.append(np.asarray(shrink, dtype=np.float32))
+        return torch.from_numpy(np.stack(chunks, axis=0)), True
+
+    def __getitem__(self, index):
+        if self.shards is None:
+            self._open()
+        shard_id = bisect.bisect_right(self.offsets, index) - 1
+        shard = self.shards[shard_id]
+        local = index - self.offsets[shard_id]
+        mel_offset, num_frames, wav_offset, wav_len = shard["index"][local]
+        meta = shard["meta"][local]
+        rng = np.random.default_rng([self.seed, self.epoch, index])
+
+        mel = shard["mel"][mel_offset : mel_offset + num_frames]
+        mel_fusion, longer = self._mel_fusion(mel, shard["shrink"][local], rng)
+        sample = {
+            "__key__": meta["__key__"],
+            "__url__": meta["__url__"],
+            "mel_fusion": mel_fusion,
+            "longer": torch.tensor([longer]),
+        }
+        if self.store_waveform:
+            waveform = shard["wav"][wav_offset : wav_offset + wav_len]
+            # random crop to max_len (for compatibility)
+            idx = rng.integers(0, max(0, wav_len - self.max_len) + 1)
+            waveform = int16_to_float32(np.asarray(waveform[idx : idx + self.max_len]))
+            sample["waveform"] = torch.from_numpy(waveform)
+
+        texts = select_text(meta["json"], self.text_augment_selection)
+        sample["full_text"] = texts
+        if isinstance(texts, list) and isinstance(texts[0], str) and len(texts) > 1:
+            texts = texts[rng.integers(len(texts))]
+        sample["raw_text"] = texts
+        sample["text"] = tokenizer(texts)
+        if self.class_index_dict is not None:
+            class_label = np.zeros(len(self.class_index_dict.keys()))
+            for x in meta["json"]["tag"]:
+                class_label[self.class_index_dict[x]] = 1
+            sample["class_label"] = torch.tensor(class_label).float()
+        sample["audio_name"] = meta["audio_name"]
+        sample["text_name"] = meta["text_name"]
+        sample["audio_orig_sr"] = meta["audio_orig_sr"]
+        return sample
+
+
+class MelShardSampler(Sampler):
+    """
+    Per-epoch reshuffling, rank sharding and resume for MelShardDataset.
+        The permutation of an epoch only depends on (seed, epoch), so skipping
+        start_index samples continues an interrupted epoch exactly.
+    """
+    def __init__(self, dataset, rank=0, world_size=1, shuffle=True, seed=0, drop_last=True):
+        self.dataset = dataset
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start_index = 0
+        if drop_last:
+            self.num_samples = len(dataset) // world_size
+        else:
+            self.num_samples = math.ceil(len(dataset) / world_size)
+
+    def set_epoch(self, epoch, start_index=0):
+        """
+        :param start_index: number of samples of this rank already consumed
+            in epoch.
+        """
+        self.epoch = epoch
+        self.start_index = start_index
+        self.dataset.set_epoch(epoch)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.dataset))
+        else:
+            order = np.arange(len(self.dataset))
+        total = self.num_samples * self.world_size
+        if total > len(order):
+            order = np.concatenate([order, order[: total - len(order)]])
+        order = order[:total][self.rank :: self.world_size]
+        return iter(order[self.start_index :].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+def get_mel_shard_dataset(args, model_cfg, is_train):
+    """
+    DataInfo of precomputed mel shards, --train-data / --val-data point to the
+        output directories of write_mel_shards.
+    """
+    out_dir = args.train_data if is_train else args.val_data
+    if isinstance(out_dir, (list, tuple)):
+        out_dir = out_dir[0]
+    dataset = MelShardDataset(
+        out_dir,
+        seed=args.seed,
+        class_index_dict=args.class_index_dict,
+        text_augment_selection=args.text_augment_selection,
+    )
+    assert dataset.manifest["audio_cfg"]["hop_size"] == model_cfg["audio_cfg"]["hop_size"], \
+        "Mel shards were computed with a different audio config."
+    parallel = is_train or args.parallel_eval
+    sampler = MelShardSampler(
+        dataset,
+        rank=args.rank if parallel else 0,
+        world_size=args.world_size if parallel else 1,
+        shuffle=is_train,
+        seed=args.seed,
+        drop_last=is_train,
+    )
+    dataloader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        sampler=sampler,
+        num_workers=args.workers,
+        pin_memory=True,
+        drop_last=is_train,
+        collate_fn=collate_fn,
+        # workers are re-created every epoch and pick up dataset.epoch
+        persistent_workers=False,
+    )
+    dataloader.num_samples = len(sampler) * (args.world_size if parallel else 1)
+    dataloader.num_batches = len(dataloader)
+    return DataInfo(dataloader, sampler)
+
+
+def main():
+    from copy import deepcopy
+    from core.models.audioldm.clap.open_clip.factory import _MODEL_CONFIGS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, nargs="+", required=True, help="webdataset tars (globs allowed).")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--amodel", type=str, default="HTSAT-tiny")
+    parser.add_argument("--max-len", type=int, default=480000)
+    parser.add_argument("--data-filling", type=str, default="repeatpad")
+    parser.add_argument("--samples-per-shard", type=int, default=2000)
+    parser.add_argument("--store-waveform", default=False, action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    input_shards = sorted(sum([glob.glob(p) for p in args.input], []))
+    write_mel_shards(
+        input_shards,
+        args.output,
+        deepcopy(_MODEL_CONFIGS[args.amodel]["audio_cfg"]),
+        max_len=args.max_len,
+        data_filling=args.data_filling,
+        samples_per_shard=args.samples_per_shard,
+        store_waveform=args.store_waveform,
+    )
+
+
+if __name__ == "__main__":
+    main()
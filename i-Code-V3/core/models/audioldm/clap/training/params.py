@@ -62,7 +62,7 @@ def parse_args():
     )
     parser.add_argument(
         "--dataset-type",
-        choices=["webdataset", "csv", "auto", "toy"],
+        choices=["webdataset", "csv", "auto", "toy", "melshard"],
         default="auto",
         help="Which type of dataset to process.",
     )
@@ -253,6 +253,13 @@ def parse_args():
     parser.add_argument(
         "--zeroshot-frequency", type=int, default=2, help="How often to run zero shot."
     )
+    parser.add_argument(
+        "--zeroshot-index-dir",
+        type=str,
+        default=None,
+        help="Directory of the cached label embeddings of zero shot evaluation, "
+        "defaults to zero_shot_index in the checkpoint directory.",
+    )
     parser.add_argument(
         "--val-frequency",
         type=int,
@@ -441,6 +448,12 @@ def parse_args():
         action="store_true",
         help="Eval in parallel (multi-GPU, multi-node).",
     )
+    parser.add_argument(
+        "--eval-chunk-size",
+        type=int,
+        default=1024,
+        help="Number of retrieval queries scored at once during evaluation.",
+    )
 
     parser.add_argument(
         "--no-eval",
@@ -0,0 +1,259 @@
+"""
+Chunked, streaming retrieval metrics.
+
+The similarity matrix is never materialized: queries are scored against the
+    whole gallery one chunk at a time, and the rank of each ground truth item is
+    the number of gallery items scoring strictly higher than it. Memory stays
+    O(chunk_size x num_gallery) and no row is sorted.
+With world_size > 1 every rank scores its own contiguous range of queries
+    and the partial results are gathered in rank order.
+"""
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+
+def shard_range(num_queries, rank=0, world_size=1):
+    """
+    Contiguous [start, end) query range evaluated by rank.
+    """
+    per_rank = (num_queries + world_size - 1) // world_size
+    start = min(rank * per_rank, num_queries)
+    end = min(start + per_rank, num_queries)
+    return start, end
+
+
+def gather_shards(partial, world_size=1):
+    """
+    Gather a per-rank python object on every rank, in rank order. This is a
+        collective call, all ranks must make the same sequence of calls.
+    """
+    if world_size == 1:
+        return [partial]
+    gathered = [None for _ in range(world_size)]
+    dist.all_gather_object(gathered, partial)
+    return gathered
+
+
+def ground_truth_ranks(scores, gt_index):
+    """
+    :param scores: [C x N] similarities of C queries to the gallery.
+    :param gt_index: [C x G] gallery indices of the G ground truth items of
+        each query.
+    :return: [C x G] 0-based rank of every ground truth item.
+    """
+    gt_scores = scores.gather(1, gt_index)
+    ranks = [(scores > gt_scores[:, g:g+1]).sum(1) for g in range(gt_index.shape[1])]
+    return torch.stack(ranks, dim=1)
+
+
+def chunked_ranks(score_fn, gt_fn, num_queries, chunk_size=1024, rank=0, world_size=1,
+                  loss_fn=None):
+    """
+    Rank the ground truth of every query without building the full
+        similarity matrix.
+    :param score_fn: score_fn(start, end) -> [end-start x N] similarities of
+        queries start..end to the gallery.
+    :param gt_fn: gt_fn(start, end) -> [end-start x G] gallery indices of the
+        ground truth of queries start..end.
+    :param loss_fn: optional loss_fn(scores, start, end) -> summed loss of the
+        chunk, accumulated over all queries.
+    :return: ([num_queries x G] numpy ranks, summed loss or None)
+    """
+    start, end = shard_range(num_queries, rank, world_size)
+    ranks = []
+    loss = 0.0
+    with torch.no_grad():
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            scores = score_fn(chunk_start, chunk_end)
+            gt_index = gt_fn(chunk_start, chunk_end).to(scores.device)
+            ranks.append(ground_truth_ranks(scores, gt_index).cpu())
+            if loss_fn is not None:
+                loss += float(loss_fn(scores, chunk_start, chunk_end))
+    if len(ranks) > 0:
+        ranks = torch.cat(ranks).numpy()
+    else:
+        ranks = np.zeros((0, gt_fn(0, 0).shape[1]), dtype=np.int64)
+
+    shards = gather_shards((ranks, loss), world_size)
+    ranks = np.concatenate([r for r, _ in shards], axis=0)
+    loss = sum([l for _, l in shards]) if loss_fn is not None else None
+    return ranks, loss
+
+
+def rank_metrics(preds, name):
+    """
+    Metrics of single ground truth retrieval from 0-based ranks.
+    """
+    preds = np.asarray(preds).reshape(-1)
+    metrics = {}
+    metrics[f"{name}_mean_rank"] = preds.mean() + 1
+    metrics[f"{name}_median_rank"] = np.floor(np.median(preds)) + 1
+    for k in [1, 5, 10]:
+        metrics[f"{name}_R@{k}"] = np.mean(preds < k)
+    # map@10
+    metrics[f"{name}_mAP@10"] = np.mean(np.where(preds < 10, 1 / (preds + 1), 0.0))
+    return metrics
+
+
+def multi_caption_metrics(ranks, name):
+    """
+    Metrics of audio to text retrieval with several captions per audio: R@k
+        takes the best ranked caption, mAP@10 assigns descending ground truth
+        to the sorted caption ranks below 10.
+    :param ranks: [num_audio x num_captions] 0-based ranks.
+    """
+    metrics = {}
+    num_captions = ranks.shape[1]
+    sorted_ranks = np.sort(ranks, axis=1)
+    position = np.arange(1, num_captions + 1)[None]
+    map_all = np.where(sorted_ranks < 10, position / (sorted_ranks + 1), 0.0).sum(1) / num_captions
+    metrics[f"{name}_mAP@10"] = np.mean(map_all)
+    best = sorted_ranks[:, 0]
+    for k in [1, 5, 10]:
+        metrics[f"{name}_R@{k}"] = np.mean(best < k)
+    return metrics
+
+
+def _to(x, device):
+    return x if device is None else x.to(device)
+
+
+def pairwise_retrieval_metrics(
+    audio_features,
+    text_features,
+    logit_scale_a,
+    audio_features_mlp=None,
+    text_features_mlp=None,
+    logit_scale_t=None,
+    mlp_loss=False,
+    chunk_size=1024,
+    device=None,
+    rank=0,
+    world_size=1,
+):
+    """
+    Streaming version of the paired audio / text retrieval metrics, item i of
+        audio_features matches item i of text_features.
+    """
+    n = audio_features.shape[0]
+    audio_features = _to(audio_features, device)
+    text_features = _to(text_features, device)
+    logit_scale_a = _to(logit_scale_a, device)
+    if mlp_loss:
+        audio_features_mlp = _to(audio_features_mlp, device)
+        text_features_mlp = _to(text_features_mlp, device)
+        logit_scale_t = _to(logit_scale_t, device)
+
+    if mlp_loss:
+        # audio to text: rows of a_logits / t_logits, text to audio: their columns
+        def a2t_terms(start, end):
+            a = logit_scale_a * audio_features[start:end] @ text_features_mlp.t()
+            t = logit_scale_t * audio_features_mlp[start:end] @ text_features.t()
+            return a, t
+
+        def t2a_terms(start, end):
+            a = logit_scale_a * text_features_mlp[start:end] @ audio_features.t()
+            t = logit_scale_t * text_features[start:end] @ audio_features_mlp.t()
+            return a, t
+    else:
+        def a2t_terms(start, end):
+            return (logit_scale_a * audio_features[start:end] @ text_features.t(), )
+
+        def t2a_terms(start, end):
+            return (logit_scale_a * text_features[start:end] @ audio_features.t(), )
+
+    metrics = {}
+    total_loss = 0.0
+    for name, terms_fn in [("audio_to_text", a2t_terms), ("text_to_audio", t2a_terms)]:
+        cache = {}
+
+        def score_fn(start, end):
+            terms = terms_fn(start, end)
+            cache['terms'] = terms
+            return sum(terms) / len(terms)
+
+        def loss_fn(scores, start, end):
+            labels = torch.arange(start, end, device=scores.device)
+            return sum([F.cross_entropy(t.float(), labels, reduction='sum') for t in cache['terms']])
+
+        def gt_fn(start, end):
+            return torch.arange(start, end).view(-1, 1)
+
+        ranks, loss = chunked_ranks(
+            score_fn, gt_fn, n, chunk_size=chunk_size,
+            rank=rank, world_size=world_size, loss_fn=loss_fn)
+        total_loss += loss
+        metrics.update(rank_metrics(ranks[:, 0], name))
+
+    num_terms = 4 if mlp_loss else 2
+    result = {}
+    result["cumulative_loss"] = total_loss / n / num_terms
+    result["num_samples"] = n
+    result.update(metrics)
+    return result
+
+
+def multi_caption_retrieval_metrics(
+    audio_features,
+    text_features,
+    logit_scale_a,
+    num_captions=5,
+    chunk_size=1024,
+    device=None,
+    rank=0,
+    world_size=1,
+):
+    """
+    Streaming version of the Clotho / AudioCaps retrieval metrics, text
+        features hold num_captions consecutive captions per audio.
+    """
+    n = audio_features.shape[0]
+    assert text_features.shape[0] == n * num_captions
+    audio_features = _to(audio_features, device)
+    text_features = _to(text_features, device)
+    logit_scale_a = _to(logit_scale_a, device)
+
+    metrics = {}
+    metrics["num_samples"] = n
+
+    # text to audio, every caption is a query
+    def t2a_scores(start, end):
+        return logit_scale_a * text_features[start:end] @ audio_features.t()
+
+    def t2a_gt(start, end):
+        return (torch.arange(start, end) // num_captions).view(-1, 1)
+
+    def t2a_loss(scores, start, end):
+        labels = torch.arange(start, end, device=scores.device) // num_captions
+        return F.cross_entropy(scores.float(), labels, reduction='sum')
+
+    t2a_ranks, t2a_loss_sum = chunked_ranks(
+        t2a_scores, t2a_gt, n * num_captions, chunk_size=chunk_size,
+        rank=rank, world_size=world_size, loss_fn=t2a_loss)
+
+    # audio to text, the ground truth are the num_captions captions of the audio
+    def a2t_scores(start, end):
+        return logit_scale_a * audio_features[start:end] @ text_features.t()
+
+    def a2t_gt(start, end):
+        return torch.arange(start, end).view(-1, 1) * num_captions + torch.arange(num_captions)[None]
+
+    def a2t_loss(scores, start, end):
+        # cross entropy over the d-th caption of every audio, for each d
+        labels = torch.arange(start, end, device=scores.device)
+        scores = scores.float().view(scores.shape[0], n, num_captions)
+        return sum([F.cross_entropy(scores[:, :, d], labels, reduction='sum') for d in range(num_captions)])
+
+    a2t_ranks, a2t_loss_sum = chunked_ranks(
+        a2t_scores, a2t_gt, n, chunk_size=chunk_size,
+        rank=rank, world_size=world_size, loss_fn=a2t_loss)
+
+    total_loss = (a2t_loss_sum / (n * num_captions) + t2a_loss_sum / (n * num_captions)) / 2
+    metrics["cumulative_loss"] = total_loss
+    metrics.update(rank_metrics(t2a_ranks[:, 0], "text_to_audio"))
+    metrics.update(multi_caption_metrics(a2t_ranks, "audio_to_text"))
+    return metrics
@@ -16,6 +16,7 @@ except ImportError:
 
 from open_clip import ClipLoss, gather_features
 from .distributed import is_master
+from .retrieval import gather_shards, pairwise_retrieval_metrics, multi_caption_retrieval_metrics
 from .zero_shot import zero_shot_eval
 
 
@@ -63,7 +64,7 @@ def train_one_epoch(
     )
 
     dataloader, sampler = data["train"].dataloader, data["train"].sampler
-    if args.distributed and sampler is not None:
+    if (args.distributed or args.dataset_type == "melshard") and sampler is not None:
         sampler.set_epoch(epoch)
     num_batches_per_epoch = dataloader.num_batches
     sample_digits = math.ceil(math.log(dataloader.num_samples + 1, 10))
@@ -304,8 +305,8 @@ def evaluate(model, data, epoch, args, tb_writer=None):
         num_samples = 0
         samples_per_val = dataloader.num_samples
 
-        # FIXME this does not scale past small eval datasets
-        # all_audio_features @ all_text_features will blow up memory and compute very quickly
+        # the retrieval metrics are computed in query chunks, see retrieval.py.
+        # with parallel eval every rank keeps the gathered features and ranks its shard of the queries.
         eval_info = {}
         if args.clap_mlploss:
             eval_info["all"] = {
@@ -330,9 +331,12 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                 texts = batch["text"]
                 # audios = audios.to(device=device, non_blocking=True)
 
-                all_names = list(
-                    set(["-".join(b.split("/")[-3:-1]) for b in batch["__url__"]])
-                )
+                batch_names = ["-".join(b.split("/")[-3:-1]) for b in batch["__url__"]]
+                if args.parallel_eval:
+                    # the features are gathered below in rank order, gather the dataset names alike
+                    # so that every rank indexes the gathered features and sees the same datasets
+                    batch_names = sum(gather_shards(batch_names, args.world_size), [])
+                all_names = sorted(set(batch_names))
                 for name in all_names:
                     if name not in eval_info.keys():
                         if args.clap_mlploss:
@@ -393,7 +397,7 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                                 mlp_loss=args.clap_mlploss,
                             )
 
-                    if is_master(args):
+                    if is_master(args) or args.parallel_eval:
                         num_samples += audio_features.shape[0]
                         for n in [*all_names, "all"]:
                             if n == "all":
@@ -411,15 +415,7 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                                         text_features_mlp.cpu()
                                     )
                             else:
-                                idx = np.where(
-                                    np.array(
-                                        [
-                                            "-".join(b.split("/")[-3:-1])
-                                            for b in batch["__url__"]
-                                        ]
-                                    )
-                                    == n
-                                )[0]
+                                idx = np.where(np.array(batch_names) == n)[0]
                                 eval_info[n]["all_audio_features"].append(
                                     audio_features.cpu().index_select(
                                         0, torch.tensor(idx).long()
@@ -449,9 +445,16 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                     logging.info(
                         f"Eval Epoch: {epoch} [{num_samples} / {samples_per_val}]"
                     )
-            if is_master(args):
+            if is_master(args) or args.parallel_eval:
+                shard = {
+                    "chunk_size": args.eval_chunk_size,
+                    "device": device,
+                    "rank": args.rank if args.parallel_eval else 0,
+                    "world_size": args.world_size if args.parallel_eval else 1,
+                }
                 val_metrics_per_dataset = {}
-                for n in eval_info.keys():
+                # the metrics gather across ranks, all ranks have to go through the datasets in the same order
+                for n in sorted(eval_info.keys()):
                     if args.clap_mlploss:
                         metrics_single_dataset = get_metrics(
                             audio_features=torch.cat(
@@ -467,6 +470,7 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                             ),
                             logit_scale_t=logit_scale_t.cpu(),
                             mlp_loss=args.clap_mlploss,
+                            **shard,
                         )
                     else:
                         metrics_single_dataset = get_metrics(
@@ -476,13 +480,15 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                             text_features=torch.cat(eval_info[n]["all_text_features"]),
                             logit_scale_a=logit_scale_a.cpu(),
                             mlp_loss=args.clap_mlploss,
+                            **shard,
                         )
                     val_metrics_per_dataset[n] = {
                         n + "/" + k: v for k, v in metrics_single_dataset.items()
                     }
-                    metrics.update(val_metrics_per_dataset[n])
-                    if "epoch" not in metrics.keys():
-                        metrics.update({"epoch": epoch})
+                    if is_master(args):
+                        metrics.update(val_metrics_per_dataset[n])
+                        if "epoch" not in metrics.keys():
+                            metrics.update({"epoch": epoch})
     if is_master(args):
         if not metrics:
             return metrics
@@ -524,73 +530,30 @@ def get_metrics(
     text_features_mlp=None,
     logit_scale_t=None,
     mlp_loss=False,
+    chunk_size=1024,
+    device=None,
+    rank=0,
+    world_size=1,
 ):
-    metrics = {}
-    if mlp_loss:
-        # Set up audio to text & text to audio similary matrice
-        a_logits_per_audio = (
-            (logit_scale_a * audio_features @ text_features_mlp.t()).detach().cpu()
-        )
-        a_logits_per_text = a_logits_per_audio.t().detach().cpu()
-        t_logits_per_audio = (
-            (logit_scale_t * audio_features_mlp @ text_features.t()).detach().cpu()
-        )
-        t_logits_per_text = t_logits_per_audio.t().detach().cpu()
-
-        labels = torch.arange(audio_features.shape[0]).long()
-        # Change the loss from two terms into four terms with 2x2 combined CE loss
-        total_loss = (
-            F.cross_entropy(a_logits_per_audio, labels)
-            + F.cross_entropy(a_logits_per_text, labels)
-            + F.cross_entropy(t_logits_per_audio, labels)
-            + F.cross_entropy(t_logits_per_text, labels)
-        ) / 4
-
-        metrics[f"cumulative_loss"] = total_loss.item()
-        metrics[f"num_samples"] = audio_features.shape[0]
-
-        logits = {
-            "audio_to_text": (a_logits_per_audio + t_logits_per_audio) / 2,
-            "text_to_audio": (a_logits_per_text + t_logits_per_text) / 2,
-        }
-        ground_truth = torch.arange(len(text_features)).view(-1, 1)
-
-    else:
-        # print("text_features", text_features)
-        # print("text_features.shape", text_features.shape)
-        logits_per_audio = (
-            (logit_scale_a * audio_features @ text_features.t()).detach().cpu()
-        )
-        logits_per_text = logits_per_audio.t().detach().cpu()
-
-        labels = torch.arange(audio_features.shape[0]).long()
-        # Change the loss from two terms into four terms with 2x2 combined CE loss
-        total_loss = (
-            F.cross_entropy(logits_per_audio, labels)
-            + F.cross_entropy(logits_per_text, labels)
-        ) / 2
-
-        metrics[f"cumulative_loss"] = total_loss.item()
-        metrics[f"num_samples"] = audio_features.shape[0]
-
-        logits = {"audio_to_text": logits_per_audio, "text_to_audio": logits_per_text}
-
-        ground_truth = torch.arange(len(text_features)).view(-1, 1)
-
-    for name, logit in logits.items():
-        ranking = torch.argsort(logit, descending=True)
-        preds = torch.where(ranking == ground_truth)[
-            1
-        ]  # (yusong) this line is slow because it uses single thread
-        preds = preds.detach().cpu().numpy()
-        metrics[f"{name}_mean_rank"] = preds.mean() + 1
-        metrics[f"{name}_median_rank"] = np.floor(np.median(preds)) + 1
-        for k in [1, 5, 10]:
-            metrics[f"{name}_R@{k}"] = np.mean(preds < k)
-        # map@10
-        metrics[f"{name}_mAP@10"] = np.mean(np.where(preds < 10, 1 / (preds + 1), 0.0))
-
-    return metrics
+    """
+    Paired audio / text retrieval metrics. The logits are computed chunk_size
+    queries at a time on device, so memory stays O(chunk_size x num_samples).
+    With world_size > 1 every rank ranks its shard of the queries, all ranks
+    must call this and get the merged metrics.
+    """
+    return pairwise_retrieval_metrics(
+        audio_features=audio_features,
+        text_features=text_features,
+        logit_scale_a=logit_scale_a,
+        audio_features_mlp=audio_features_mlp,
+        text_features_mlp=text_features_mlp,
+        logit_scale_t=logit_scale_t,
+        mlp_loss=mlp_loss,
+        chunk_size=chunk_size,
+        device=device,
+        rank=rank,
+        world_size=world_size,
+    )
 
 
 def evaluate_clotho_audiocaps(
@@ -683,100 +646,23 @@ def evaluate_clotho_audiocaps(
             audio_features = torch.cat(eval_info[n]["all_audio_features"], dim=0)
             text_features = torch.cat(eval_info[n]["all_text_features"], dim=0)
 
-            logits_per_audio = (
-                (logit_scale_a * audio_features @ text_features.t()).detach().cpu()
-            )
-            logits_per_text = logits_per_audio.t().detach().cpu()
-
-            # logits_per_audio shape: [num_samples, num_samples*5]
-            # logits_per_text shape: [num_samples*5, num_samples]
-
             logging.info(
-                f"dataset {n}, logits_per_audio shape: {logits_per_audio.shape}, "
-                f"logits_per_text shape: {logits_per_text.shape}"
+                f"dataset {n}, audio_features shape: {audio_features.shape}, "
+                f"text_features shape: {text_features.shape}"
             )
 
-            metrics = {}
-            num_samples = audio_features.shape[0]
-            metrics[f"num_samples"] = num_samples
-
-            # (yusong) the following code is very important, please double-check:
-            # logits_per_audio.reshape(num_samples, num_samples, 5)[:, :, d]
-            # logits_per_text.reshape(num_samples, 5, num_samples)[:, d, :]
-            # Those two are retrieving one of the 5 text for each audio.
-            labels = torch.arange(audio_features.shape[0]).long()
-            audio_to_text_loss = [
-                F.cross_entropy(
-                    logits_per_audio.reshape(num_samples, num_samples, 5)[:, :, d],
-                    labels,
-                )
-                for d in range(5)
-            ]
-            text_to_audio_loss = [
-                F.cross_entropy(
-                    logits_per_text.reshape(num_samples, 5, num_samples)[:, d, :],
-                    labels,
-                )
-                for d in range(5)
-            ]
-            total_loss = (np.mean(audio_to_text_loss) + np.mean(text_to_audio_loss)) / 2
-
-            metrics[f"cumulative_loss"] = total_loss.item()
-
-            # text to audio: do 5 times
-            pred_text = []
-            for d in range(5):
-                logit = logits_per_text.reshape(num_samples, 5, num_samples)[:, d, :]
-                ground_truth = torch.arange(len(logit)).view(-1, 1)
-                ranking = torch.argsort(
-                    logit, descending=True
-                )  # [num_samples, num_samples]
-                preds = torch.where(ranking == ground_truth)[1]
-                pred_text.append(preds.detach().cpu().numpy())
-            pred_text_concat = np.concatenate(pred_text, axis=0)  # [5*num_samples]
-            metrics[f"text_to_audio_mean_rank"] = pred_text_concat.mean() + 1
-            metrics[f"text_to_audio_median_rank"] = (
-                np.floor(np.median(pred_text_concat)) + 1
-            )
-            for k in [1, 5, 10]:
-                metrics[f"text_to_audio_R@{k}"] = np.mean(pred_text_concat < k)
-            # map@10
-            metrics[f"text_to_audio_mAP@10"] = np.mean(
-                np.where(pred_text_concat < 10, 1 / (pred_text_concat + 1), 0.0)
-            )
-
-            # audio to text: take the best result
-            # for audio to text map 10, sort and assign descending ground truth.
+            # text to audio: every one of the 5 captions is a query, ranks are averaged.
+            # audio to text: R@k takes the best rank among the 5 captions, for map@10
+            # the caption ranks are sorted and assigned descending ground truth,
             # see https://github.com/XinhaoMei/audio-text_retrieval/blob/main/tools/utils.py#L103
-            # map@10
-            map_all = []
-            pred_audio_all = []
-            for d in range(num_samples):
-                # logits_per_audio: [num_samples, num_samples*5]
-                logit_single = logits_per_audio[d, :]  # [5*num_samples]
-                # Ground-truth index: [d*5, d*5+1, d*5+2, d*5+3, d*5+4]
-                ranking = torch.argsort(
-                    logit_single, descending=True
-                )  # [5*num_samples]
-                # ranking: the index of first match, second match, ...
-                ground_truth = torch.arange(d * 5, d * 5 + 5)[None]
-                all_pred = torch.where(
-                    torch.stack([ranking] * 5) == ground_truth.view(-1, 1)
-                )[1]
-                min_pred = torch.min(all_pred)
-                pred_audio_all.append(min_pred.detach().cpu().numpy())
-                all_pred_filter = all_pred[all_pred < 10].detach().cpu().numpy()
-                # /5 because we have 5 text, so it means for the text rank >=10 we count as 0.
-                map_single = (
-                    np.sum(
-                        (np.arange(1, len(all_pred_filter) + 1) / (all_pred_filter + 1))
-                    )
-                    / 5
-                )
-                map_all.append(map_single)
-            metrics[f"audio_to_text_mAP@10"] = np.mean(map_all)
-            for k in [1, 5, 10]:
-                metrics[f"audio_to_text_R@{k}"] = np.mean(np.array(pred_audio_all) < k)
+            metrics = multi_caption_retrieval_metrics(
+                audio_features=audio_features,
+                text_features=text_features,
+                logit_scale_a=logit_scale_a,
+                num_captions=5,
+                chunk_size=args.eval_chunk_size,
+                device=device,
+            )
 
             val_metrics_all[n] = {n + "/" + k: v for k, v in metrics.items()}
     return val_metrics_all
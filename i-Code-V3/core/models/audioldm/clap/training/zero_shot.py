@@ -1,95 +1,100 @@
-# NOTE: This script is currently not supported for CLAP.
+"""
+Zero-shot audio classification of the val data against the labels of
+    args.class_index_dict.
+
+The template averaged text embeddings of the labels are kept in an
+    EmbeddingIndex, rebuilt only when the text side of the model changes, so
+    an evaluation costs one audio forward and one matmul against the cached
+    text embeddings per batch. It runs a full pass over the val data on the
+    master process only, so it is meant for fixed checkpoints; the training
+    evaluate does not call it.
+"""
 import logging
+import os
 from contextlib import suppress
 
 import torch
-import torch.nn.functional as F
 from tqdm import tqdm
 
-from open_clip import tokenize
-from .imagenet_zeroshot_data import imagenet_classnames, openai_imagenet_template
+from .data import tokenizer
+from .distributed import is_master
+from .embedding_index import (
+    TEXT_EMBEDDING_PARAMS, EmbeddingIndex, keys_fingerprint, model_fingerprint, text_embed_fn)
 
+ZERO_SHOT_TEMPLATES = ["This is a sound of {}."]
 
-def zero_shot_classifier(model, classnames, templates, args):
-    with torch.no_grad():
-        zeroshot_weights = []
-        for classname in tqdm(classnames):
-            texts = [template(classname) for template in templates]  # format with class
-            texts = tokenize(texts).to(args.device)  # tokenize
-            if args.distributed and not args.horovod:
-                class_embeddings = model.module.encode_text(texts)
-            else:
-                class_embeddings = model.encode_text(texts)
-            class_embedding = F.normalize(class_embeddings, dim=-1).mean(dim=0)
-            class_embedding /= class_embedding.norm()
-            zeroshot_weights.append(class_embedding)
-        zeroshot_weights = torch.stack(zeroshot_weights, dim=1).to(args.device)
-    return zeroshot_weights
-
-
-def accuracy(output, target, topk=(1,)):
-    pred = output.topk(max(topk), 1, True, True)[1].t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
-    return [
-        float(correct[:k].reshape(-1).float().sum(0, keepdim=True).cpu().numpy())
-        for k in topk
-    ]
-
-
-def run(model, classifier, dataloader, args):
+
+def zero_shot_index_root(args):
+    if getattr(args, "zeroshot_index_dir", None):
+        return args.zeroshot_index_dir
+    return os.path.join(getattr(args, "checkpoint_path", "") or ".", "zero_shot_index")
+
+
+def zero_shot_index(model, classnames, args, templates=ZERO_SHOT_TEMPLATES):
+    """
+    Index of the normalized text embeddings of classnames, opened from disk if
+        it was built by the same text weights and templates, rebuilt otherwise.
+    """
+    fingerprint = model_fingerprint(model, TEXT_EMBEDDING_PARAMS) + keys_fingerprint(templates)
+    return EmbeddingIndex.get_or_build(
+        zero_shot_index_root(args), classnames, text_embed_fn(model, tokenizer, templates),
+        fingerprint, device=args.device, in_memory=True)
+
+
+def accuracy(logits, class_label, topk=(1,)):
+    """
+    Number of samples whose k best scored classes contain one of their labels.
+    """
+    pred = logits.topk(max(topk), 1, True, True)[1]
+    hits = class_label.gather(1, pred) > 0
+    return [float(hits[:, :k].any(1).sum()) for k in topk]
+
+
+def run(model, index, dataloader, args):
     autocast = torch.cuda.amp.autocast if args.precision == "amp" else suppress
+    device = torch.device(args.device)
     with torch.no_grad():
         top1, top5, n = 0.0, 0.0, 0.0
-        for images, target in tqdm(dataloader, unit_scale=args.batch_size):
-            images = images.to(args.device)
-            target = target.to(args.device)
+        for batch in tqdm(dataloader, unit_scale=args.batch_size):
+            class_label = batch["class_label"].to(device)
 
             with autocast():
-                # predict
-                if args.distributed and not args.horovod:
-                    image_features = model.module.encode_image(images)
-                else:
-                    image_features = model.encode_image(images)
-                image_features = F.normalize(image_features, dim=-1)
-                logits = 100.0 * image_features @ classifier
-
-            # measure accuracy
-            acc1, acc5 = accuracy(logits, target, topk=(1, 5))
+                audio_features = model.audio_projection(
+                    model.encode_audio(batch, device=device)["embedding"]
+                )
+            # normalized and scored against every label in one matmul
+            logits = index.classify(audio_features)
+
+            acc1, acc5 = accuracy(logits, class_label, topk=(1, 5))
             top1 += acc1
             top5 += acc5
-            n += images.size(0)
+            n += class_label.shape[0]
 
-    top1 = top1 / n
-    top5 = top5 / n
+    top1 = top1 / max(n, 1)
+    top5 = top5 / max(n, 1)
     return top1, top5
 
 
 def zero_shot_eval(model, data, epoch, args):
-    if "imagenet-val" not in data and "imagenet-v2" not in data:
+    if "val" not in data or not getattr(args, "class_index_dict", None):
         return {}
     if args.zeroshot_frequency == 0:
         return {}
     if (epoch % args.zeroshot_frequency) != 0 and epoch != args.epochs:
         return {}
-
-    logging.info("Starting zero-shot imagenet.")
-
-    logging.info("Building zero-shot classifier")
-    classifier = zero_shot_classifier(
-        model, imagenet_classnames, openai_imagenet_template, args
-    )
-
-    logging.info("Using classifier")
-    results = {}
-    if "imagenet-val" in data:
-        top1, top5 = run(model, classifier, data["imagenet-val"].dataloader, args)
-        results["imagenet-zeroshot-val-top1"] = top1
-        results["imagenet-zeroshot-val-top5"] = top5
-    if "imagenet-v2" in data:
-        top1, top5 = run(model, classifier, data["imagenet-v2"].dataloader, args)
-        results["imagenetv2-zeroshot-val-top1"] = top1
-        results["imagenetv2-zeroshot-val-top5"] = top5
-
-    logging.info("Finished zero-shot imagenet.")
-
-    return results
+    # the index is written by a single process
+    if not is_master(args):
+        return {}
+    if args.distributed and not args.horovod:
+        model = model.module
+
+    logging.info("Starting zero-shot classification.")
+    classnames = sorted(args.class_index_dict, key=args.class_index_dict.get)
+    index = zero_shot_index(model, classnames, args)
+    top1, top5 = run(model, index, data["val"].dataloader, args)
+    logging.info("Finished zero-shot classification.")
+
+    return {
+        "zeroshot-val-top1": top1,
+        "zeroshot-val-top5": top5,
+    }
@@ -0,0 +1,274 @@
+"""
+Policy based activation checkpointing for the VD U-Nets.
+
+Instead of the per-module use_checkpoint flags set from config, a policy picks
+    which blocks recompute their activations in the backward pass. Blocks can
+    be selected by type and stage, or from an activation memory budget using a
+    per-block activation size estimate.
+
+    blocks = find_checkpointable_blocks(unet)
+    estimate_activation_bytes(blocks, lambda: unet(x, t, c, xtype, ctype, mix_weight))
+    selected = select_by_budget(blocks, batch_size=8, budget_bytes=20 * 2**30)
+    apply_checkpoint_policy(blocks, selected)
+"""
+
+import torch
+
+from .openaimodel import ResBlock, FCBlock, AttentionBlock, ConnectorOut
+from .attention import BasicTransformerBlock
+from .make_a_video_pytorch import SpatioTemporalAttention
+
+# block class -> name of its checkpoint flag
+CHECKPOINT_FLAGS = {
+    ResBlock : 'use_checkpoint',
+    FCBlock : 'use_checkpoint',
+    ConnectorOut : 'use_checkpoint',
+    AttentionBlock : 'use_checkpoint',
+    BasicTransformerBlock : 'checkpoint',
+    SpatioTemporalAttention : 'use_checkpoint',
+}
+
+STAGES = ['connector', 'input', 'middle', 'output']
+
+
+def _flag_name(module):
+    for class_, flag in CHECKPOINT_FLAGS.items():
+        if isinstance(module, class_):
+            return flag
+    return None
+
+
+def _stage_and_index(name):
+    parts = name.split('.')
+    for i, part in enumerate(parts):
+        if part in ['connecters_out', 'input_block_connecters_in', 'output_block_connecters_in']:
+            return 'connector', int(parts[i+1])
+        elif part == 'input_blocks':
+            return 'input', int(parts[i+1])
+        elif part == 'middle_block':
+            return 'middle', 0
+        elif part == 'output_blocks':
+            return 'output', int(parts[i+1])
+    return None, None
+
+
+class CheckpointBlock(object):
+    """
+    One checkpointable block.
+    :param name: the module name inside the model.
+    :param module: the module.
+    :param stage: one of STAGES.
+    :param index: the block index inside its stage.
+    Checkpointable modules inside the block are kept in nested, checkpointing
+        the block recomputes them as well.
+    """
+    def __init__(self, name, module, stage, index):
+        self.name = name
+        self.module = module
+        self.stage = stage
+        self.index = index
+        self.type = module.__class__.__name__
+        self.flag = _flag_name(module)
+        self.nested = []
+        # filled by estimate_activation_bytes, per sample of batch
+        self.activation_bytes = None
+        self.input_bytes = None
+
+    @property
+    def enabled(self):
+        return bool(getattr(self.module, self.flag))
+
+    def set(self, enabled):
+        setattr(self.module, self.flag, enabled)
+
+    def __repr__(self):
+        return '{}({}, {}[{}])'.format(self.type, self.name, self.stage, self.index)
+
+
+def find_checkpointable_blocks(model):
+    """
+    List the outermost checkpointable blocks of model, covering unet_image,
+        unet_text, unet_audio and their connector modules. Checkpointable
+        modules inside a listed block (e.g. the temporal attention of a
+        ConnectorOut) go to its nested list, so no activation is counted twice.
+    """
+    blocks = []
+    for name, module in model.named_modules():
+        if _flag_name(module) is None:
+            continue
+        stage, index = _stage_and_index(name)
+        if stage is None:
+            continue
+        block = CheckpointBlock(name, module, stage, index)
+        # named_modules is depth first, descendants follow their ancestor
+        if blocks and name.startswith(blocks[-1].name + '.'):
+            blocks[-1].nested.append(block)
+        else:
+            blocks.append(block)
+    return blocks
+
+
+def _numel(shape):
+    n = 1
+    for si in shape:
+        n *= si
+    return n
+
+
+def _estimate_elements(block, shapes):
+    """
+    Number of activation elements kept for backward by one block, per sample.
+        The factors count the tensors autograd saves in the block's forward.
+    """
+    module = block.module
+    in_shape, out_shape = shapes['input'], shapes['output']
+    batch = in_shape[0]
+    n_in = _numel(in_shape) / batch
+    n_out = _numel(out_shape) / batch
+
+    if isinstance(module, (ResBlock, FCBlock, ConnectorOut)):
+        # norm, silu and conv inputs on both halves plus the residual sum
+        return 2 * n_in + 6 * n_out
+    elif isinstance(module, AttentionBlock):
+        tokens = _numel(in_shape[2:])
+        return 6 * n_in + 2 * module.num_heads * tokens * tokens
+    elif isinstance(module, BasicTransformerBlock):
+        tokens = in_shape[1]
+        heads = module.attn1.heads
+        context_tokens = shapes.get('context', in_shape)[1]
+        attn = 2 * heads * tokens * (tokens + context_tokens)
+        # qkv / out projections of both attentions, three norms and GEGLU ff
+        return 30 * n_in + attn
+    elif isinstance(module, SpatioTemporalAttention):
+        if len(in_shape) != 5:
+            return 0
+        frames = in_shape[2]
+        sequences = _numel(in_shape[3:])
+        heads = module.temporal_attn.heads
+        attn = 2 * heads * sequences * frames * frames
+        return 25 * n_in + attn
+    return 2 * n_in + 2 * n_out
+
+
+def estimate_activation_bytes(blocks, probe_fn):
+    """
+    Record the input / output shapes of every block by running probe_fn (a
+        forward pass of the model, any batch size) and fill in the per-sample
+        activation size estimate of each block, including its nested blocks.
+    """
+    shapes = {}
+    handles = []
+
+    def make_hook(block):
+        def hook(module, inputs, output):
+            x = inputs[0]
+            entry = shapes.setdefault(block.name, {})
+            entry['input'] = tuple(x.shape)
+            entry['output'] = tuple(output.shape)
+            entry['itemsize'] = x.element_size()
+        return hook
+
+    def make_context_hook(block):
+        def hook(module, inputs, output):
+            shapes.setdefault(block.name, {})['context'] = tuple(inputs[0].shape)
+        return hook
+
+    all_blocks = blocks + [inner for block in blocks for inner in block.nested]
+    for block in all_blocks:
+        handles.append(block.module.register_forward_hook(make_hook(block)))
+        if isinstance(block.module, BasicTransformerBlock):
+            handles.append(block.module.attn2.to_k.register_forward_hook(make_context_hook(block)))
+
+    try:
+        with torch.no_grad():
+            probe_fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    for block in all_blocks:
+        if block.name not in shapes or 'input' not in shapes[block.name]:
+            # block not visited by the probe, e.g. an unused modality
+            block.activation_bytes = 0
+            block.input_bytes = 0
+            continue
+        entry = shapes[block.name]
+        batch = entry['input'][0]
+        block.activation_bytes = int(_estimate_elements(block, entry) * entry['itemsize'])
+        block.input_bytes = int(_numel(entry['input']) / batch * entry['itemsize'])
+    for block in blocks:
+        block.activation_bytes += sum([inner.activation_bytes for inner in block.nested])
+    return blocks
+
+
+def select_by_type(blocks, block_types=None, stages=None, indices=None):
+    """
+    Select blocks by class name, stage and block index within the stage,
+        None means no restriction.
+    """
+    selected = []
+    for block in blocks:
+        if block_types is not None and block.type not in block_types:
+            continue
+        if stages is not None and block.stage not in stages:
+            continue
+        if indices is not None and block.index not in indices:
+            continue
+        selected.append(block)
+    return selected
+
+
+def select_by_budget(blocks, batch_size, budget_bytes):
+    """
+    Choose the blocks to checkpoint so that the estimated activation memory of
+        a batch fits into budget_bytes. Blocks saving the most memory are
+        checkpointed first, a checkpointed block still keeps its input.
+    :return: the selected blocks and the estimated activation bytes.
+    """
+    assert all([b.activation_bytes is not None for b in blocks]), \
+        'Run estimate_activation_bytes first.'
+    total = sum([b.activation_bytes for b in blocks]) * batch_size
+    order = sorted(blocks, key=lambda b: b.activation_bytes - b.input_bytes, reverse=True)
+    selected = []
+    for block in order:
+        if total <= budget_bytes:
+            break
+        saving = (block.activation_bytes - block.input_bytes) * batch_size
+        if saving <= 0:
+            break
+        selected.append(block)
+        total -= saving
+    return selected, total
+
+
+def apply_checkpoint_policy(blocks, selected):
+    """
+    Turn checkpointing on for the selected blocks and off for all other blocks.
+        Nested blocks are turned off, a checkpointed block recomputes them
+        already and the estimates count them as stored otherwise.
+    """
+    selected = set([b.name for b in selected])
+    for block in blocks:
+        block.set(block.name in selected)
+        for inner in block.nested:
+            inner.set(False)
+
+
+def summarize(blocks, batch_size=1):
+    """
+    Estimated activation memory per stage and block type, in bytes, split into
+        the checkpointed and the stored part.
+    """
+    summary = {}
+    for block in blocks:
+        if block.activation_bytes is None:
+            continue
+        key = (block.stage, block.type)
+        entry = summary.setdefault(key, {'blocks': 0, 'checkpointed': 0, 'stored': 0})
+        entry['blocks'] += 1
+        if block.enabled:
+            entry['checkpointed'] += 1
+            entry['stored'] += block.input_bytes * batch_size
+        else:
+            entry['stored'] += block.activation_bytes * batch_size
+    return summary
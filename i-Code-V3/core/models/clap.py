@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 from core.models.audioldm.clap.open_clip import create_model
-from core.models.audioldm.clap.training.data import get_audio_features
+from core.models.audioldm.clap.training.data import get_audio_features, fill_audio
 import torchaudio
 from transformers import RobertaTokenizer
 import torch.nn.functional as F
@@ -23,6 +23,9 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         num_layers=12,
         depths=[2, 2, 6, 2],
         amodel="HTSAT-tiny",
+        long_audio_pooling=None,
+        long_audio_hop=240000,
+        long_audio_max_windows=64,
     ):
         super().__init__()
 
@@ -42,6 +45,11 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         self.joint_embed_shape = joint_embed_shape
         self.max_random_mute_portion = max_random_mute_portion
         self.training_mode = training_mode
+        # None keeps the random fusion crop, 'mean' / 'attention' / 'max' pool
+        # the embeddings of windows sliding over the whole waveform
+        self.long_audio_pooling = long_audio_pooling
+        self.long_audio_hop = long_audio_hop
+        self.long_audio_max_windows = long_audio_max_windows
         self.model, self.model_cfg = create_model(
             self.amodel,
             self.tmodel,
@@ -90,16 +98,87 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         # waveform: [bs, t_steps]
         with torch.no_grad():
             self.embed_mode = "audio"
-            audio_emb = self(waveform.cuda())
+            audio_emb = self(waveform.to(next(self.model.parameters()).device))
             self.embed_mode = "text"
             text_emb = self(text)
             similarity = F.cosine_similarity(audio_emb, text_emb, dim=2)
             return similarity.squeeze()
 
+    def split_windows(self, waveform, window=480000, hop=240000):
+        """
+        Deterministically cover a 48kHz waveform with windows of window
+        samples every hop samples, the last window ends at the end of the
+        waveform. Waveforms shorter than a window are repeat padded.
+        """
+        if len(waveform) <= window:
+            return fill_audio(waveform, window, "repeatpad")[None]
+        starts = list(range(0, len(waveform) - window + 1, hop))
+        if starts[-1] + window < len(waveform):
+            starts.append(len(waveform) - window)
+        return torch.stack([waveform[i : i + window] for i in starts])
+
+    def pool_windows(self, embed, pooling="mean"):
+        """
+        Pool [num_windows x D] normalized window embeddings into one.
+        'attention' weights every window by its agreement with the mean
+        embedding, down-weighting outlier windows such as silence.
+        """
+        if pooling == "mean":
+            pooled = embed.mean(0)
+        elif pooling == "max":
+            pooled = embed.max(0)[0]
+        elif pooling == "attention":
+            query = F.normalize(embed.mean(0), dim=-1)
+            scale = self.model.logit_scale_a.exp()
+            weights = torch.softmax(scale * embed @ query, dim=0)
+            pooled = (weights[:, None] * embed).sum(0)
+        else:
+            raise ValueError("Unknown long audio pooling {}.".format(pooling))
+        return F.normalize(pooled, dim=-1)
+
+    def get_long_audio_embedding(self, waveforms, pooling="mean", hop=None):
+        """
+        Embed a list of 48kHz waveforms of any length. The windows of all
+        waveforms go through HTSAT together, long_audio_max_windows at a time.
+        :return: [bs, D] pooled embeddings.
+        """
+        hop = self.long_audio_hop if hop is None else hop
+        truncating = "fusion" if self.enable_fusion else "rand_trunc"
+        windows, owners = [], []
+        for i, waveform in enumerate(waveforms):
+            for window in self.split_windows(waveform, 480000, hop):
+                # windows are exactly max_len long, so no random crop happens
+                windows.append(get_audio_features(
+                    {}, window, 480000,
+                    data_truncating=truncating,
+                    data_filling="repeatpad",
+                    audio_cfg=self.model_cfg["audio_cfg"],
+                ))
+                owners.append(i)
+
+        embed = torch.cat([
+            self.model.get_audio_embedding(windows[j : j + self.long_audio_max_windows])
+            for j in range(0, len(windows), self.long_audio_max_windows)
+        ])
+        owners = torch.tensor(owners, device=embed.device)
+        return torch.stack([
+            self.pool_windows(embed[owners == i], pooling) for i in range(len(waveforms))
+        ])
+
     def forward(self, batch, key=None):
 
+        if self.embed_mode == "audio" and self.long_audio_pooling is not None:
+            assert (
+                self.sampling_rate == 16000
+            ), "We only support 16000 sampling rate"
+            batch = torchaudio.functional.resample(
+                batch, orig_freq=self.sampling_rate, new_freq=48000
+            )
+            waveforms = [waveform.reshape(-1) for waveform in self.batch_to_list(batch)]
+            embed = self.get_long_audio_embedding(waveforms, pooling=self.long_audio_pooling)
+
         # the 'fusion' truncate mode can be changed to 'rand_trunc' if run in unfusion mode
-        if self.embed_mode == "audio":
+        elif self.embed_mode == "audio":
             audio_dict_list = []
             assert (
                 self.sampling_rate == 16000
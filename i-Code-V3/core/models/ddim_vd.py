@@ -8,7 +8,9 @@ import numpy as np
 from tqdm import tqdm
 from functools import partial
 
-from .diffusion_utils import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+from .diffusion_utils import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
+    make_feature_cache_schedule
+from .openaimodel import FeatureCache
 
 from .ddim import DDIMSampler
 
@@ -27,7 +29,13 @@ class DDIMSampler_VD(DDIMSampler):
                mix_weight=None,
                noise_dropout=0.,
                verbose=True,
-               log_every_t=100,):
+               log_every_t=100,
+               cache_interval=1,
+               cache_depth=1,
+               cache_schedule='uniform',
+               condition_mask=None,
+               audio_window=None,
+               audio_overlap=64,):
 
         self.make_schedule(ddim_num_steps=steps, ddim_eta=eta, verbose=verbose)
         print(f'Data shape for DDIM sampling is {shape}, eta {eta}')
@@ -42,7 +50,13 @@ class DDIMSampler_VD(DDIMSampler):
             noise_dropout=noise_dropout,
             temperature=temperature,
             log_every_t=log_every_t,
-            mix_weight=mix_weight,)
+            mix_weight=mix_weight,
+            cache_interval=cache_interval,
+            cache_depth=cache_depth,
+            cache_schedule=cache_schedule,
+            condition_mask=condition_mask,
+            audio_window=audio_window,
+            audio_overlap=audio_overlap,)
         return samples, intermediates
 
     @torch.no_grad()
@@ -58,7 +72,19 @@ class DDIMSampler_VD(DDIMSampler):
                       noise_dropout=0., 
                       temperature=1.,
                       mix_weight=None,
-                      log_every_t=100,):
+                      log_every_t=100,
+                      cache_interval=1,
+                      cache_depth=1,
+                      cache_schedule='uniform',
+                      condition_mask=None,
+                      audio_window=None,
+                      audio_overlap=64,):
+        """
+        :param audio_window: if set and the audio latent is longer than
+            audio_window frames, the audio is denoised as overlapping windows
+            of audio_window frames that are crossfaded over audio_overlap
+            frames at every step, see LatentWindows.
+        """
 
         device = self.model.device
         dtype = condition[0][0].dtype
@@ -84,11 +110,34 @@ class DDIMSampler_VD(DDIMSampler):
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         # print(f"Running DDIM Sampling with {total_steps} timesteps")
 
+        if cache_interval > 1:
+            feature_cache = FeatureCache(depth=cache_depth)
+            cache_refresh = make_feature_cache_schedule(total_steps, cache_interval, cache_schedule)
+        else:
+            feature_cache = None
+
+        windows = None
+        if audio_window is not None and 'audio' in xtype:
+            audio_len = xt[xtype.index('audio')].shape[2]
+            if audio_len > audio_window:
+                windows = LatentWindows(audio_len, audio_window, audio_overlap)
+
+        # the packed batch layout is the same for all steps
+        if windows is None:
+            packed = pack_guidance_batch(
+                condition, bs, unconditional_guidance_scale, condition_mask, mix_weight, condition_types)
+        else:
+            packed = pack_guidance_batch(
+                *windows.expand_guidance(condition, bs, unconditional_guidance_scale, condition_mask, mix_weight),
+                condition_types)
+
         pred_xt = xt
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
             ts = torch.full((bs,), step, device=device, dtype=torch.long)
+            if feature_cache is not None:
+                feature_cache.refresh = bool(cache_refresh[i])
 
             outs = self.p_sample_ddim(
                 pred_xt, 
@@ -100,7 +149,11 @@ class DDIMSampler_VD(DDIMSampler):
                 use_original_steps=ddim_use_original_steps,
                 noise_dropout=noise_dropout,
                 temperature=temperature,
-                mix_weight=mix_weight,)
+                mix_weight=mix_weight,
+                feature_cache=feature_cache,
+                condition_mask=condition_mask,
+                packed=packed,
+                windows=windows,)
             pred_xt, pred_x0 = outs
 
             if index % log_every_t == 0 or index == total_steps - 1:
@@ -120,56 +173,219 @@ class DDIMSampler_VD(DDIMSampler):
                       use_original_steps=False, 
                       noise_dropout=0.,
                       temperature=1.,
-                      mix_weight=None,):
-
+                      mix_weight=None,
+                      feature_cache=None,
+                      condition_mask=None,
+                      packed=None,
+                      windows=None,):
+        """
+        :param condition: list with one tensor per condition type, either
+            [2B x ...] (unconditional rows first) or [B x ...] when no row
+            needs guidance.
+        :param unconditional_guidance_scale: float or per-row [B] scales.
+        :param condition_mask: optional [B x num_conditions] mask of the
+            conditions present in each row, absent conditions use their
+            unconditional embedding.
+        :param packed: the output of pack_guidance_batch, rebuilt if None.
+        :param windows: optional LatentWindows splitting the audio latent.
+        """
         b, *_, device = *x[0].shape, x[0].device
+        x_model, t_model, b_model = x, t, b
+        if windows is not None:
+            x_model = windows.split(x, xtype)
+            t_model = t.repeat(windows.num_windows)
+            b_model = b * windows.num_windows
+        if packed is None:
+            if windows is None:
+                packed = pack_guidance_batch(
+                    condition, b, unconditional_guidance_scale, condition_mask, mix_weight, condition_types)
+            else:
+                packed = pack_guidance_batch(
+                    *windows.expand_guidance(condition, b, unconditional_guidance_scale, condition_mask, mix_weight),
+                    condition_types)
+        guided, scale = packed['guided'], packed['scale']
 
-        x_in = []
-        for x_i in x:
-            x_in.append(torch.cat([x_i] * 2))
-        t_in = torch.cat([t] * 2)
-        
+        # every row once with its conditions, guided rows again unconditioned
+        x_in = [torch.cat([x_i, x_i[guided]]) for x_i in x_model]
+        t_in = torch.cat([t_model, t_model[guided]])
         out = self.model.model.diffusion_model(
-            x_in, t_in, condition, xtype=xtype, condition_types=condition_types, mix_weight=mix_weight)
+            x_in, t_in, packed['condition'], xtype=xtype, condition_types=condition_types,
+            mix_weight=mix_weight, feature_cache=feature_cache,
+            condition_weights=packed['weights'])
+
         e_t = []
         for out_i in out:
-            e_t_uncond_i, e_t_i = out_i.chunk(2)
-            e_t_i = e_t_uncond_i + unconditional_guidance_scale * (e_t_i - e_t_uncond_i)
-            e_t_i = e_t_i.to(device)
-            e_t.append(e_t_i)
+            e_t_i, e_t_uncond_i = out_i[:b_model], out_i[b_model:]
+            if len(guided) > 0:
+                s_i = scale.to(out_i).view(-1, *([1] * (out_i.ndim - 1)))
+                e_t_guided = e_t_uncond_i + s_i * (e_t_i[guided] - e_t_uncond_i)
+                e_t_i = e_t_i.index_copy(0, guided, e_t_guided)
+            e_t.append(e_t_i.to(device))
+        if windows is not None:
+            e_t = windows.merge(e_t, xtype)
 
         alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
         alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
         sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
         sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
-        # select parameters corresponding to the currently considered timestep
+        # select parameters corresponding to the currently considered timestep,
+        # all rows and modalities share the step so plain scalars broadcast
+        a_t = float(alphas[index])
+        a_prev = float(alphas_prev[index])
+        sigma_t = float(sigmas[index])
+        sqrt_one_minus_at = float(sqrt_one_minus_alphas[index])
 
         x_prev = []
         pred_x0 = []
-        device = x[0].device
-        dtype = x[0].dtype
         for i, xtype_i in enumerate(xtype):
-            if xtype_i == 'image':
-                extended_shape = (b, 1, 1, 1)
-            elif xtype_i == 'video':
-                extended_shape = (b, 1, 1, 1, 1)        
-            elif xtype_i == 'text':
-                extended_shape = (b, 1)
-            elif xtype_i == 'audio':
-                extended_shape = (b, 1, 1, 1)    
-
-            a_t = torch.full(extended_shape, alphas[index], device=device, dtype=dtype)
-            a_prev = torch.full(extended_shape, alphas_prev[index], device=device, dtype=dtype)
-            sigma_t = torch.full(extended_shape, sigmas[index], device=device, dtype=dtype)
-            sqrt_one_minus_at = torch.full(extended_shape, sqrt_one_minus_alphas[index], device=device, dtype=dtype)
-
             # current prediction for x_0
-            pred_x0_i = (x[i] - sqrt_one_minus_at * e_t[i]) / a_t.sqrt()
-            dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t[i]
+            pred_x0_i = (x[i] - sqrt_one_minus_at * e_t[i]) / a_t ** 0.5
+            dir_xt = (1. - a_prev - sigma_t**2) ** 0.5 * e_t[i]
             noise = sigma_t * noise_like(x[i], repeat_noise) * temperature
             if noise_dropout > 0.:
                 noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev_i = a_prev.sqrt() * pred_x0_i + dir_xt + noise
+            x_prev_i = a_prev ** 0.5 * pred_x0_i + dir_xt + noise
             x_prev.append(x_prev_i)
             pred_x0.append(pred_x0_i)
-        return x_prev, pred_x0
\ No newline at end of file
+        return x_prev, pred_x0
+
+
+def pack_guidance_batch(condition, batch_size, guidance_scale, condition_mask, mix_weight, condition_types):
+    """
+    Pack a batch with per-row guidance into one forward. Row r of the packed
+        batch (r < batch_size) carries the conditions of row r, the rows after
+        batch_size are unconditional copies of the rows needing guidance, i.e.
+        rows with a scale != 1 and at least one condition present.
+    :param condition: list of [2B x ...] (unconditional first) or [B x ...]
+        condition tensors.
+    :param guidance_scale: float or [B] per-row scales.
+    :param condition_mask: None (all conditions present) or [B x C] mask.
+    :param mix_weight: dict condition type -> weight, or [B x C] per-row
+        weights in the order of condition_types.
+    :return: dict with the packed condition list, the [B + G x C] per-row
+        condition weights, the [G] guided row indices and their [G] scales.
+    """
+    device = condition[0].device
+    num_conditions = len(condition)
+    if condition_mask is None:
+        condition_mask = torch.ones(batch_size, num_conditions, dtype=torch.bool, device=device)
+    condition_mask = torch.as_tensor(condition_mask, device=device).bool()
+    scale = torch.as_tensor(guidance_scale, dtype=torch.float32, device=device)
+    if scale.ndim == 0:
+        scale = scale.expand(batch_size)
+
+    guided = torch.nonzero((scale != 1.) & condition_mask.any(1)).view(-1)
+    has_uncond = [c.shape[0] == 2 * batch_size for c in condition]
+    if len(guided) > 0 or not bool(condition_mask.all()):
+        assert all(has_uncond), 'Unconditional embeddings are required for guidance or masked conditions.'
+
+    packed_condition = []
+    for c, with_uncond in zip(condition, has_uncond):
+        if with_uncond:
+            uncond, cond = c[:batch_size], c[batch_size:]
+        else:
+            uncond, cond = None, c
+        packed_condition.append((uncond, cond))
+
+    mask = condition_mask.to(condition[0].dtype)
+    condition_packed = []
+    for ci, (uncond, cond) in enumerate(packed_condition):
+        if uncond is None:
+            condition_packed.append(cond)
+            continue
+        m = mask[:, ci].view(-1, *([1] * (cond.ndim - 1)))
+        row = cond * m + uncond * (1 - m)
+        condition_packed.append(torch.cat([row, uncond[guided]]))
+
+    if isinstance(mix_weight, dict):
+        weights = torch.tensor(
+            [mix_weight[ctype] for ctype in condition_types], dtype=torch.float32, device=device)
+        weights = weights[None].expand(batch_size, num_conditions)
+    else:
+        weights = torch.as_tensor(mix_weight, dtype=torch.float32, device=device)
+    weights = torch.cat([weights, weights[guided]])
+    return {
+        'condition' : condition_packed,
+        'weights' : weights,
+        'guided' : guided,
+        'scale' : scale[guided], }
+
+
+class LatentWindows(object):
+    """
+    Overlapping windows over the time axis (dim 2) of an audio latent longer
+        than the audio U-Net was trained on. The windows are stacked along the
+        batch dimension (row w * B + b is window w of sample b) so one forward
+        denoises all of them, and the noise predictions are crossfaded back
+        with linear ramps over the overlaps. As the DDIM update is linear in
+        the noise prediction, this crossfades the latents at every step.
+    Other modalities of a joint generation are repeated for every window and
+        their predictions averaged over the windows.
+    """
+    def __init__(self, length, window=256, overlap=64):
+        assert 0 <= overlap < window <= length
+        self.length = length
+        self.window = window
+        stride = window - overlap
+        self.starts = list(range(0, length - window + 1, stride))
+        if self.starts[-1] + window < length:
+            self.starts.append(length - window)
+        self.num_windows = len(self.starts)
+
+        weight = torch.zeros(self.num_windows, length)
+        ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+        for w, start in enumerate(self.starts):
+            wi = torch.ones(window)
+            if overlap > 0 and w > 0:
+                wi[:overlap] = ramp
+            if overlap > 0 and w < self.num_windows - 1:
+                wi[-overlap:] = ramp.flip(0)
+            weight[w, start:start + window] = wi
+        self.weight = weight / weight.sum(0, keepdim=True)
+
+    def expand_guidance(self, condition, batch_size, guidance_scale, condition_mask, mix_weight):
+        """
+        Repeat the per-row guidance inputs for every window, in the argument
+            order of pack_guidance_batch.
+        """
+        n = self.num_windows
+        expanded = []
+        for c in condition:
+            if c.shape[0] == 2 * batch_size:
+                uncond, cond = c[:batch_size], c[batch_size:]
+                expanded.append(torch.cat([uncond.repeat(n, *([1] * (c.ndim - 1))),
+                                           cond.repeat(n, *([1] * (c.ndim - 1)))]))
+            else:
+                expanded.append(c.repeat(n, *([1] * (c.ndim - 1))))
+        scale = torch.as_tensor(guidance_scale, dtype=torch.float32)
+        if scale.ndim > 0:
+            scale = scale.repeat(n)
+        if condition_mask is not None:
+            condition_mask = torch.as_tensor(condition_mask).repeat(n, 1)
+        if not isinstance(mix_weight, dict):
+            mix_weight = torch.as_tensor(mix_weight).repeat(n, 1)
+        return expanded, batch_size * n, scale, condition_mask, mix_weight
+
+    def split(self, x, xtype):
+        out = []
+        for x_i, xtype_i in zip(x, xtype):
+            if xtype_i == 'audio':
+                out.append(torch.cat([x_i[:, :, s:s + self.window] for s in self.starts]))
+            else:
+                out.append(x_i.repeat(self.num_windows, *([1] * (x_i.ndim - 1))))
+        return out
+
+    def merge(self, e, xtype):
+        out = []
+        for e_i, xtype_i in zip(e, xtype):
+            e_i = e_i.view(self.num_windows, -1, *e_i.shape[1:])
+            if xtype_i == 'audio':
+                weight = self.weight.to(e_i)
+                merged = e_i.new_zeros(*e_i.shape[1:3], self.length, *e_i.shape[4:])
+                for w, start in enumerate(self.starts):
+                    wi = weight[w, start:start + self.window].view(1, 1, -1, *([1] * (e_i.ndim - 4)))
+                    merged[:, :, start:start + self.window] += e_i[w] * wi
+                out.append(merged)
+            else:
+                out.append(e_i.mean(0))
+        return out
@@ -45,6 +45,33 @@ def make_ddim_timesteps(ddim_discr_method, num_ddim_timesteps, num_ddpm_timestep
         print(f'Selected timesteps for ddim sampler: {steps_out}')
     return steps_out
 
+def make_feature_cache_schedule(num_steps, interval, schedule='uniform'):
+    """
+    Decide at which sampling steps the full U-Net is evaluated when deep
+    features are reused across steps.
+    :param num_steps: the number of sampling steps.
+    :param interval: average number of steps between two full evaluations.
+                     1 means every step is a full evaluation.
+    :param schedule: 'uniform' refreshes every `interval` steps, 'quad' puts
+                     the refreshes closer together at the beginning of
+                     sampling where the features change fastest.
+    :return: a boolean array of length num_steps, True for full evaluations.
+    """
+    refresh = np.zeros(num_steps, dtype=bool)
+    if interval <= 1:
+        refresh[:] = True
+        return refresh
+    if schedule == 'uniform':
+        refresh[::interval] = True
+    elif schedule == 'quad':
+        num_refresh = int(np.ceil(num_steps / interval))
+        steps = (np.linspace(0, np.sqrt(num_steps - 1), num_refresh) ** 2).astype(int)
+        refresh[steps] = True
+    else:
+        raise NotImplementedError(f'There is no feature cache schedule called "{schedule}"')
+    refresh[0] = True
+    return refresh
+
 def make_ddim_sampling_parameters(alphacums, ddim_timesteps, eta, verbose=True):
     # select alphas for computing the variance schedule
     alphas = alphacums[ddim_timesteps]
@@ -73,3 +73,181 @@ class LitEma(nn.Module):
         """
         for c_param, param in zip(self.collected_params, parameters):
             param.data.copy_(c_param.data)
+
+
+def _foreach_copy_(dst, src):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
+
+
+class LitEmaFused(nn.Module):
+    """
+    Drop-in replacement of LitEma keeping the shadow parameters in a few
+        contiguous flat buffers (one per dtype, split into buckets of at most
+        bucket_numel elements) and updating them with multi-tensor foreach
+        ops instead of one kernel launch per parameter.
+    The state dict has exactly the same keys and shapes as LitEma, so existing
+        model_ema checkpoints load into either class.
+    :param update_every: only update the shadow parameters every k-th call,
+        the decay is raised to the power k to keep the same time constant.
+    :param offload: keep the shadow parameters on CPU (pinned if CUDA is
+        available). They are not moved by .to()/.cuda() of the parent module.
+    """
+    def __init__(self, model, decay=0.9999, use_num_updates=True,
+                 update_every=1, offload=False, bucket_numel=2**26):
+        super().__init__()
+        if decay < 0.0 or decay > 1.0:
+            raise ValueError('Decay must be between 0 and 1')
+        if update_every < 1:
+            raise ValueError('update_every must be at least 1')
+
+        self.register_buffer('decay', torch.tensor(decay, dtype=torch.float32))
+        self.register_buffer('num_updates', torch.tensor(0,dtype=torch.int) if use_num_updates
+                             else torch.tensor(-1,dtype=torch.int))
+        self.update_every = update_every
+        self.offload = offload
+        self.num_calls = 0
+
+        self.m_name2s_name = {}
+        groups = {}
+        for name, p in model.named_parameters():
+            if p.requires_grad:
+                #remove as '.'-character is not allowed in buffers
+                self.m_name2s_name.update({name:name.replace('.','')})
+                groups.setdefault(p.dtype, []).append((name, p))
+
+        # buckets: list of (param names, shapes, numels)
+        self.buckets = []
+        self.offloaded_flats = []
+        for dtype, named_params in groups.items():
+            bucket, numel = [], 0
+            for name, p in named_params:
+                if bucket and numel + p.numel() > bucket_numel:
+                    self._add_bucket(bucket)
+                    bucket, numel = [], 0
+                bucket.append((name, p))
+                numel += p.numel()
+            if bucket:
+                self._add_bucket(bucket)
+
+        self.collected_params = []
+
+    def _add_bucket(self, named_params):
+        names = [n for n, _ in named_params]
+        shapes = [p.shape for _, p in named_params]
+        numels = [p.numel() for _, p in named_params]
+        with torch.no_grad():
+            flat = torch.cat([p.detach().reshape(-1) for _, p in named_params])
+        if self.offload:
+            flat = flat.cpu()
+            if torch.cuda.is_available():
+                flat = flat.pin_memory()
+            self.offloaded_flats.append(flat)
+        else:
+            self.register_buffer('flat{}'.format(len(self.buckets)), flat, persistent=False)
+        self.buckets.append((names, shapes, numels))
+
+    def flat_buffers(self):
+        if self.offload:
+            return self.offloaded_flats
+        return [getattr(self, 'flat{}'.format(i)) for i in range(len(self.buckets))]
+
+    def shadow_params(self):
+        """
+        Yield (model param name, shadow view) for every tracked parameter.
+        """
+        for (names, shapes, numels), flat in zip(self.buckets, self.flat_buffers()):
+            for name, shape, view in zip(names, shapes, flat.split(numels)):
+                yield name, view.view(shape)
+
+    def forward(self, model):
+        self.num_calls += 1
+        if self.num_calls % self.update_every != 0:
+            return
+
+        decay = self.decay
+        if self.num_updates >= 0:
+            self.num_updates += 1
+            decay = min(self.decay,(1 + self.num_updates) / (10 + self.num_updates))
+        decay = float(decay) ** self.update_every
+        one_minus_decay = 1.0 - decay
+
+        with torch.no_grad():
+            m_param = dict(model.named_parameters())
+            for (names, shapes, numels), flat in zip(self.buckets, self.flat_buffers()):
+                params = [m_param[n].detach() for n in names]
+                if self.offload:
+                    # blocking copy, the CPU update below reads it right away
+                    current = torch.cat([p.reshape(-1) for p in params]).to(flat.device)
+                    flat.mul_(decay).add_(current.to(flat.dtype), alpha=one_minus_decay)
+                else:
+                    shadows = list(flat.split(numels))
+                    params = [p.reshape(-1) for p in params]
+                    torch._foreach_mul_(shadows, decay)
+                    torch._foreach_add_(shadows, params, alpha=one_minus_decay)
+
+    def copy_to(self, model):
+        m_param = dict(model.named_parameters())
+        with torch.no_grad():
+            for (names, shapes, numels), flat in zip(self.buckets, self.flat_buffers()):
+                params = [m_param[n].data for n in names]
+                # blocking copy, an offloaded shadow is updated in place on the CPU by the next forward
+                shadows = [v.view(s).to(params[0].device) for v, s in zip(flat.split(numels), shapes)]
+                _foreach_copy_(params, shadows)
+
+    def store(self, parameters):
+        """
+        Save the current parameters for restoring later, as one flat copy
+            per dtype and device.
+        Args:
+          parameters: Iterable of `torch.nn.Parameter`; the parameters to be
+            temporarily stored.
+        """
+        self.collected_params = []
+        groups = {}
+        for param in parameters:
+            groups.setdefault((param.dtype, param.device), []).append(param)
+        with torch.no_grad():
+            for params in groups.values():
+                flat = torch.cat([p.detach().reshape(-1) for p in params])
+                self.collected_params.append((params, flat))
+
+    def restore(self, parameters=None):
+        """
+        Restore the parameters stored with the `store` method.
+        Args:
+          parameters: ignored, the stored parameters are restored in place.
+            Kept for API compatibility with LitEma.
+        """
+        with torch.no_grad():
+            for params, flat in self.collected_params:
+                views = [v.view(p.shape) for v, p in zip(flat.split([p.numel() for p in params]), params)]
+                _foreach_copy_([p.data for p in params], views)
+        self.collected_params = []
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        for name, view in self.shadow_params():
+            destination[prefix + self.m_name2s_name[name]] = view if keep_vars else view.detach()
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        s_names = set(prefix + s for s in self.m_name2s_name.values())
+        with torch.no_grad():
+            for name, view in self.shadow_params():
+                key = prefix + self.m_name2s_name[name]
+                if key not in state_dict:
+                    missing_keys.append(key)
+                    continue
+                value = state_dict[key]
+                if value.shape != view.shape:
+                    error_msgs.append('size mismatch for {}: copying a param with shape {} from checkpoint, '
+                                      'the shape in current model is {}.'.format(key, value.shape, view.shape))
+                    continue
+                view.copy_(value)
+        state_dict = {k: v for k, v in state_dict.items() if k not in s_names}
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
@@ -522,6 +522,7 @@ class SpatioTemporalAttention(nn.Module):
         self.temporal_rel_pos_bias = ContinuousPositionBias(dim = dim // 2, heads = heads, num_dims = 1)
         
         self.ff = FeedForward(dim = dim, mult = 4)
+        self.use_checkpoint = False
 
 
     def forward(
@@ -529,6 +530,16 @@ class SpatioTemporalAttention(nn.Module):
         x,
         enable_time = True,
         framerate = 4,
+    ):
+        return checkpoint(
+            functools.partial(self._forward, enable_time = enable_time, framerate = framerate),
+            (x, ), self.parameters(), self.use_checkpoint)
+
+    def _forward(
+        self,
+        x,
+        enable_time = True,
+        framerate = 4,
     ):
         b, c, *_, h, w = x.shape
         is_video = x.ndim == 5
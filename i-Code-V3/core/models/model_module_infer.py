@@ -1,4 +1,5 @@
 import os
+import math
 
 import torch
 import torch.nn as nn
@@ -7,11 +8,29 @@ import torchvision.transforms as tvtrans
 from core.models import get_model
 from core.cfg_helper import model_cfg_bank
 from core.common.utils import regularize_image
+from core.common.output_encoders import output_encoder
+from core.models.token_merging import apply_token_merging
 from einops import rearrange
 
 import pytorch_lightning as pl
 
 
+AUDIO_SAMPLE_RATE = 16000
+# audio latent frames per second: 160 samples hop, 4x downsampled by the VAE
+AUDIO_LATENT_RATE = AUDIO_SAMPLE_RATE / 160 / 4
+
+
+def audio_latent_length(duration=None, multiple=8):
+    """
+    Latent time frames for duration seconds of audio, rounded up to a multiple
+        of the audio U-Net downsampling factor.
+    """
+    if duration is None:
+        return 256
+    frames = int(math.ceil(duration * AUDIO_LATENT_RATE / multiple)) * multiple
+    return max(frames, multiple)
+
+
 class model_module(pl.LightningModule):
     def __init__(self, data_dir='pretrained', pth=["CoDi_encoders.pth"]):
         super().__init__()
@@ -32,12 +51,19 @@ class model_module(pl.LightningModule):
         from core.models.ddim_vd import DDIMSampler_VD
         self.sampler = DDIMSampler_VD(net)
 
-    def decode(self, z, xtype):
+    def decode(self, z, xtype, return_tensor=False):
+        """
+        :param return_tensor: return image / video / audio as device tensors
+            ([B x C x H x W], [B x F x C x H x W] in [0, 1], [B x 1 x N]) for
+            the output encoders instead of PIL images and numpy waveforms.
+        """
         net = self.net
-        z = z.cuda()
+        z = z.to(self.device)
         if xtype == 'image':
             x = net.autokl_decode(z)
             x = torch.clamp((x+1.0)/2.0, min=0.0, max=1.0)
+            if return_tensor:
+                return x
             x = [tvtrans.ToPILImage()(xi) for xi in x]
             return x
         
@@ -48,6 +74,8 @@ class model_module(pl.LightningModule):
             x = rearrange(x, '(b f) c h w -> b f c h w', f=num_frames)
             
             x = torch.clamp((x+1.0)/2.0, min=0.0, max=1.0)
+            if return_tensor:
+                return x
             video_list = []
             for video in x:
                 video_list.append([tvtrans.ToPILImage()(xi) for xi in video])
@@ -71,24 +99,39 @@ class model_module(pl.LightningModule):
             return x
         
         elif xtype == 'audio':
-            x = net.audioldm_decode(z)
-            x = self.mel_spectrogram_to_waveform(x)
+            x = net.audioldm_decode_waveform(z)
+            if return_tensor:
+                return x
+            x = x.cpu().detach().numpy()
             return x
 
     def mel_spectrogram_to_waveform(self, mel):
         # Mel: [bs, 1, t-steps, fbins]
-        if len(mel.size()) == 4:
-            mel = mel.squeeze(1)
-        mel = mel.permute(0, 2, 1)
-        waveform = self.net.audioldm.vocoder(mel)
+        if len(mel.size()) == 3:
+            mel = mel.unsqueeze(1)
+        waveform = self.net.audioldm.vocode(mel)
         waveform = waveform.cpu().detach().numpy()
         return waveform
     
     
-    def inference(self, xtype=[], condition=[], condition_types=[], n_samples=1, mix_weight={'audio': 1, 'text': 1, 'image': 1}, image_size=256, ddim_steps=50, scale=7.5, num_frames=8):
+    def inference(self, xtype=[], condition=[], condition_types=[], n_samples=1, mix_weight={'audio': 1, 'text': 1, 'image': 1}, image_size=256, ddim_steps=50, scale=7.5, num_frames=8,
+                  cache_interval=1, cache_depth=1, cache_schedule='uniform', token_merge_ratio=0.0,
+                  long_audio_pooling=None, audio_duration=None, audio_window=256, audio_overlap=64,
+                  output_format=None, mux_audio=False, fps=8, encode_workers=4):
+        """
+        :param audio_duration: length of generated audio in seconds, None for
+            the default 10.24s. Shorter audio uses a shorter latent, longer
+            audio is denoised as overlapping audio_window latent frames.
+        :param output_format: optional dict from xtype to an output encoder
+            format (e.g. {'image': 'png', 'video': 'mp4', 'audio': 'wav'}),
+            outputs of those xtypes are returned as lists of bytes.
+        :param mux_audio: with both video and audio generated and the video
+            encoded, mux the audio track into the video container.
+        """
         net = self.net
         sampler = self.sampler
         ddim_eta = 0.0
+        apply_token_merging(net.model.diffusion_model, ratio=token_merge_ratio)
 
         conditioning = []
         assert len(set(condition_types)) == len(condition_types), "we don't support condition with same modalities yet."
@@ -96,30 +139,30 @@ class model_module(pl.LightningModule):
         
         for i, condition_type in enumerate(condition_types):
             if condition_type == 'image':
-                ctemp1 = regularize_image(condition[i]).cuda()
+                ctemp1 = regularize_image(condition[i]).to(self.device)
                 ctemp1 = ctemp1[None].repeat(n_samples, 1, 1, 1)
-                cim = net.clip_encode_vision(ctemp1).cuda()
+                cim = net.clip_encode_vision(ctemp1).to(self.device)
                 uim = None
                 if scale != 1.0:
-                    dummy = torch.zeros_like(ctemp1).cuda()
-                    uim = net.clip_encode_vision(dummy).cuda()
-                conditioning.append(torch.cat([uim, cim]))
+                    dummy = torch.zeros_like(ctemp1).to(self.device)
+                    uim = net.clip_encode_vision(dummy).to(self.device)
+                conditioning.append(cim if uim is None else torch.cat([uim, cim]))
             
             elif condition_type == 'audio':
                 ctemp = condition[i][None].repeat(n_samples, 1, 1)
-                cad = net.clap_encode_audio(ctemp)
+                cad = net.clap_encode_audio(ctemp, long_audio_pooling=long_audio_pooling)
                 uad = None
                 if scale != 1.0:
                     dummy = torch.zeros_like(ctemp)
-                    uad = net.clap_encode_audio(dummy)  
-                conditioning.append(torch.cat([uad, cad]))
+                    uad = net.clap_encode_audio(dummy, long_audio_pooling=long_audio_pooling)  
+                conditioning.append(cad if uad is None else torch.cat([uad, cad]))
                 
             elif condition_type == 'text':
-                ctx = net.clip_encode_text(n_samples * [condition[i]]).cuda()
+                ctx = net.clip_encode_text(n_samples * [condition[i]]).to(self.device)
                 utx = None
                 if scale != 1.0:
-                    utx = net.clip_encode_text(n_samples * [""]).cuda()
-                conditioning.append(torch.cat([utx, ctx]))
+                    utx = net.clip_encode_text(n_samples * [""]).to(self.device)
+                conditioning.append(ctx if utx is None else torch.cat([utx, ctx]))
         
         shapes = []
         for xtype_i in xtype:
@@ -133,7 +176,7 @@ class model_module(pl.LightningModule):
                 n = 768
                 shape = [n_samples, n]
             elif xtype_i == 'audio':
-                h, w = [256, 16]
+                h, w = [audio_latent_length(audio_duration), 16]
                 shape = [n_samples, 8, h, w]
             else:
                 raise
@@ -149,11 +192,52 @@ class model_module(pl.LightningModule):
             condition_types=condition_types,
             eta=ddim_eta,
             verbose=False,
-            mix_weight=mix_weight)
+            mix_weight=mix_weight,
+            cache_interval=cache_interval,
+            cache_depth=cache_depth,
+            cache_schedule=cache_schedule,
+            audio_window=audio_window,
+            audio_overlap=audio_overlap)
 
+        output_format = {} if output_format is None else output_format
         out_all = []
         for i, xtype_i in enumerate(xtype):
-            z[i] = z[i].cuda()
-            x_i = self.decode(z[i], xtype_i)
+            z[i] = z[i].to(self.device)
+            x_i = self.decode(z[i], xtype_i, return_tensor=xtype_i in output_format)
+            if xtype_i == 'audio' and audio_duration is not None:
+                x_i = x_i[..., :int(round(audio_duration * AUDIO_SAMPLE_RATE))]
             out_all.append(x_i)
+        if len(output_format) > 0:
+            out_all = self.encode_outputs(
+                out_all, xtype, output_format, mux_audio=mux_audio, fps=fps, num_workers=encode_workers)
+        return out_all
+
+    def encode_outputs(self, outputs, xtype, output_format, mux_audio=False, fps=8, num_workers=4):
+        """
+        Encode the decoded tensors of the xtypes in output_format to bytes,
+            all samples of all xtypes are encoded concurrently.
+        """
+        encoder = output_encoder(num_workers=num_workers)
+        options = {
+            'image': {},
+            'video': {'fps': fps},
+            'audio': {'sample_rate': AUDIO_SAMPLE_RATE},
+            'text': {}, }
+        muxed = mux_audio and 'video' in output_format and 'audio' in xtype
+        futures = []
+        for x_i, xtype_i in zip(outputs, xtype):
+            if xtype_i not in output_format:
+                futures.append(None)
+            elif xtype_i == 'video' and muxed:
+                audio = outputs[xtype.index('audio')]
+                if not torch.is_tensor(audio):
+                    audio = torch.from_numpy(audio)
+                futures.append(encoder.submit_muxed(
+                    x_i, audio, fmt=output_format['video'], fps=fps, sample_rate=AUDIO_SAMPLE_RATE))
+            else:
+                futures.append(encoder.submit(x_i, xtype_i, output_format[xtype_i], **options[xtype_i]))
+        out_all = [
+            x_i if f is None else [fi.result() for fi in f]
+            for x_i, f in zip(outputs, futures)]
+        encoder.close()
         return out_all
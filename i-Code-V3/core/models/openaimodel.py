@@ -413,7 +413,7 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
+        return checkpoint(self._forward, (x,), self.parameters(), self.use_checkpoint)   # TODO: fix the .half call!!!
         #return pt_checkpoint(self._forward, x)  # pytorch
 
     def _forward(self, x):
@@ -1074,6 +1074,31 @@ class UNetModel0D_MultiDim(nn.Module):
         return self.out(h)
 
     
+class FeatureCache(object):
+    """
+    Deep U-Net features kept across adjacent sampling steps (DeepCache).
+    On a refresh step the full network runs and the hidden state entering the
+        last `depth` output blocks is stored. On the other steps only the first
+        `depth` input blocks and the last `depth` output blocks are evaluated,
+        the deeper part of the network is replaced by the stored features.
+    :param depth: number of shallow input/output block pairs recomputed on
+        every step.
+    """
+    def __init__(self, depth=1):
+        assert depth >= 1, 'Feature cache depth must be at least 1.'
+        self.depth = depth
+        self.features = None
+        self.refresh = True
+
+    def reset(self):
+        self.features = None
+        self.refresh = True
+
+    @property
+    def reusable(self):
+        return (not self.refresh) and (self.features is not None)
+
+
 @register('openai_unet_vd', version)
 class UNetModelVD(nn.Module):
     def __init__(self,
@@ -1090,20 +1115,40 @@ class UNetModelVD(nn.Module):
         self.text_model_channels = self.unet_text.model_channels
         self.audio_model_channels = self.unet_audio.model_channels
         
-    def forward(self, x, timesteps, condition, xtype, condition_types, mix_weight):
-        
+    def forward(self, x, timesteps, condition, xtype, condition_types, mix_weight, feature_cache=None,
+                condition_weights=None):
+        """
+        :param feature_cache: an optional FeatureCache. When given, the deep
+            features are either refreshed (full computation) or reused from
+            the previous refresh step, depending on feature_cache.refresh.
+        :param condition_weights: optional [N x num_conditions] per-row
+            weights of the conditions, replacing mix_weight. A zero weight
+            drops the condition from that row.
+        """
+        use_cache = feature_cache is not None and feature_cache.reusable
+        num_output_blocks = len(self.unet_image.output_blocks)
+        if feature_cache is not None:
+            assert feature_cache.depth <= num_output_blocks, \
+                'Feature cache depth {} exceeds {} blocks.'.format(feature_cache.depth, num_output_blocks)
+            cache_from = num_output_blocks - feature_cache.depth
+
         # Prepare conditioning
-        weights = np.array(list(map(mix_weight.get, condition_types)))
-        norm_weights = weights / weights.sum()
         context = 0.0
-        for i in range(len(condition)):
-            context += condition[i] * weights[i]
+        if condition_weights is None:
+            weights = np.array(list(map(mix_weight.get, condition_types)))
+            for i in range(len(condition)):
+                context += condition[i] * weights[i]
+        else:
+            for i in range(len(condition)):
+                w_i = condition_weights[:, i].to(condition[i])
+                context += condition[i] * w_i.view(-1, *([1] * (condition[i].ndim - 1)))
 
         # Prepare inputs
         hs = []
-        x = [temp.cuda() for temp in x]
-        timesteps = timesteps.cuda()
-        context = context.cuda()
+        device = next(self.parameters()).device
+        x = [temp.to(device) for temp in x]
+        timesteps = timesteps.to(device)
+        context = context.to(device)
         if 'image' in xtype or 'video' in xtype:
             t_emb_image = timestep_embedding(timesteps, self.image_model_channels, repeat_only=False).to(x[0])
             emb_image = self.unet_image.time_embed(t_emb_image)
@@ -1144,12 +1189,14 @@ class UNetModelVD(nn.Module):
         
         # Joint / single generation
         h = x
-        for (i_module, t_module, a_module,
+        for block_idx, (i_module, t_module, a_module,
             i_con_in, t_con_in, a_con_in) \
-        in zip(
+        in enumerate(zip(
             self.unet_image.input_blocks, self.unet_text.input_blocks, self.unet_audio.input_blocks,
             self.unet_image.input_block_connecters_in, self.unet_text.input_block_connecters_in, self.unet_audio.input_block_connecters_in, 
-            ):
+            )):
+            if use_cache and block_idx >= feature_cache.depth:
+                break
             h = [h_i for h_i in h]
             for i, xtype_i in enumerate(xtype):
                 if xtype_i == 'audio':
@@ -1174,24 +1221,30 @@ class UNetModelVD(nn.Module):
 
             hs.append(h)            
 
-
-        for i, xtype_i in enumerate(xtype):
-            if xtype_i == 'audio':
-                h[i] = self.unet_audio.middle_block(h[i], emb_audio, context)
-            elif xtype_i in ['video', 'image']:
-                h[i] = self.unet_image.middle_block(h[i], emb_image, context)
-            elif xtype_i == 'text':
-                h[i] = self.unet_text.middle_block(h[i], emb_text, context)   
-            else:
-                raise
+        if use_cache:
+            h = [h_i for h_i in feature_cache.features]
+        else:
+            for i, xtype_i in enumerate(xtype):
+                if xtype_i == 'audio':
+                    h[i] = self.unet_audio.middle_block(h[i], emb_audio, context)
+                elif xtype_i in ['video', 'image']:
+                    h[i] = self.unet_image.middle_block(h[i], emb_image, context)
+                elif xtype_i == 'text':
+                    h[i] = self.unet_text.middle_block(h[i], emb_text, context)   
+                else:
+                    raise
 
 
-        for (i_module, t_module, a_module, 
+        for block_idx, (i_module, t_module, a_module, 
             i_con_in, t_con_in, a_con_in,) \
-        in zip(
+        in enumerate(zip(
             self.unet_image.output_blocks, self.unet_text.output_blocks, self.unet_audio.output_blocks, 
             self.unet_image.output_block_connecters_in, self.unet_text.output_block_connecters_in, self.unet_audio.output_block_connecters_in,
-            ):
+            )):
+            if use_cache and block_idx < cache_from:
+                continue
+            if feature_cache is not None and not use_cache and block_idx == cache_from:
+                feature_cache.features = [h_i for h_i in h]
             temp = hs.pop()
             h_connector_out = []
             for i, xtype_i in enumerate(xtype):
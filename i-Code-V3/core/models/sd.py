@@ -14,7 +14,7 @@ symbol = 'sd'
 from .diffusion_utils import \
     count_params, extract_into_tensor, make_beta_schedule
 from .distributions import normal_kl, DiagonalGaussianDistribution
-from .ema import LitEma
+from .ema import LitEma, LitEmaFused
 
 def highlight_print(info):
     print('')
@@ -28,6 +28,9 @@ class DDPM(nn.Module):
                  unet_config,
                  timesteps=1000,
                  use_ema=True,
+                 ema_fused=False,
+                 ema_update_every=1,
+                 ema_offload=False,
 
                  beta_schedule="linear",
                  beta_linear_start=1e-4,
@@ -63,7 +66,12 @@ class DDPM(nn.Module):
         # TODO: Remove this ugly trick to match SD with deprecated version, after no bug with the module.
 
         self.use_ema = use_ema
-        if self.use_ema:
+        if self.use_ema and ema_fused:
+            self.model_ema = LitEmaFused(
+                self.model, update_every=ema_update_every, offload=ema_offload)
+        elif self.use_ema:
+            assert ema_update_every == 1 and not ema_offload, \
+                'ema_update_every and ema_offload require ema_fused.'
             self.model_ema = LitEma(self.model)
             print_log(f"Keeping EMAs of {len(list(self.model_ema.buffers()))}.")
 
@@ -0,0 +1,135 @@
+"""
+Token merging (ToMe) for the self-attention and feed-forward of
+    BasicTransformerBlock.
+Adapted from https://github.com/dbolya/tomesd
+"""
+
+import torch
+
+
+def do_nothing(x, mode=None):
+    return x
+
+
+def bipartite_soft_matching_2d(metric, h, w, sx, sy, r, use_rand=False):
+    """
+    Partition the tokens of an h x w grid into src and dst sets, with one dst
+        token per sy x sx cell, and merge the r src tokens that are most similar
+        to a dst token into it.
+    :param metric: [B x N x C] tensor used to measure token similarity,
+        N must equal h * w.
+    :param h, w: the spatial layout of the N tokens.
+    :param sx, sy: stride of the dst grid.
+    :param r: number of tokens to remove.
+    :param use_rand: pick the dst token of each cell at random instead of
+        always taking the top-left one.
+    :return: the merge and unmerge functions.
+    """
+    B, N, _ = metric.shape
+    hsy, wsx = h // sy, w // sx
+    num_dst = hsy * wsx
+    if r <= 0 or num_dst == 0:
+        return do_nothing, do_nothing
+
+    device = metric.device
+    with torch.no_grad():
+        if use_rand:
+            rand_idx = torch.randint(sy*sx, size=(hsy, wsx, 1), device=device)
+        else:
+            rand_idx = torch.zeros(hsy, wsx, 1, device=device, dtype=torch.int64)
+
+        # -1 marks the dst tokens, argsort moves them to the front
+        idx_buffer_view = torch.zeros(hsy, wsx, sy*sx, device=device, dtype=torch.int64)
+        idx_buffer_view.scatter_(dim=2, index=rand_idx, src=-torch.ones_like(rand_idx))
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy*sy, wsx*sx)
+        if (hsy*sy) < h or (wsx*sx) < w:
+            idx_buffer = torch.zeros(h, w, device=device, dtype=torch.int64)
+            idx_buffer[:(hsy*sy), :(wsx*sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+
+        a_idx = rand_idx[:, num_dst:, :]
+        b_idx = rand_idx[:, :num_dst, :]
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(x.shape[0], N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(x.shape[0], num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]
+        src_idx = edge_idx[..., :r, :]
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+        unm_pos = torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx)
+        src_pos = torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx)
+
+    def merge(x, mode='mean'):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = x.shape[-1]
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=unm_pos.expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=src_pos.expand(B, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+def compute_merge(x, hw, cfg):
+    """
+    Build the merge / unmerge functions of one transformer block.
+    :param x: [B x N x C] tokens entering the block.
+    :param hw: (h, w) spatial layout of the N tokens.
+    :param cfg: the token merging config set by apply_token_merging.
+    """
+    h, w = hw
+    if cfg is None or cfg['ratio'] <= 0 or h * w < cfg['min_tokens']:
+        return do_nothing, do_nothing
+    r = int(x.shape[1] * cfg['ratio'])
+    sx, sy = cfg['stride']
+    return bipartite_soft_matching_2d(x, h, w, sx, sy, r, use_rand=cfg['use_rand'])
+
+
+def apply_token_merging(model, ratio=0.5, min_tokens=1024, stride=(2, 2), use_rand=False):
+    """
+    Enable token merging on every BasicTransformerBlock of model. A ratio of 0
+        disables it again.
+    :param ratio: fraction of the tokens merged away before self-attention and
+        feed-forward.
+    :param min_tokens: only blocks running on at least this many tokens (per
+        frame) merge tokens, the low resolution blocks are cheap anyway.
+    :param stride: (sx, sy) stride of the dst token grid.
+    :param use_rand: pick the dst token of each stride cell at random.
+    """
+    from .attention import BasicTransformerBlock
+    assert 0.0 <= ratio < 1.0, 'Token merging ratio must be in [0, 1).'
+    cfg = None
+    if ratio > 0:
+        cfg = {
+            'ratio' : ratio,
+            'min_tokens' : min_tokens,
+            'stride' : tuple(stride),
+            'use_rand' : use_rand, }
+    for module in model.modules():
+        if isinstance(module, BasicTransformerBlock):
+            module.token_merge = cfg
+    return model
@@ -113,20 +113,58 @@ class VD(DDPM):
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
         return inputs, labels
 
+    def optimus_tokenize(self, text, max_length=512):
+        """
+        Tokenize a batch of sentences for the Optimus BERT encoder.
+        Identical sentences are tokenized once, every sentence is truncated to
+            max_length - 2 word pieces before [CLS] / [SEP] are added.
+        :return: [B x L] padded token ids and [B x L] attention mask, L is the
+            longest sequence of the batch.
+        """
+        tokenizer = self.optimus.tokenizer_encoder
+        unique = {}
+        for sentence in text:
+            if sentence not in unique:
+                token = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(sentence.lower()))
+                unique[sentence] = tokenizer.add_special_tokens_single_sentence(token[:max_length-2])
+        token_id = [unique[sentence] for sentence in text]
+
+        lengths = torch.LongTensor([len(t) for t in token_id])
+        max_len = int(lengths.max()) if len(token_id) > 0 else 0
+        attention_mask = torch.arange(max_len)[None] < lengths[:, None]
+        padded = torch.zeros(len(token_id), max_len, dtype=torch.long)
+        padded[attention_mask] = torch.LongTensor([i for t in token_id for i in t])
+        return padded, attention_mask.long()
+
     @torch.no_grad()
-    def optimus_encode(self, text):
+    def optimus_encode(self, text, bucket_size=None, max_length=512):
+        """
+        :param text: list of sentences, or already tokenized [B x L] token ids
+            padded with 0.
+        :param bucket_size: if set, sentences are sorted by length and encoded
+            bucket_size at a time, each bucket only padded to its own longest
+            sentence.
+        """
+        device = next(self.optimus.encoder.parameters()).device
         if isinstance(text, List):
-            tokenizer = self.optimus.tokenizer_encoder
-            token = [tokenizer.tokenize(sentence.lower()) for sentence in text]
-            token_id = []
-            for tokeni in token:
-                token_sentence = [tokenizer._convert_token_to_id(i) for i in tokeni]
-                token_sentence = tokenizer.add_special_tokens_single_sentence(token_sentence)
-                token_id.append(torch.LongTensor(token_sentence))
-            token_id = torch._C._nn.pad_sequence(token_id, batch_first=True, padding_value=0.0)[:, :512]
+            token_id, attention_mask = self.optimus_tokenize(text, max_length=max_length)
         else:
             token_id = text
-        z = self.optimus.encoder(token_id, attention_mask=(token_id > 0))[1]
+            attention_mask = (token_id > 0).long()
+        token_id, attention_mask = token_id.to(device), attention_mask.to(device)
+
+        if bucket_size is None or bucket_size >= token_id.shape[0]:
+            z = self.optimus.encoder(token_id, attention_mask=attention_mask)[1]
+        else:
+            lengths = attention_mask.sum(1)
+            order = lengths.argsort(descending=True)
+            z = []
+            for bucket in order.split(bucket_size):
+                bucket_len = int(lengths[bucket].max())
+                z.append(self.optimus.encoder(
+                    token_id[bucket, :bucket_len],
+                    attention_mask=attention_mask[bucket, :bucket_len])[1])
+            z = torch.cat(z)[order.argsort()]
         z_mu, z_logvar = self.optimus.encoder.linear(z).chunk(2, -1)
         return z_mu.squeeze(1) * self.text_scale_factor
 
@@ -165,6 +203,13 @@ class VD(DDPM):
             z = torch.clip(z, min=-10, max=10)
         z = 1.0 / self.audio_scale_factor * z
         return self.audioldm.decode(z)
+
+    @torch.no_grad()
+    def audioldm_decode_waveform(self, z):
+        if (torch.max(torch.abs(z)) > 1e2):
+            z = torch.clip(z, min=-10, max=10)
+        z = 1.0 / self.audio_scale_factor * z
+        return self.audioldm.decode_waveform(z)
     
     @torch.no_grad()
     def clip_encode_text(self, text, encode_type='encode_text'):
@@ -192,8 +237,20 @@ class VD(DDPM):
         return embedding
     
     @torch.no_grad()
-    def clap_encode_audio(self, audio):
-        embedding = self.clap(audio)
+    def clap_encode_audio(self, audio, long_audio_pooling=None):
+        """
+        :param long_audio_pooling: 'mean', 'attention' or 'max' to pool
+            sliding windows over the whole audio, None keeps the setting of
+            self.clap.
+        """
+        if long_audio_pooling is None:
+            return self.clap(audio)
+        pooling = self.clap.long_audio_pooling
+        self.clap.long_audio_pooling = long_audio_pooling
+        try:
+            embedding = self.clap(audio)
+        finally:
+            self.clap.long_audio_pooling = pooling
         return embedding
 
     def forward(self, x=None, c=None, noise=None, xtype='image', ctype='prompt', u=None, return_algined_latents=False):
@@ -0,0 +1,251 @@
+import os
+import time
+import queue
+import threading
+import traceback
+import itertools
+import collections
+
+import torch
+import torch.multiprocessing as mp
+
+def share_weights(module):
+    """
+    Freeze module and move all its parameters and buffers to shared memory,
+        so that processes receiving it map the same storage instead of
+        copying it.
+    """
+    module.eval()
+    for param in module.parameters():
+        param.requires_grad = False
+    module.share_memory()
+    return module
+
+def _heartbeat_loop(worker_id, heartbeat, interval):
+    while True:
+        heartbeat[worker_id] = time.time()
+        time.sleep(interval)
+
+def _worker_loop(worker_id, model, num_threads, request_q, result_q, heartbeat, poll_interval):
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    # beats during inference as well, a stale heartbeat means a frozen process
+    threading.Thread(
+        target=_heartbeat_loop, args=(worker_id, heartbeat, poll_interval), daemon=True).start()
+    while True:
+        item = request_q.get()
+        if item is None:
+            return
+        request_id, kwargs = item
+        try:
+            with torch.no_grad():
+                out = model.inference(**kwargs)
+            result_q.put((worker_id, request_id, True, out))
+        except Exception:
+            result_q.put((worker_id, request_id, False, traceback.format_exc()))
+
+class cpu_replica_pool(object):
+    """
+    A pool of CPU worker processes serving model_module.inference.
+    The parent holds the only copy of the weights in shared memory, every
+        worker maps the same tensors read-only and runs its share of the
+        requests under its own thread budget.
+    The parent hands a request to a worker only when the worker is idle, so
+        it always knows which request every worker holds. Workers whose
+        process died, whose heartbeat is older than heartbeat_timeout or whose
+        request runs longer than request_timeout are restarted by
+        check_health, the request they held is resubmitted up to max_retries
+        times.
+    """
+    def __init__(self,
+                 model,
+                 num_workers=2,
+                 threads_per_worker=None,
+                 start_method='spawn',
+                 poll_interval=1.0,
+                 request_timeout=None,
+                 heartbeat_timeout=60.0,
+                 max_retries=1):
+        self.model = share_weights(model)
+        self.num_workers = num_workers
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+        self.threads_per_worker = threads_per_worker
+        self.poll_interval = poll_interval
+        self.request_timeout = request_timeout
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+
+        self.ctx = mp.get_context(start_method)
+        self.result_q = self.ctx.Queue()
+        self.heartbeat = self.ctx.Array('d', num_workers, lock=False)
+        # request held by each worker and when it was handed over, -1 / None when idle
+        self.current = [-1] * num_workers
+        self.busy_since = [None] * num_workers
+        self.request_qs = [None] * num_workers
+        self.workers = [None] * num_workers
+
+        self.request_id = itertools.count()
+        self.queued = collections.deque()
+        self.pending = {}
+        self.retries = {}
+        self.results = {}
+        self.restarts = 0
+
+    @classmethod
+    def from_pretrained(cls, data_dir='pretrained', pth=["CoDi_encoders.pth"], **kwargs):
+        from core.models.model_module_infer import model_module
+        model = model_module(data_dir=data_dir, pth=pth)
+        return cls(model, **kwargs)
+
+    def _spawn(self, worker_id):
+        self.current[worker_id] = -1
+        self.heartbeat[worker_id] = time.time()
+        self.busy_since[worker_id] = None
+        # a fresh queue, nothing a dead worker left behind is picked up
+        self.request_qs[worker_id] = self.ctx.Queue()
+        p = self.ctx.Process(
+            target=_worker_loop,
+            args=(worker_id, self.model, self.threads_per_worker,
+                  self.request_qs[worker_id], self.result_q,
+                  self.heartbeat, self.poll_interval),
+            daemon=True)
+        p.start()
+        self.workers[worker_id] = p
+
+    def _dispatch(self):
+        """
+        Hand queued requests to idle workers.
+        """
+        for worker_id, p in enumerate(self.workers):
+            if p is None or self.current[worker_id] >= 0:
+                continue
+            while self.queued:
+                request_id = self.queued.popleft()
+                if request_id not in self.pending:
+                    continue
+                self.current[worker_id] = request_id
+                self.busy_since[worker_id] = time.time()
+                self.request_qs[worker_id].put((request_id, self.pending[request_id]))
+                break
+
+    def start(self):
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+        self._dispatch()
+        return self
+
+    def submit(self, **kwargs):
+        """
+        Queue one model_module.inference call, returns its request id.
+        """
+        request_id = next(self.request_id)
+        self.pending[request_id] = kwargs
+        self.retries[request_id] = 0
+        self.queued.append(request_id)
+        self._dispatch()
+        return request_id
+
+    def _fail_or_retry(self, request_id, reason):
+        if request_id not in self.pending:
+            return
+        if self.retries[request_id] < self.max_retries:
+            self.retries[request_id] += 1
+            self.queued.appendleft(request_id)
+        else:
+            self.pending.pop(request_id)
+            self.retries.pop(request_id)
+            self.results[request_id] = (False, reason)
+
+    def check_health(self):
+        """
+        Restart dead or hanging workers, returns the ids of restarted workers.
+        """
+        restarted = []
+        now = time.time()
+        for worker_id, p in enumerate(self.workers):
+            if p is None:
+                continue
+            request_id = self.current[worker_id]
+            hanging = (self.request_timeout is not None) \
+                and (self.busy_since[worker_id] is not None) \
+                and (now - self.busy_since[worker_id] > self.request_timeout)
+            stale = (self.heartbeat_timeout is not None) \
+                and (now - self.heartbeat[worker_id] > self.heartbeat_timeout)
+            if p.is_alive() and not hanging and not stale:
+                continue
+            if not p.is_alive():
+                reason = 'Worker {} died with exit code {}.'.format(worker_id, p.exitcode)
+            elif hanging:
+                reason = 'Worker {} timed out after {}s.'.format(worker_id, self.request_timeout)
+            else:
+                reason = 'Worker {} sent no heartbeat for {}s.'.format(worker_id, self.heartbeat_timeout)
+            p.terminate()
+            p.join(timeout=self.poll_interval)
+            if request_id >= 0:
+                self._fail_or_retry(request_id, reason)
+            self._spawn(worker_id)
+            self.restarts += 1
+            restarted.append(worker_id)
+        self._dispatch()
+        return restarted
+
+    def _collect(self, timeout):
+        try:
+            worker_id, request_id, ok, out = self.result_q.get(timeout=timeout)
+        except queue.Empty:
+            return
+        if self.current[worker_id] == request_id:
+            self.current[worker_id] = -1
+            self.busy_since[worker_id] = None
+            self._dispatch()
+        if request_id not in self.pending:
+            return
+        self.pending.pop(request_id)
+        self.retries.pop(request_id)
+        self.results[request_id] = (ok, out)
+
+    def get(self, request_id, timeout=None):
+        """
+        Wait for the result of request_id. Raises RuntimeError with the worker
+            traceback if the request failed.
+        """
+        start = time.time()
+        while request_id not in self.results:
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError('Request {} not finished after {}s.'.format(request_id, timeout))
+            self._collect(self.poll_interval)
+            self.check_health()
+        ok, out = self.results.pop(request_id)
+        if not ok:
+            raise RuntimeError('Request {} failed:\n{}'.format(request_id, out))
+        return out
+
+    def map(self, requests, timeout=None):
+        """
+        Run a list of inference kwargs dicts, results come back in order.
+        """
+        request_ids = [self.submit(**kwargs) for kwargs in requests]
+        return [self.get(request_id, timeout=timeout) for request_id in request_ids]
+
+    def close(self):
+        for request_q in self.request_qs:
+            if request_q is not None:
+                request_q.put(None)
+        for p in self.workers:
+            if p is None:
+                continue
+            p.join(timeout=self.poll_interval * 5)
+            if p.is_alive():
+                p.terminate()
+        self.workers = [None] * self.num_workers
+        self.request_qs = [None] * self.num_workers
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,88 @@
+"""
+Throughput of the audio VAE front-end (waveform -> subband fbank -> posterior)
+and back-end (latent -> waveform), per-sample reference path against the
+fused batched path.
+
+PYTHONPATH='.' python scripts/benchmark_audio_vae.py \
+    --batch_sizes 1 2 4 8 16 32 --time 10.24
+"""
+
+import argparse
+import time
+
+import torch
+
+from core.models.audio_autoencoder import AudioAutoencoderKL
+from core.models.audioldm.audio.tools import wav_to_fbank
+
+
+def reference_encode(vae, wav, duration):
+    x = wav_to_fbank(
+        wav.float(), target_length=int(duration * 102.4), fn_STFT=vae.fn_STFT.float()
+    ).to(wav.device).to(wav.dtype)
+    x = vae.freq_split_subband(x)
+    return vae.quant_conv(vae.encoder(x))
+
+
+def fused_encode(vae, wav, duration):
+    x = vae.wav_to_subband_fbank(wav, int(duration * 102.4)).to(wav.dtype)
+    return vae.quant_conv(vae.encoder(x))
+
+
+def reference_decode(vae, z):
+    dec = vae.decode(z)
+    mel = dec.squeeze(1).permute(0, 2, 1)
+    return torch.from_numpy(vae.vocoder(mel).cpu().numpy())
+
+
+def fused_decode(vae, z):
+    return vae.decode_waveform(z).cpu()
+
+
+def timed(fn, repeats):
+    torch.cuda.synchronize()
+    tic = time.time()
+    for _ in range(repeats):
+        out = fn()
+    torch.cuda.synchronize()
+    return out, (time.time() - tic) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--time', type=float, default=10.24)
+    parser.add_argument('--latent_length', type=int, default=256)
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dtype = torch.float16 if args.fp16 else torch.float32
+    vae = AudioAutoencoderKL().cuda().to(dtype)
+    vae.eval()
+    torch.manual_seed(args.seed)
+
+    print('{:>6} {:>8} {:>12} {:>12} {:>9} {:>10}'.format(
+        'batch', 'stage', 'ref (it/s)', 'fused (it/s)', 'speedup', 'max diff'))
+    with torch.no_grad():
+        for bs in args.batch_sizes:
+            wav = torch.rand(bs, int(args.time * 16000), device='cuda', dtype=dtype) * 2 - 1
+            z = torch.randn(bs, vae.embed_dim, args.latent_length, 16, device='cuda', dtype=dtype)
+            stages = [
+                ('encode', lambda: reference_encode(vae, wav, args.time), lambda: fused_encode(vae, wav, args.time)),
+                ('decode', lambda: reference_decode(vae, z), lambda: fused_decode(vae, z)),
+            ]
+            for name, ref_fn, fused_fn in stages:
+                # warmup
+                ref_fn()
+                fused_fn()
+                ref, ref_time = timed(ref_fn, args.repeats)
+                out, fused_time = timed(fused_fn, args.repeats)
+                diff = (ref.float().cpu() - out.float().cpu()).abs().max().item()
+                print('{:>6} {:>8} {:>12.2f} {:>12.2f} {:>8.2f}x {:>10.2e}'.format(
+                    bs, name, bs / ref_time, bs / fused_time, ref_time / fused_time, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Step time / max batch size trade-off of activation checkpointing policies for
+    the joint VD U-Net.
+
+PYTHONPATH='.' python scripts/benchmark_checkpoint_policy.py \
+    --xtype video audio --budgets_gb 0 8 16 32 inf
+"""
+
+import argparse
+import time
+
+import torch
+
+from core.cfg_helper import model_cfg_bank
+from core.models import get_model
+from core.models.checkpoint_policy import \
+    find_checkpointable_blocks, estimate_activation_bytes, \
+    select_by_budget, apply_checkpoint_policy
+
+
+def make_inputs(xtype, batch_size, args, device):
+    x = []
+    for xtype_i in xtype:
+        if xtype_i == 'image':
+            shape = [batch_size, 4, args.image_size//8, args.image_size//8]
+        elif xtype_i == 'video':
+            shape = [batch_size, 4, args.num_frames, args.image_size//8, args.image_size//8]
+        elif xtype_i == 'text':
+            shape = [batch_size, 768]
+        elif xtype_i == 'audio':
+            shape = [batch_size, 8, 256, 16]
+        x.append(torch.randn(shape, device=device))
+    t = torch.randint(0, 1000, (batch_size,), device=device)
+    condition = [torch.randn(batch_size, 77, 768, device=device)]
+    return x, t, condition
+
+
+def step(unet, xtype, batch_size, args, device):
+    x, t, condition = make_inputs(xtype, batch_size, args, device)
+    out = unet(x, t, condition, xtype, ['text'], {'text': 1})
+    loss = sum([o.float().pow(2).mean() for o in out])
+    loss.backward()
+    unet.zero_grad(set_to_none=True)
+
+
+def time_step(unet, xtype, batch_size, args, device):
+    for _ in range(args.warmup):
+        step(unet, xtype, batch_size, args, device)
+    torch.cuda.synchronize()
+    tic = time.time()
+    for _ in range(args.repeat):
+        step(unet, xtype, batch_size, args, device)
+    torch.cuda.synchronize()
+    return (time.time() - tic) / args.repeat
+
+
+def max_batch_size(unet, xtype, args, device):
+    def fits(bs):
+        try:
+            step(unet, xtype, bs, args, device)
+            return True
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            return False
+        finally:
+            torch.cuda.empty_cache()
+
+    lo, hi = 0, 1
+    while hi <= args.max_batch_size and fits(hi):
+        lo, hi = hi, hi * 2
+    hi = min(hi, args.max_batch_size + 1)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--xtype', nargs='+', default=['video', 'audio'])
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--num_frames', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--budgets_gb', type=float, nargs='+', default=[0, 8, 16, 32, float('inf')])
+    parser.add_argument('--max_batch_size', type=int, default=64)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device('cuda')
+    cfg = model_cfg_bank()('openai_unet_vd')
+    cfg.args.unet_image_cfg.args.use_video_architecture = True
+    unet = get_model()(cfg).to(device)
+    unet.train()
+
+    blocks = find_checkpointable_blocks(unet)
+    estimate_activation_bytes(
+        blocks, lambda: unet(*make_inputs(args.xtype, 1, args, device), args.xtype, ['text'], {'text': 1}))
+    full = sum([b.activation_bytes for b in blocks]) * args.batch_size
+    print('{} checkpointable blocks, estimated activations {:.2f} GB at batch size {}'.format(
+        len(blocks), full / 2**30, args.batch_size))
+
+    print('{:>10} {:>8} {:>12} {:>12} {:>10}'.format(
+        'budget GB', 'ckpt', 'est. GB', 'step (s)', 'max bs'))
+    for budget in args.budgets_gb:
+        selected, estimate = select_by_budget(blocks, args.batch_size, budget * 2**30)
+        apply_checkpoint_policy(blocks, selected)
+        step_time = time_step(unet, args.xtype, args.batch_size, args, device)
+        max_bs = max_batch_size(unet, args.xtype, args, device)
+        print('{:>10} {:>8} {:>12.2f} {:>12.3f} {:>10}'.format(
+            budget, len(selected), estimate / 2**30, step_time, max_bs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Quality / speed benchmark of cross-step feature reuse against full computation.
+
+PYTHONPATH='.' python scripts/benchmark_feature_cache.py \
+    --data_dir pretrained --xtype image --prompt "a sea turtle swimming" \
+    --intervals 1 2 3 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from core.models.model_module_infer import model_module
+
+
+def to_array(out, xtype):
+    if xtype == 'image':
+        return np.stack([np.asarray(xi, dtype=np.float32) / 255.0 for xi in out])
+    elif xtype == 'video':
+        return np.stack([np.stack([np.asarray(fi, dtype=np.float32) / 255.0 for fi in video]) for video in out])
+    elif xtype == 'audio':
+        return np.asarray(out, dtype=np.float32)
+    raise ValueError('No numeric comparison for xtype {}'.format(xtype))
+
+
+def psnr(x, ref, peak=1.0):
+    mse = np.mean((x - ref) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(peak ** 2 / mse)
+
+
+def run(model, args, cache_interval):
+    torch.manual_seed(args.seed)
+    torch.cuda.synchronize()
+    tic = time.time()
+    out = model.inference(
+        xtype=[args.xtype],
+        condition=[args.prompt],
+        condition_types=['text'],
+        n_samples=args.n_samples,
+        image_size=args.image_size,
+        ddim_steps=args.ddim_steps,
+        scale=args.scale,
+        num_frames=args.num_frames,
+        cache_interval=cache_interval,
+        cache_depth=args.cache_depth,
+        cache_schedule=args.cache_schedule)
+    torch.cuda.synchronize()
+    return out[0], time.time() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default='pretrained')
+    parser.add_argument('--pth', nargs='+', default=[
+        'CoDi_encoders.pth', 'CoDi_text_diffuser.pth',
+        'CoDi_audio_diffuser_m.pth', 'CoDi_video_diffuser_8frames.pth'])
+    parser.add_argument('--xtype', default='image', choices=['image', 'video', 'audio'])
+    parser.add_argument('--prompt', default='a sea turtle swimming in the ocean')
+    parser.add_argument('--n_samples', type=int, default=1)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--num_frames', type=int, default=8)
+    parser.add_argument('--ddim_steps', type=int, default=50)
+    parser.add_argument('--scale', type=float, default=7.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--intervals', type=int, nargs='+', default=[1, 2, 3, 5])
+    parser.add_argument('--cache_depth', type=int, default=1)
+    parser.add_argument('--cache_schedule', default='uniform', choices=['uniform', 'quad'])
+    parser.add_argument('--warmup', type=int, default=1)
+    args = parser.parse_args()
+
+    model = model_module(data_dir=args.data_dir, pth=args.pth)
+    model = model.cuda()
+    model.eval()
+
+    for _ in range(args.warmup):
+        run(model, args, 1)
+
+    ref, ref_time = run(model, args, 1)
+    ref = to_array(ref, args.xtype)
+    print('{:>8} {:>10} {:>9} {:>9}'.format('interval', 'time (s)', 'speedup', 'psnr'))
+    for interval in args.intervals:
+        if interval == 1:
+            out, elapsed = ref, ref_time
+        else:
+            out, elapsed = run(model, args, interval)
+            out = to_array(out, args.xtype)
+        peak = np.abs(ref).max() if args.xtype == 'audio' else 1.0
+        print('{:>8} {:>10.2f} {:>8.2f}x {:>9.2f}'.format(
+            interval, elapsed, ref_time / elapsed, psnr(out, ref, peak)))
+
+
+if __name__ == '__main__':
+    main()
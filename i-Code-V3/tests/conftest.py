@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# tests import `core` from the repository root, as the scripts do with PYTHONPATH='.'
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,155 @@
+import random
+
+import pytest
+import regex as re
+import torch
+
+from core.models.audioldm.clap.open_clip.tokenizer import (
+    SimpleTokenizer,
+    basic_clean,
+    get_pairs,
+    tokenize,
+    tokenize_batch,
+    whitespace_clean,
+)
+
+
+def legacy_bpe(tokenizer, cache, token):
+    if token in cache:
+        return cache[token]
+    word = tuple(token[:-1]) + (token[-1] + "</w>",)
+    pairs = get_pairs(word)
+
+    if not pairs:
+        return token + "</w>"
+
+    while True:
+        bigram = min(pairs, key=lambda pair: tokenizer.bpe_ranks.get(pair, float("inf")))
+        if bigram not in tokenizer.bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        new_word = tuple(new_word)
+        word = new_word
+        if len(word) == 1:
+            break
+        else:
+            pairs = get_pairs(word)
+    word = " ".join(word)
+    cache[token] = word
+    return word
+
+
+def legacy_tokenize(tokenizer, texts, context_length=77):
+    """
+    Per-text tokenization replaced by tokenize_batch, kept as the reference.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    cache = {"<start_of_text>": "<start_of_text>", "<end_of_text>": "<end_of_text>"}
+
+    def encode(text):
+        bpe_tokens = []
+        text = whitespace_clean(basic_clean(text)).lower()
+        for token in re.findall(tokenizer.pat, text):
+            token = "".join(tokenizer.byte_encoder[b] for b in token.encode("utf-8"))
+            bpe_tokens.extend(
+                tokenizer.encoder[bpe_token] for bpe_token in legacy_bpe(tokenizer, cache, token).split(" ")
+            )
+        return bpe_tokens
+
+    sot_token = tokenizer.encoder["<start_of_text>"]
+    eot_token = tokenizer.encoder["<end_of_text>"]
+    all_tokens = [[sot_token] + encode(text) + [eot_token] for text in texts]
+    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+
+    for i, tokens in enumerate(all_tokens):
+        if len(tokens) > context_length:
+            tokens = tokens[:context_length]  # Truncate
+        result[i, : len(tokens)] = torch.tensor(tokens)
+
+    return result
+
+
+WORDS = [
+    "dog", "barking", "a", "the", "Rain", "on", "tin", "roof", "engine", "idling", "birds",
+    "chirping", "loudly", "while", "cars", "pass", "by", "it's", "they're", "we'll", "42", "2023",
+    "café", "naïve", "Müller", "日本語", "音楽", "😀", "--", "...", "!?", "&amp;", "&lt;b&gt;",
+    "  ", "\t", "\n", "<start_of_text>", "<end_of_text>", "supercalifragilisticexpialidocious",
+]
+
+
+def random_texts(seed, num_texts=64, max_words=120):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(num_texts):
+        # lengths up to max_words exceed the context length and exercise truncation
+        words = [rng.choice(WORDS) for _ in range(rng.randint(0, max_words))]
+        texts.append(" ".join(words))
+    return texts
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return SimpleTokenizer()
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("context_length", [77, 16])
+def test_tokenize_batch_matches_legacy(tokenizer, seed, context_length):
+    texts = random_texts(seed)
+    expected = legacy_tokenize(tokenizer, texts, context_length)
+    assert torch.equal(tokenize_batch(texts, context_length, tokenizer=tokenizer), expected)
+    # second pass is served from the word caches
+    assert torch.equal(tokenize_batch(texts, context_length, tokenizer=tokenizer), expected)
+
+
+def test_tokenize_single_text_matches_legacy(tokenizer):
+    text = random_texts(7, num_texts=1)[0]
+    assert torch.equal(tokenize(text), legacy_tokenize(tokenizer, text))
+
+
+@pytest.mark.parametrize("cache_size", [1, 2, 8])
+def test_tiny_cache_matches_legacy(tokenizer, cache_size):
+    tiny = SimpleTokenizer(cache_size=cache_size)
+    for seed in range(3):
+        texts = random_texts(seed, num_texts=16)
+        expected = legacy_tokenize(tokenizer, texts)
+        assert torch.equal(tokenize_batch(texts, tokenizer=tiny), expected)
+        assert len(tiny.cache) <= cache_size and len(tiny.ids_cache) <= cache_size
+    info = tiny.cache_info()
+    assert info["ids"]["misses"] > 0
+
+
+def test_out_reuse(tokenizer):
+    out = torch.full((16, 77), -1, dtype=torch.long)
+    for seed in range(3):
+        texts = random_texts(seed, num_texts=16)
+        result = tokenize_batch(texts, out=out, tokenizer=tokenizer)
+        assert result.data_ptr() == out.data_ptr()
+        assert torch.equal(result, legacy_tokenize(tokenizer, texts))
+
+    with pytest.raises(AssertionError):
+        tokenize_batch(random_texts(0, num_texts=4), out=out, tokenizer=tokenizer)
+
+
+def test_empty_inputs(tokenizer):
+    result = tokenize_batch([], tokenizer=tokenizer)
+    assert result.shape == (0, 77) and result.dtype == torch.long
+    assert torch.equal(tokenize_batch(["", " "], tokenizer=tokenizer), legacy_tokenize(tokenizer, ["", " "]))